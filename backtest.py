@@ -0,0 +1,41 @@
+import argparse
+import json
+
+import src.backtest as bcktst
+import src.storage as storage
+import train
+
+parser = argparse.ArgumentParser(
+    description='Rolling-origin backtest of the duration and chunk models')
+parser.add_argument('--model', choices=sorted(bcktst.MODELS), default='ridge')
+parser.add_argument('--min-train-days', type=int, default=14)
+parser.add_argument('--test-days', type=int, default=1)
+parser.add_argument('--step-days', type=int, default=1)
+parser.add_argument('--train-days', type=int,
+                    help='Rolling window length. Expanding if not given')
+parser.add_argument('--workers', type=int)
+parser.add_argument('--out', help='Write the full report to this JSON file')
+args = parser.parse_args()
+
+# Load in our parameters file
+with open('parameters.json') as f:
+    params = json.load(f)
+
+db = storage.open_storage(params)
+
+tasks = [(name, frame, features, target) for name, frame, features, target, _
+            in train.model_tasks(params, db)]
+
+report = bcktst.backtest(tasks, model_name=args.model, workers=args.workers,
+            min_train_days=args.min_train_days, test_days=args.test_days,
+            step_days=args.step_days, train_days=args.train_days)
+
+for name, task_rmse in report['tasks'].items():
+    print (name, " RMSE: ", task_rmse)
+    for window in report['windows'][name]:
+        print ("    ", window['origin'], " trained on ", window['train_days'],
+                " days, RMSE: ", window['rmse'])
+
+if args.out:
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
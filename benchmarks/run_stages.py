@@ -0,0 +1,480 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import src.extract as extract
+import src.label_starts as label_starts
+import src.label_trips as label_trips
+import src.sample_schedule as smpl_schd
+import src.build_chunks as bld_chnks
+import src.chunk_trips as chnk_trps
+import src.trip_chunk_collections as trp_chnks_coll
+import src.headways as headways
+
+from src.storage import MemoryStorage
+
+from benchmarks.synthetic_avl import build_world
+
+# Stages in pipeline order. Each one needs the stages before it to have run.
+STAGES = ['extract', 'label_starts', 'label_trips', 'sample_schedule',
+            'build_chunks', 'chunk_trips', 'aggregate']
+
+# Where baselines are kept, one per backend
+BASELINE_DIR = 'benchmarks/baselines'
+
+# Name of the scratch database on a local mongod
+BENCH_DATABASE = 'muni_benchmark'
+
+
+def get_database(backend, host='localhost', port=27017):
+    """
+    A fresh database on the in-memory storage, mongomock or a local mongod
+    """
+
+    if backend == 'memory':
+        return MemoryStorage()
+
+    if backend == 'mongomock':
+        import mongomock
+        return mongomock.MongoClient()[BENCH_DATABASE]
+
+    from pymongo import MongoClient
+
+    client = MongoClient(host, port)
+    client.drop_database(BENCH_DATABASE)
+
+    return client[BENCH_DATABASE]
+
+
+def count(collection, query=None):
+    """
+    Number of documents matching a query
+    """
+
+    return collection.count_documents(query or {})
+
+
+def ftp_lines(path):
+    """
+    Lines of a day file as the FTP server hands them over, with the header
+    glued to the first row
+    """
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+
+    return [lines[0] + lines[1]] + lines[2:]
+
+
+############
+# Stages
+# Each takes the run's context and returns counts of what it produced
+
+def run_extract(ctx):
+
+    extractor = extract.Extractor(ctx['raw'], bus=ctx['bus'],
+                    direction=ctx['direction'], gtfs_period=0)
+    extractor.setup()
+
+    for path in ctx['day_files']:
+        for line in ftp_lines(path):
+            extractor.read_ftp(line)
+        extractor.flush()
+
+    return {'lines': extractor.total_count, 'kept': extractor.filter_count}
+
+
+def run_label_starts(ctx):
+
+    labeler = label_starts.StartLabeler(ctx['raw'], ctx['label'], gtfs_period=0)
+    labeler.label_single_starts()
+
+    return {'starts': count(ctx['label'], {'trip_start': 1})}
+
+
+def run_label_trips(ctx):
+
+    labeler = label_trips.TripLabeler(ctx['raw'], ctx['label'], gtfs_period=0)
+    labeler.label_trips()
+
+    return {'good': labeler.good_trip_count, 'docs': labeler.good_doc_count,
+            'mini': labeler.mini, 'giant': labeler.giant,
+            'endless': labeler.endless, 'empty': labeler.empty,
+            'sparse': labeler.sparse}
+
+
+def run_sample_schedule(ctx):
+
+    # Don't time a cache hit from an earlier run
+    shutil.rmtree(smpl_schd.SCHEDULE_DIR, ignore_errors=True)
+
+    ctx['schedule_path'] = smpl_schd.create_sample_schedule(0, ctx['label'],
+                                bus=ctx['bus'], direction=ctx['direction'])
+
+    with open(ctx['schedule_path']) as f:
+        return {'stops': sum(1 for line in f) - 1}
+
+
+def run_build_chunks(ctx):
+
+    chunky = bld_chnks.ChunkBuilder(ctx['label'], ctx['chunk'], ctx['chunks'],
+                schedule_path=ctx['schedule_path'])
+    chunky.get_chunk_info()
+
+    return {'chunk_sets': count(ctx['chunk'])}
+
+
+def run_chunk_trips(ctx):
+
+    chunker = chnk_trps.TripChunker(ctx['label'], ctx['chunk'])
+    chunker.chunk_trips(verbose=False)
+
+    counts = {}
+    for chunk_interval in ctx['chunks']:
+        field = 'chunk_' + str(chunk_interval)
+        counts[field] = count(ctx['label'], {field: {'$exists': True}})
+
+    return counts
+
+
+def run_aggregate(ctx):
+
+    db = ctx['db']
+    all_trips = ctx['label'].distinct('trip_id_iso')
+
+    trp_chnks_coll.temporal_features_total(all_trips, ctx['label'],
+                                            db['trips_total_duration'])
+    counts = {'duration': count(db['trips_total_duration'])}
+
+    for chunk_interval in ctx['chunks']:
+
+        coll_str = 'chunk_' + str(chunk_interval) + '_collection'
+        trp_chnks_coll.chunk_data_interval(all_trips, ctx['label'], ctx['chunk'],
+                                            db[coll_str], chunk_interval)
+
+        headway_str = 'headway_' + str(chunk_interval) + '_collection'
+        headways.headway_data_interval(ctx['label'], db[headway_str],
+                                        chunk_interval)
+
+        counts[coll_str] = count(db[coll_str])
+        counts[headway_str] = count(db[headway_str])
+
+    return counts
+
+
+STAGE_FUNCTIONS = {
+    'extract': run_extract,
+    'label_starts': run_label_starts,
+    'label_trips': run_label_trips,
+    'sample_schedule': run_sample_schedule,
+    'build_chunks': run_build_chunks,
+    'chunk_trips': run_chunk_trips,
+    'aggregate': run_aggregate
+}
+
+
+############
+# Running
+
+def run_pipeline(ctx, stages, verbose=False):
+    """
+    Run the stages once, in order, timing each. A stage that fails is recorded
+    with its error, and the stages after it are skipped.
+    Output: Dictionary of stage results
+    """
+
+    results = {}
+    failed = None
+
+    for stage in stages:
+
+        if failed:
+            results[stage] = {'status': 'skipped',
+                                'error': 'needs ' + failed}
+            continue
+
+        output = sys.stdout if verbose else io.StringIO()
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        try:
+            with contextlib.redirect_stdout(output):
+                counts = STAGE_FUNCTIONS[stage](ctx)
+
+        except Exception as e:
+            results[stage] = {'status': 'error',
+                                'error': '{}: {}'.format(type(e).__name__, e)}
+            failed = stage
+            continue
+
+        results[stage] = {
+            'status': 'ok',
+            'seconds': time.perf_counter() - wall,
+            'cpu_seconds': time.process_time() - cpu,
+            'counts': counts
+        }
+
+    return results
+
+
+def summarize(runs):
+    """
+    Combine repeated runs: the median time of each stage, and its counts from
+    the first run
+    """
+
+    summary = {}
+
+    for stage, first in runs[0].items():
+
+        summary[stage] = dict(first)
+
+        if first['status'] != 'ok':
+            continue
+
+        times = [run[stage]['seconds'] for run in runs
+                    if run[stage]['status'] == 'ok']
+        cpu = [run[stage]['cpu_seconds'] for run in runs
+                    if run[stage]['status'] == 'ok']
+
+        summary[stage]['seconds'] = float(np.median(times))
+        summary[stage]['cpu_seconds'] = float(np.median(cpu))
+        summary[stage]['runs'] = times
+
+    return summary
+
+
+def run_benchmarks(work_dir, backend='memory', repeat=3, stages=STAGES,
+                    chunks=(2, 6), host='localhost', port=27017, seed=0,
+                    verbose=False, **world_args):
+    """
+    Generate a synthetic world and time every stage of the pipeline on it.
+    Stages are run `repeat` times, each on an empty database.
+    Output: Dictionary with the configuration, the generated world's ground
+    truth and the results of each stage
+    """
+
+    world = build_world(work_dir, seed=seed, **world_args)
+    day_files = [os.path.abspath(path) for path in world['day_files']]
+
+    config = {
+        'backend': backend,
+        'days': len(world['days']),
+        'blocks': len(world['blocks']),
+        'chunks': list(chunks),
+        'seed': seed,
+        'repeat': repeat
+    }
+
+    # The pipeline reads its data files relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+
+    runs = []
+
+    try:
+        for run in range(repeat):
+
+            # The labelers and chunk builder sample at random
+            random.seed(seed)
+            np.random.seed(seed)
+
+            db = get_database(backend, host, port)
+
+            ctx = {
+                'db': db,
+                'raw': db['avl_raw'],
+                'label': db['labeled_trips'],
+                'chunk': db['chunk_details'],
+                'bus': world['bus'],
+                'direction': world['direction'],
+                'chunks': list(chunks),
+                'day_files': day_files
+            }
+
+            runs.append(run_pipeline(ctx, stages, verbose))
+
+    finally:
+        os.chdir(cwd)
+
+    return {
+        'config': config,
+        'environment': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor()
+        },
+        'truth': world['truth'],
+        'stages': summarize(runs)
+    }
+
+
+############
+# Regression report
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare stage results to a baseline. A stage is:
+        broken: It ran in the baseline, but fails or is skipped now
+        changed: It produced different counts, so its output changed
+        slower/faster: Its median time changed by more than the tolerance
+        same: None of the above
+    Output: List of rows, one per stage, and a list of warnings
+    """
+
+    warnings = []
+
+    if results['config'] != baseline['config']:
+        warnings.append('Configurations differ: {} vs {}'.format(
+            results['config'], baseline['config']))
+
+    if results['environment'] != baseline['environment']:
+        warnings.append('Baseline was recorded on a different environment')
+
+    rows = []
+
+    for stage, current in results['stages'].items():
+
+        base = baseline['stages'].get(stage)
+        row = {'stage': stage, 'status': current['status'],
+                'seconds': current.get('seconds'),
+                'baseline': base.get('seconds') if base else None}
+
+        if base is None or base['status'] != 'ok':
+            row['verdict'] = 'new' if current['status'] == 'ok' else current['status']
+
+        elif current['status'] != 'ok':
+            row['verdict'] = 'broken'
+
+        elif current['counts'] != base['counts']:
+            row['verdict'] = 'changed'
+
+        else:
+            ratio = current['seconds'] / max(base['seconds'], 1e-9)
+            row['ratio'] = ratio
+
+            if ratio > 1 + tolerance:
+                row['verdict'] = 'slower'
+            elif ratio < 1 - tolerance:
+                row['verdict'] = 'faster'
+            else:
+                row['verdict'] = 'same'
+
+        rows.append(row)
+
+    return rows, warnings
+
+
+def print_report(results, rows=None, warnings=()):
+
+    print ("\n")
+    print ("Generated trips: ", results['truth'])
+    print ("\n")
+
+    header = '{:<16}{:>10}{:>10}{:>8}  {}'
+    print (header.format('stage', 'seconds', 'baseline', 'ratio', 'verdict'))
+
+    def fmt(value, spec):
+        return spec.format(value) if value is not None else '-'
+
+    rows = rows or [{'stage': stage, 'seconds': res.get('seconds'),
+                        'verdict': res['status']}
+                    for stage, res in results['stages'].items()]
+
+    for row in rows:
+        print (header.format(row['stage'], fmt(row.get('seconds'), '{:.3f}'),
+                fmt(row.get('baseline'), '{:.3f}'), fmt(row.get('ratio'), '{:.2f}'),
+                row['verdict']))
+
+    for stage, res in results['stages'].items():
+        if res['status'] == 'error':
+            print ("\n", stage, ": ", res['error'])
+
+    for warning in warnings:
+        print ("\nWarning: ", warning)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark each pipeline stage on synthetic AVL data')
+    parser.add_argument('--backend', choices=['memory', 'mongomock', 'mongod'],
+                        default='memory',
+                        help="mongomock can't run the stages from build_chunks on")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--blocks', type=int, default=9)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='*', choices=STAGES,
+                        help='Only run up to the last of these stages')
+    parser.add_argument('--work-dir',
+                        help='Where to generate data. Defaults to a temporary directory')
+    parser.add_argument('--baseline',
+                        help='Baseline to compare to. Defaults to '
+                             'benchmarks/baselines/<backend>.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative change in time treated as noise')
+    parser.add_argument('--output', help='Also write the results to this file')
+    parser.add_argument('--verbose', action='store_true',
+                        help="Show the stages' own output")
+    args = parser.parse_args()
+
+    stages = STAGES
+    if args.stages:
+        stages = STAGES[:max(STAGES.index(stage) for stage in args.stages) + 1]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='muni_bench_')
+    work_dir = os.path.abspath(work_dir)
+
+    results = run_benchmarks(work_dir, backend=args.backend,
+                    repeat=args.repeat, stages=stages, host=args.host,
+                    port=args.port, seed=args.seed, verbose=args.verbose,
+                    days=args.days, blocks=args.blocks)
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    baseline_path = args.baseline or os.path.join(BASELINE_DIR,
+                                                  args.backend + '.json')
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        print_report(results)
+        print ("\nSaved baseline to ", baseline_path)
+
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+        rows, warnings = compare(results, baseline, args.tolerance)
+        print_report(results, rows, warnings)
+
+        # Fail, for CI, when a stage got slower, broke or changed its output
+        if any(row['verdict'] in ('slower', 'broken', 'changed') for row in rows):
+            sys.exit(1)
+
+    else:
+        print_report(results)
+        print ("\nNo baseline at ", baseline_path, ", run with --save-baseline")
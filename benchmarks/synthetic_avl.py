@@ -0,0 +1,519 @@
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from src.extract import AVL_HEADER
+from src.geo import EARTH_RADIUS
+
+# Real GTFS period whose shapes.txt the synthetic route follows
+SOURCE_GTFS = 'data/gtfs/sfmta_2016-06-03'
+
+# Name and sign id of the synthetic GTFS period
+SYNTHETIC_DIR = 'synthetic'
+SYNTHETIC_SIGN_ID = 900
+
+# Distance between synthetic stops, in meters
+STOP_SPACING = 250
+
+# Average running speed between stops, in meters per second
+BASE_SPEED = 4.5
+
+# AVL units report every 20 to 50 seconds
+PING_INTERVAL = (20, 50)
+
+
+def route_shape(gtfs_dir=SOURCE_GTFS, bus='33', direction=0, shape_id=None):
+    """
+    Get the most common shape of a route and direction from a real GTFS period
+    Output: route_id, and the shape's points in order
+    """
+
+    routes = pd.read_csv(os.path.join(gtfs_dir, 'routes.txt'))
+    route_id = routes[routes['route_short_name'].str.strip() == bus]['route_id'].values[0]
+
+    if shape_id is None:
+        trips = pd.read_csv(os.path.join(gtfs_dir, 'trips.txt'))
+        trip_mask = (trips['route_id'] == route_id) \
+            & (trips['direction_id'] == direction)
+        shape_id = trips[trip_mask]['shape_id'].mode()[0]
+
+    shapes = pd.read_csv(os.path.join(gtfs_dir, 'shapes.txt'))
+    shape = shapes[shapes['shape_id'] == shape_id].sort_values('shape_pt_sequence')
+
+    return route_id, shape.reset_index(drop=True)
+
+
+class SyntheticRoute(object):
+    """
+    A synthetic GTFS period for one route and direction, following a real
+    shape, and AVL data of its vehicles driving it:
+        Vehicles lay over at the starting stop before each departure
+        Running speeds vary by time of day and along the route, with dwells at
+        stops
+        Pings are irregular, with GPS noise, and some trips have long gaps or
+        go silent before reaching the last stop
+        Unrelated vehicles report too, so the extractor has something to
+        filter
+    The number of trips of each kind is kept, to check the labelers against.
+    """
+
+    def __init__(self, shape, route_id, bus='33', direction=0, blocks=9,
+                    headway=12, first_departure='05:30', last_departure='22:30',
+                    noise=4.0, gap_rate=0.03, dropout_rate=0.02,
+                    background=2.0, seed=0):
+        """
+        Input:
+            shape, route_id:
+                Shape points and route_id, from route_shape
+            bus, direction:
+                Route name and direction of the synthetic trips
+            blocks:
+                Number of vehicles (and blocks) running the route
+            headway:
+                Minutes between scheduled departures
+            first_departure, last_departure:
+                Service span, as HH:MM
+            noise:
+                Standard deviation of the GPS noise, in meters
+            gap_rate:
+                Share of trips with a reporting gap long enough to be sparse
+            dropout_rate:
+                Share of trips whose vehicle stops reporting before the end
+            background:
+                Pings of unrelated vehicles per ping of the route
+            seed:
+                Seed of the random generator, so runs are repeatable
+        """
+
+        self.shape = shape
+        self.route_id = route_id
+        self.bus = bus
+        self.direction = direction
+        self.block_ids = [int(bus) * 100 + blk + 1 if bus.isdigit() else 9000 + blk
+                            for blk in range(blocks)]
+        self.headway = headway * 60
+        self.noise = noise
+        self.gap_rate = gap_rate
+        self.dropout_rate = dropout_rate
+        self.background = background
+        self.rng = np.random.RandomState(seed)
+
+        first = datetime.strptime(first_departure, '%H:%M')
+        last = datetime.strptime(last_departure, '%H:%M')
+        self.first_departure = first.hour * 3600 + first.minute * 60
+        self.last_departure = last.hour * 3600 + last.minute * 60
+
+        self.shape_dist = shape['shape_dist_traveled'].values.astype(float)
+        self.length = self.shape_dist[-1]
+
+        self.build_stops()
+
+        self.truth = {'trips': 0, 'good': 0, 'sparse': 0, 'endless': 0,
+                        'pings': 0, 'background_pings': 0}
+
+    ############
+    # GTFS
+
+    def point_at(self, dist):
+        """
+        Lat/lon of points at distances along the shape
+        """
+
+        lat = np.interp(dist, self.shape_dist, self.shape['shape_pt_lat'].values)
+        lon = np.interp(dist, self.shape_dist, self.shape['shape_pt_lon'].values)
+
+        return lat, lon
+
+    def build_stops(self):
+        """
+        Evenly spaced stops along the shape, always including both ends, with
+        the scheduled running time to each
+        """
+
+        count = max(int(round(self.length / STOP_SPACING)), 1)
+        self.stop_dist = np.linspace(0, self.length, count + 1)
+        self.stop_lat, self.stop_lon = self.point_at(self.stop_dist)
+        self.stop_ids = np.arange(90001, 90001 + len(self.stop_dist))
+
+        # Scheduled seconds from departure to each stop, with 15 second dwells
+        self.stop_offsets = self.stop_dist / BASE_SPEED \
+            + 15 * np.arange(len(self.stop_dist))
+
+    def departures(self):
+        """
+        Scheduled departures of the day, as (trip index, block_id, seconds
+        since midnight)
+        """
+
+        times = np.arange(self.first_departure, self.last_departure + 1,
+                            self.headway)
+
+        return [(idx, self.block_ids[idx % len(self.block_ids)], int(dep))
+                    for idx, dep in enumerate(times)]
+
+    def write_gtfs(self, gtfs_dir, services=(1, 2, 3), start_date=None,
+                    end_date=None):
+        """
+        Write the synthetic period's shapes, stops, trips, schedule and
+        calendar. Every service runs the same timetable, with service 1 on
+        weekdays, 2 on Saturdays and 3 on Sundays.
+        """
+
+        os.makedirs(gtfs_dir, exist_ok=True)
+
+        def hms(seconds):
+            seconds = int(round(seconds))
+            return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600,
+                        (seconds % 3600) // 60, seconds % 60)
+
+        shape_id = int(self.shape['shape_id'].values[0])
+
+        self.shape.to_csv(os.path.join(gtfs_dir, 'shapes.txt'), index=False)
+
+        pd.DataFrame({
+            'stop_id': self.stop_ids,
+            'stop_name': ['SYNTHETIC STOP {}'.format(idx + 1)
+                            for idx in range(len(self.stop_ids))],
+            'stop_lat': self.stop_lat.round(6),
+            'stop_lon': self.stop_lon.round(6)
+        }).to_csv(os.path.join(gtfs_dir, 'stops.txt'), index=False)
+
+        trips = []
+        stop_times = []
+
+        for service in services:
+            for idx, block, dep in self.departures():
+
+                trip_id = self.trip_id(service, idx)
+
+                trips.append((self.route_id, service, trip_id, 'SYNTHETIC',
+                                self.direction, block, shape_id))
+
+                for seq, (stop_id, offset, dist) in enumerate(zip(
+                        self.stop_ids, self.stop_offsets, self.stop_dist)):
+                    stop_times.append((trip_id, hms(dep + offset),
+                                        hms(dep + offset), stop_id, seq + 1,
+                                        round(dist, 1)))
+
+        pd.DataFrame(trips, columns=['route_id', 'service_id', 'trip_id',
+                        'trip_headsign', 'direction_id', 'block_id', 'shape_id']
+                    ).to_csv(os.path.join(gtfs_dir, 'trips.txt'), index=False)
+
+        pd.DataFrame(stop_times, columns=['trip_id', 'arrival_time',
+                        'departure_time', 'stop_id', 'stop_sequence',
+                        'shape_dist_traveled']
+                    ).to_csv(os.path.join(gtfs_dir, 'stop_times.txt'), index=False)
+
+        weekdays = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+                    'saturday', 'sunday']
+        day_service = {1: range(5), 2: [5], 3: [6]}
+
+        calendar = []
+        for service in services:
+            row = {'service_id': service}
+            for num, day in enumerate(weekdays):
+                row[day] = int(num in day_service.get(service, []))
+            row['start_date'] = start_date
+            row['end_date'] = end_date
+            calendar.append(row)
+
+        pd.DataFrame(calendar).to_csv(os.path.join(gtfs_dir, 'calendar.txt'),
+                                        index=False)
+
+        pd.DataFrame(columns=['service_id', 'date', 'exception_type']).to_csv(
+            os.path.join(gtfs_dir, 'calendar_dates.txt'), index=False)
+
+    def trip_id(self, service, idx):
+
+        return 8000000 + service * 10000 + idx
+
+    ############
+    # AVL
+
+    def speed_factor(self, seconds):
+        """
+        Traffic slows buses down around the morning and evening peaks
+        """
+
+        hour = seconds / 3600.0
+
+        return 1 - 0.25 * np.exp(-(hour - 8.5)**2 / 2) \
+            - 0.3 * np.exp(-(hour - 17.5)**2 / 2)
+
+    def run_profile(self, depart):
+        """
+        Actual seconds from departure to each point along the route: speeds
+        vary between 200 meter segments, with random dwells at stops
+        Output: Distances, and the seconds at which they are reached
+        """
+
+        seg_dist = np.append(np.arange(0, self.length, 200.0), self.length)
+        seg_len = np.diff(seg_dist)
+
+        speed = BASE_SPEED * self.speed_factor(depart) \
+            * self.rng.lognormal(0, 0.25, len(seg_len))
+        seg_time = seg_len / np.clip(speed, 1.0, 15.0)
+
+        # Dwell at each stop, added to the segment it falls in
+        stop_seg = np.searchsorted(seg_dist, self.stop_dist[1:-1]) - 1
+        dwell = self.rng.exponential(15, len(stop_seg))
+        np.add.at(seg_time, stop_seg, dwell)
+
+        return seg_dist, np.append(0, np.cumsum(seg_time))
+
+    def ping_times(self, start, end):
+        """
+        Irregular reporting times between two times
+        """
+
+        count = int((end - start) / PING_INTERVAL[0]) + 1
+        gaps = self.rng.uniform(PING_INTERVAL[0], PING_INTERVAL[1], count)
+        times = start + np.cumsum(gaps)
+
+        return times[times < end]
+
+    def jitter(self, lat, lon):
+        """
+        Add GPS noise, in meters, to coordinates
+        """
+
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+
+        d_north = self.rng.normal(0, self.noise, lat.shape)
+        d_east = self.rng.normal(0, self.noise, lat.shape)
+
+        lat = lat + np.degrees(d_north / EARTH_RADIUS)
+        lon = lon + np.degrees(d_east / (EARTH_RADIUS * np.cos(np.radians(lat))))
+
+        return lat, lon
+
+    def trip_pings(self, block, depart):
+        """
+        Pings of a vehicle for one scheduled departure: a layover at the
+        starting stop, the run itself, and a few pings at the last stop
+        Output: Arrays of seconds since midnight, latitudes and longitudes
+        """
+
+        self.truth['trips'] += 1
+
+        # Lay over at the first stop, and leave up to a few minutes late
+        layover = self.rng.uniform(240, 600)
+        actual = depart + max(self.rng.normal(60, 90), 0)
+
+        lay_times = self.ping_times(actual - layover, actual)
+        lay_times = np.append(lay_times, actual)
+        lay_lat = np.full(len(lay_times), self.stop_lat[0])
+        lay_lon = np.full(len(lay_times), self.stop_lon[0])
+
+        seg_dist, seg_secs = self.run_profile(actual)
+        arrive = actual + seg_secs[-1]
+
+        # The vehicle stays at the last stop a little while after arriving
+        run_times = self.ping_times(actual, arrive + self.rng.uniform(60, 180))
+        run_dist = np.interp(run_times - actual, seg_secs, seg_dist)
+        run_lat, run_lon = self.point_at(run_dist)
+
+        # Some trips have a long gap in reporting, or stop reporting before
+        # they get to the last stop
+        draw = self.rng.uniform()
+        keep = np.ones(len(run_times), dtype=bool)
+
+        if draw < self.gap_rate:
+            gap_start = self.rng.uniform(0.2, 0.8) * (arrive - actual) + actual
+            keep &= (run_times < gap_start) | (run_times > gap_start + 300)
+            self.truth['sparse'] += 1
+
+        elif draw < self.gap_rate + self.dropout_rate:
+            keep &= run_dist < self.length * self.rng.uniform(0.3, 0.9)
+            self.truth['endless'] += 1
+
+        else:
+            self.truth['good'] += 1
+
+        times = np.append(lay_times, run_times[keep])
+        lat, lon = self.jitter(np.append(lay_lat, run_lat[keep]),
+                                np.append(lay_lon, run_lon[keep]))
+
+        return times, lat, lon
+
+    def day_pings(self, date, service):
+        """
+        All pings of the route on a day, plus background pings
+        Output: DataFrame with the AVL columns, sorted by REPORT_TIME
+        """
+
+        frames = []
+
+        for idx, block, depart in self.departures():
+
+            times, lat, lon = self.trip_pings(block, depart)
+
+            frames.append(pd.DataFrame({
+                'seconds': times,
+                'LATITUDE': lat,
+                'LONGITUDE': lon,
+                'VEHICLE_TAG': 8400 + self.block_ids.index(block),
+                'TRAIN_ASSIGNMENT': block
+            }))
+
+        pings = pd.concat(frames, ignore_index=True)
+        self.truth['pings'] += len(pings)
+
+        # Unrelated vehicles anywhere in the city, on blocks of other routes
+        count = int(len(pings) * self.background)
+        self.truth['background_pings'] += count
+
+        frames.append(pd.DataFrame({
+            'seconds': self.rng.uniform(self.first_departure - 3600,
+                            self.last_departure + 7200, count),
+            'LATITUDE': self.rng.uniform(37.71, 37.81, count),
+            'LONGITUDE': self.rng.uniform(-122.51, -122.38, count),
+            'VEHICLE_TAG': self.rng.randint(1000, 8000, count),
+            'TRAIN_ASSIGNMENT': self.rng.randint(100, 9000, count) * 10
+        }))
+
+        pings = pd.concat(frames, ignore_index=True).sort_values('seconds',
+                                                                  kind='stable')
+
+        midnight = datetime(date.year, date.month, date.day)
+        whole = np.floor(pings['seconds'].values).astype(int)
+
+        pings['REV'] = 1
+        pings['REPORT_TIME'] = [
+            (midnight + timedelta(seconds=int(sec))).strftime('%m/%d/%Y %H:%M:%S')
+            for sec in whole]
+        pings['SPEED'] = 0
+        pings['HEADING'] = 0
+        pings['PREDICTABLE'] = 1
+        pings['LATITUDE'] = pings['LATITUDE'].round(6)
+        pings['LONGITUDE'] = pings['LONGITUDE'].round(6)
+
+        return pings[AVL_HEADER]
+
+    def write_day(self, path, date, service):
+        """
+        Write a day of AVL data in the format of the SFMTA's raw AVL files
+        """
+
+        self.day_pings(date, service).to_csv(path, index=False)
+
+
+def day_file_name(date):
+    """
+    Name of the raw AVL file of a day, as on the SFMTA FTP server
+    """
+
+    return 'sfmtaAVLRawData{}.csv'.format(date.strftime('%m%d%Y'))
+
+
+def build_world(work_dir, days=3, start_date='2016-06-06', bus='33',
+                direction=0, source_gtfs=SOURCE_GTFS, shape_id=None, **route_args):
+    """
+    Build a working directory the pipeline can run in, with:
+        data/gtfs/synthetic: The synthetic GTFS period
+        data/gtfs_lookup.csv: A lookup with only that period
+        data/lookUpBlockIDToBlockNumNam.csv: The real block lookup, plus the
+            synthetic blocks
+        avl/: One raw AVL file per day
+    Input:
+        work_dir: Directory to build in
+        days: Number of days of AVL data
+        start_date: First day, as YYYY-MM-DD
+        source_gtfs: Real GTFS period whose shape is followed
+        route_args: Passed on to SyntheticRoute
+    Output: Summary of what was generated, also written to work_dir
+    """
+
+    route_id, shape = route_shape(source_gtfs, bus, direction, shape_id)
+    route = SyntheticRoute(shape, route_id, bus=bus, direction=direction,
+                            **route_args)
+
+    first = datetime.strptime(start_date, '%Y-%m-%d')
+    dates = [first + timedelta(days=day) for day in range(days)]
+    until = dates[-1] + timedelta(days=1)
+
+    data_dir = os.path.join(work_dir, 'data')
+    avl_dir = os.path.join(work_dir, 'avl')
+    os.makedirs(avl_dir, exist_ok=True)
+
+    route.write_gtfs(os.path.join(data_dir, 'gtfs', SYNTHETIC_DIR),
+                        start_date=first.strftime('%Y%m%d'),
+                        end_date=until.strftime('%Y%m%d'))
+
+    # The real routes, so the route is looked up the same way
+    shutil.copy(os.path.join(source_gtfs, 'routes.txt'),
+                os.path.join(data_dir, 'gtfs', SYNTHETIC_DIR))
+
+    pd.DataFrame({
+        'from_date': [first.strftime('%Y-%m-%d')],
+        'to_date': [until.strftime('%Y-%m-%d')],
+        'directory': [SYNTHETIC_DIR],
+        'sign_id': [SYNTHETIC_SIGN_ID]
+    }).to_csv(os.path.join(data_dir, 'gtfs_lookup.csv'), index=False)
+
+    # Keep the real lookup, so block names are read the same way
+    blockref = pd.read_csv('data/lookUpBlockIDToBlockNumNam.csv')
+    synth_blocks = pd.DataFrame({
+        'SIGNID': SYNTHETIC_SIGN_ID,
+        'BLOCKID': np.arange(len(route.block_ids)) + 990000,
+        'BLOCKNUM': route.block_ids,
+        'BLOCKNAME': [str(block) for block in route.block_ids]
+    })
+    pd.concat([blockref, synth_blocks], ignore_index=True).to_csv(
+        os.path.join(data_dir, 'lookUpBlockIDToBlockNumNam.csv'), index=False)
+
+    # Copy the route list along, for tools that look routes up
+    shutil.copy('data/muni_routes.csv', data_dir)
+
+    day_files = []
+    for date in dates:
+        service = {5: 2, 6: 3}.get(date.weekday(), 1)
+        path = os.path.join(avl_dir, day_file_name(date))
+        route.write_day(path, date, service)
+        day_files.append(path)
+
+    summary = {
+        'bus': bus,
+        'direction': direction,
+        'shape_id': int(shape['shape_id'].values[0]),
+        'route_length': float(route.length),
+        'stops': len(route.stop_ids),
+        'blocks': route.block_ids,
+        'days': [date.strftime('%Y-%m-%d') for date in dates],
+        'day_files': day_files,
+        'truth': route.truth
+    }
+
+    with open(os.path.join(work_dir, 'synthetic.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    return summary
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic GTFS period and AVL data for a route')
+    parser.add_argument('work_dir', help='Directory to build in')
+    parser.add_argument('--days', type=int, default=3)
+    parser.add_argument('--start-date', default='2016-06-06')
+    parser.add_argument('--bus', default='33')
+    parser.add_argument('--direction', type=int, default=0)
+    parser.add_argument('--blocks', type=int, default=9)
+    parser.add_argument('--headway', type=float, default=12,
+                        help='Minutes between departures')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    summary = build_world(args.work_dir, days=args.days,
+                            start_date=args.start_date, bus=args.bus,
+                            direction=args.direction, blocks=args.blocks,
+                            headway=args.headway, seed=args.seed)
+
+    print (json.dumps(summary['truth'], indent=2))
@@ -1,86 +1,52 @@
+import argparse
 import json
 
-import pymongo
-from pymongo import MongoClient
+import src.instrument as instrument
+import src.orchestrator as orchestrator
+import src.profiling as profiling
+import src.stages as stages
+import src.storage as storage
 
-import src.sample_schedule as smpl_schd
-import src.build_chunks as bld_chnks
-import src.chunk_trips as chnk_trps
-import src.trip_chunk_collections as trp_chnks_coll
+parser = argparse.ArgumentParser(description='Chunk labeled trips and build feature collections')
+orchestrator.add_run_arguments(parser)
+profiling.add_profile_arguments(parser)
+args = parser.parse_args()
+
+# Profile the stages asked for. Without --profile, nothing is profiled
+instrument.RECORDER.profiler = profiling.profiler_from_args(args,
+                                    prefix='chunk_data_')
 
 # Load in our parameters file
 with open('parameters.json') as f:
     params = json.load(f)
 
-database = params['database']
-labeled_collection = params['labeled_collection']
-chunk_collection = params['chunk_collection']
-duration_collection = params['duration_collection']
-gtfs_period = params['gtfs_period']
-chunks = params['chunks']
-
-# Connect to the database
-client = MongoClient('localhost', 27017)
-
-# Select our database and collections
-db = client[database]
-label_coll = db[labeled_collection]
-chunk_coll = db[chunk_collection]
-duration_coll = db[duration_collection]
-
-# Start with empty collections
-chunk_coll.delete_many({});
-
-# Create the sample schedule with distances
-smpl_schd.create_sample_schedule(gtfs_period, label_coll)
-
-# Get details, such as the average stop, for various intervals of the data
-chunky = bld_chnks.ChunkBuilder(label_coll, chunk_coll, chunks)
-chunky.get_chunk_info()
-
-# For each trip, label which documents belong to which chunks
-# This will usually take a while, maybe 45 minutes when processing 50 days
-print ("\n")
-print ("Labelling trip documents with different chunks")
-trip_chunker = chnk_trps.TripChunker(label_coll, chunk_coll)
-trip_chunker.chunk_trips()
-
-# Finally, build new collections based on the chunk data from each trip
-all_trips = label_coll.distinct('trip_id_iso')
-
-# Total Trip Duration, Time of Day
-print ("Getting trip data based on total trip duration")
-duration_coll.delete_many({});
-trp_chnks_coll.temporal_features_total(all_trips, label_coll, duration_coll)
-
-for chunk_interval in chunks:
-
-    print ("Getting trip data based on ", chunk_interval, " chunks")
-
-    coll_str = "chunk_" + str(chunk_interval) + "_collection"
-    output_collection = db[coll_str]
-
-    output_collection.delete_many({});
-
-    trp_chnks_coll.chunk_data_interval(all_trips, label_coll, chunk_coll,
-                        output_collection, chunk_interval)
-
-    print ("Trips inserted into collection: ", coll_str)
-
-    # Update the params
-    params[coll_str] = coll_str
-
-with open('parameters.json', 'w') as outfile:
-    json.dump(params, outfile)
-
-
-
-# # Total Trip Duration, Time of Day
-#
-# two_chunk_coll.delete_many({});
-# trp_chnks_coll.two_chunk_data(all_trips, label_coll, chunk_coll, two_chunk_coll)
-#
-# # Total Trip Duration, Time of Day
-# print ("Getting trip data based on six chunks")
-# six_chunk_coll.delete_many({});
-# trp_chnks_coll.six_chunk_data(all_trips, label_coll, chunk_coll, six_chunk_coll)
+# Connect to the storage, Mongo or the in-memory collections saved by
+# pipeline.py. Mongo commands are recorded for the run report
+db = storage.open_storage(params,
+        event_listeners=[instrument.command_listener(
+            params.get('measure_command_bytes', False))])
+
+# Build the sample schedule and the chunks of each interval, label trip
+# documents with their chunks, and build the feature collections. Stages
+# whose inputs haven't changed since they last ran are skipped, so adding a
+# chunk interval only builds the new interval. The labeling stages are rerun
+# first if they are out of date
+runner = orchestrator.Orchestrator(stages.pipeline_stages(params), db, params)
+
+try:
+    runner.run(only=args.stage, resume=args.resume, force=args.force,
+                dry_run=args.dry_run)
+
+finally:
+    # Keep the in-memory collections and checkpoints for train.py, even if a
+    # stage failed, so the run can be resumed
+    db.save()
+
+# Where the time went, per stage, and what each stage sent to Mongo
+report_path = instrument.write_report('chunk_data',
+                    params.get('report_dir', instrument.REPORT_DIR),
+                    parameters=params)
+print ("Run report written to ", report_path)
+
+if instrument.RECORDER.profiler is not None:
+    instrument.RECORDER.profiler.write()
@@ -1,49 +1,51 @@
+import argparse
 import json
 
-import pymongo
-from pymongo import MongoClient
+import src.instrument as instrument
+import src.orchestrator as orchestrator
+import src.profiling as profiling
+import src.stages as stages
+import src.storage as storage
 
-import src.extract as extract
-import src.label_starts as label_starts
-import src.label_trips as label_trips
 
+parser = argparse.ArgumentParser(description='Extract AVL data and label it into trips')
+orchestrator.add_run_arguments(parser)
+profiling.add_profile_arguments(parser)
+args = parser.parse_args()
+
+# Profile the stages asked for. Without --profile, nothing is profiled
+instrument.RECORDER.profiler = profiling.profiler_from_args(args,
+                                    prefix='pipeline_')
 
 # Load in our parameters file
 with open('parameters.json') as f:
     params = json.load(f)
 
-# Get relevant parameters
-database = params['database']
-avl_collection = params['avl_collection']
-labeled_collection = params['labeled_collection']
-gtfs_period = params['gtfs_period']
-days = params['ftp_days']
-bus = params['bus']
-direction = params['direction']
-
-# Connect to the database
-client = MongoClient('localhost', 27017)
-
-# Select our database and collections
-db = client[database]
-raw_coll = db[avl_collection]
-label_coll = db[labeled_collection]
-
-# Start with empty collections
-raw_coll.delete_many({});
-label_coll.delete_many({});
-
-# Extract the data from the FTP Server
-extractor = extract.Extractor(raw_coll, gtfs_period=gtfs_period, days=days,
-                                bus=bus, direction=direction)
-extractor.run()
-
-# Label Trip Starts in the Data
-start_labeler = label_starts.StartLabeler(raw_coll, label_coll,
-                        gtfs_period=gtfs_period)
-start_labeler.label_single_starts()
-
-# Label the remaining data based on the starts
-trip_labeler = label_trips.TripLabeler(raw_coll, label_coll,
-                        gtfs_period=gtfs_period)
-trip_labeler.label_trips()
+# Connect to the storage, Mongo or in memory. Mongo commands are recorded
+# for the run report
+db = storage.open_storage(params,
+        event_listeners=[instrument.command_listener(
+            params.get('measure_command_bytes', False))])
+
+# Extract the data from the FTP Server, label trip starts in the data, and
+# label the remaining data based on the starts. Stages whose inputs haven't
+# changed since they last ran are skipped
+runner = orchestrator.Orchestrator(stages.pipeline_stages(params), db, params)
+
+try:
+    runner.run(targets=stages.LABEL_STAGES[-1:], only=args.stage,
+                resume=args.resume, force=args.force, dry_run=args.dry_run)
+
+finally:
+    # Keep the in-memory collections and checkpoints for chunk_data.py, even
+    # if a stage failed, so the run can be resumed
+    db.save()
+
+# Where the time went, per stage, and what each stage sent to Mongo
+report_path = instrument.write_report('pipeline',
+                    params.get('report_dir', instrument.REPORT_DIR),
+                    parameters=params)
+print ("Run report written to ", report_path)
+
+if instrument.RECORDER.profiler is not None:
+    instrument.RECORDER.profiler.write()
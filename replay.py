@@ -0,0 +1,48 @@
+import argparse
+import json
+
+import src.replay as replay
+import src.stages as stages
+import src.storage as storage
+import src.stream as stream
+
+parser = argparse.ArgumentParser(
+    description='Replay stored AVL data against a live consumer')
+parser.add_argument('--files', nargs='*',
+                    help='Original AVL day files. Defaults to the avl_raw collection')
+parser.add_argument('--speedup', default='1',
+                    help="Replay speed-up, such as 1 or 10, or 'max'")
+parser.add_argument('--consumer', choices=['none', 'stream'], default='stream',
+                    help='What to replay into')
+parser.add_argument('--schedule',
+                    help='Sample schedule of the route, for the stream consumer. '
+                        'Defaults to the one chunk_data.py last built')
+args = parser.parse_args()
+
+# Load in our parameters file
+with open('parameters.json') as f:
+    params = json.load(f)
+
+db = storage.open_storage(params)
+
+if args.files:
+    pings = replay.file_pings(args.files)
+else:
+    pings = replay.collection_pings(db[params['avl_collection']])
+
+if args.consumer == 'stream':
+    schedule_path = args.schedule or stages.last_schedule_path(db, params)
+
+    trip_stream = stream.route_stream(params, db, schedule_path,
+                        lambda event: None)
+    consumer = trip_stream.process
+else:
+    consumer = lambda ping: None
+
+speedup = None if args.speedup == 'max' else float(args.speedup)
+
+replayer = replay.Replayer(consumer, speedup=speedup)
+print (json.dumps(replayer.run(pings), indent=2))
+
+if args.consumer == 'stream':
+    print (json.dumps(trip_stream.counts, indent=2))
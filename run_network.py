@@ -0,0 +1,53 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+import src.instrument as instrument
+import src.network as network
+import src.orchestrator as orchestrator
+
+parser = argparse.ArgumentParser(
+    description='Run the pipeline for many routes, directions and GTFS periods')
+parser.add_argument('--routes', nargs='+',
+                    help='Routes to run. Defaults to every route in data/muni_routes.csv')
+parser.add_argument('--directions', nargs='+', type=int, default=[0, 1])
+parser.add_argument('--periods', nargs='+', type=int,
+                    help='GTFS periods to run. Defaults to gtfs_period of parameters.json')
+parser.add_argument('--concurrency', type=int,
+                    help='Number of jobs run at once. Defaults to the number of CPUs')
+orchestrator.add_run_arguments(parser)
+args = parser.parse_args()
+
+# Load in our parameters file, the base of every job's parameters
+with open('parameters.json') as f:
+    params = json.load(f)
+
+# Every route reads the same days of AVL data, so only download them once
+params.setdefault('avl_cache_dir', network.AVL_CACHE_DIR)
+
+periods = args.periods if args.periods is not None else [params['gtfs_period']]
+jobs = network.job_matrix(args.routes, args.directions, periods)
+
+print ("Running ", len(jobs), " jobs")
+
+# Each job only runs the stages whose inputs changed since its last run
+summaries = network.run_jobs(params, jobs, args.concurrency, only=args.stage,
+                resume=args.resume, force=args.force, dry_run=args.dry_run)
+
+failed = [summary for summary in summaries if summary['status'] != 'done']
+
+for summary in failed:
+    print ("Failed: ", summary['job'], " ", summary.get('error'), " ",
+            summary.get('log', ''))
+
+report_dir = params.get('report_dir', instrument.REPORT_DIR)
+os.makedirs(report_dir, exist_ok=True)
+
+report_path = os.path.join(report_dir, 'network_{}.json'.format(
+                    datetime.now().strftime('%Y%m%d_%H%M%S')))
+
+with open(report_path, 'w') as f:
+    json.dump({'jobs': summaries, 'failed': len(failed)}, f, indent=2)
+
+print ("Network report written to ", report_path)
@@ -0,0 +1,30 @@
+import argparse
+
+import src.predict as predict
+import src.prediction_cache as prdct_cache
+
+parser = argparse.ArgumentParser(description='Serve travel time predictions')
+parser.add_argument('artifact', help='Model artifact, as written by train.py')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8500)
+parser.add_argument('--bucket-minutes', type=int, default=5,
+                    help='Width of the cached departure time buckets')
+parser.add_argument('--cache-size', type=int, default=10000,
+                    help='Most cached predictions, 0 to turn the cache off')
+parser.add_argument('--cache-ttl', type=float, default=300,
+                    help='Seconds a cached prediction stays valid')
+parser.add_argument('--key-features', nargs='*',
+                    help="Features that are part of a cached prediction's key. "
+                        "Defaults to each model's features, other than the "
+                        "time of day")
+args = parser.parse_args()
+
+predictor = predict.Predictor(args.artifact)
+
+cache = None
+if args.cache_size:
+    cache = prdct_cache.PredictionCache(predictor,
+                bucket_minutes=args.bucket_minutes, capacity=args.cache_size,
+                ttl=args.cache_ttl, key_features=args.key_features)
+
+predict.serve(predictor, host=args.host, port=args.port, cache=cache)
@@ -0,0 +1,197 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import Ridge
+from sklearn.preprocessing import StandardScaler
+
+import src.gtfs as gtfs
+
+# Models that can be backtested, with fixed hyperparameters
+MODELS = {
+    'ridge': lambda: Ridge(alpha=10),
+    'forest': lambda: RandomForestRegressor(n_estimators=50, max_depth=4,
+                                            max_leaf_nodes=20)
+}
+
+# Time of day buckets, as hours since midnight
+TOD_BUCKETS = [0, 6, 10, 15, 19, 24]
+TOD_LABELS = ['night', 'am_peak', 'midday', 'pm_peak', 'evening']
+
+
+def service_days(start_timestamps):
+    """
+    Local service date of each trip start, as a day number
+    """
+
+    days, _ = gtfs.local_days(start_timestamps)
+
+    return days
+
+
+def tod_buckets(start_timestamps):
+    """
+    Time of day bucket index of each trip start
+    """
+
+    _, hours = gtfs.local_days(start_timestamps)
+
+    return np.digitize(hours, TOD_BUCKETS[1:-1])
+
+
+def make_windows(days, min_train_days=14, test_days=1, step_days=1,
+                    train_days=None):
+    """
+    Rolling-origin evaluation windows over the service days in the data.
+    Input:
+        days: Array of each trip's service day
+        min_train_days: Days of data before the first test window
+        test_days: Days in each test window
+        step_days: Days the origin moves forward between windows
+        train_days: If given, train on only this many days before the origin
+            (rolling); otherwise on everything before it (expanding)
+    Output: List of (train_from, origin, test_to) day numbers
+    """
+
+    unique_days = np.unique(days)
+
+    if len(unique_days) <= min_train_days:
+        return []
+
+    windows = []
+
+    for idx in range(min_train_days, len(unique_days), step_days):
+
+        origin = unique_days[idx]
+        test_to = unique_days[min(idx + test_days, len(unique_days)) - 1] + 1
+
+        if train_days:
+            train_from = unique_days[max(idx - train_days, 0)]
+        else:
+            train_from = unique_days[0]
+
+        windows.append((int(train_from), int(origin), int(test_to)))
+
+    return windows
+
+
+def write_matrix(path, name, frame, features, target):
+    """
+    Write a task's features, target, days and time of day buckets as .npy
+    files that worker processes can memory-map
+    """
+
+    task_dir = os.path.join(path, name)
+    os.makedirs(task_dir)
+
+    np.save(os.path.join(task_dir, 'X.npy'), frame[features].values.astype(float))
+    np.save(os.path.join(task_dir, 'y.npy'), frame[target].values.astype(float))
+    np.save(os.path.join(task_dir, 'days.npy'), service_days(frame['start_timestamp']))
+    np.save(os.path.join(task_dir, 'tod.npy'), tod_buckets(frame['start_timestamp']))
+
+    return task_dir
+
+
+def evaluate_window(task_dir, window, model_name):
+    """
+    Worker: fit on a window's training days and predict its test days, reading
+    the task's matrices memory-mapped.
+    Output: Test residuals and their time of day buckets
+    """
+
+    X = np.load(os.path.join(task_dir, 'X.npy'), mmap_mode='r')
+    y = np.load(os.path.join(task_dir, 'y.npy'), mmap_mode='r')
+    days = np.load(os.path.join(task_dir, 'days.npy'), mmap_mode='r')
+    tod = np.load(os.path.join(task_dir, 'tod.npy'), mmap_mode='r')
+
+    train_from, origin, test_to = window
+    train = (days >= train_from) & (days < origin)
+    test = (days >= origin) & (days < test_to)
+
+    if train.sum() < 2 or test.sum() == 0:
+        return np.array([]), np.array([], dtype=int)
+
+    scaler = StandardScaler().fit(X[train])
+    scaler_y = StandardScaler().fit(y[train].reshape(-1, 1))
+
+    model = MODELS[model_name]()
+    model.fit(scaler.transform(X[train]),
+                scaler_y.transform(y[train].reshape(-1, 1)).ravel())
+
+    y_pred = scaler_y.inverse_transform(
+        model.predict(scaler.transform(X[test])).reshape(-1, 1)).ravel()
+
+    return y_pred - y[test], np.asarray(tod[test])
+
+
+def rmse(residuals):
+    return float(np.sqrt(np.mean(np.square(residuals)))) if len(residuals) else None
+
+
+def backtest(tasks, model_name='ridge', workers=None, **window_args):
+    """
+    Backtest every task over rolling-origin windows, with the windows of all
+    tasks evaluated in parallel worker processes.
+    Input:
+        tasks: List of (name, DataFrame, features, target), as from train.py
+        model_name: Key of MODELS
+        workers: Number of worker processes
+        window_args: Passed on to make_windows
+    Output: Dictionary of RMSE per task and window, per task, and per task
+        and time of day bucket
+    """
+
+    tmp_dir = tempfile.mkdtemp(prefix='backtest_')
+
+    try:
+        jobs = []
+
+        for name, frame, features, target in tasks:
+
+            task_dir = write_matrix(tmp_dir, name, frame, features, target)
+            days = np.load(os.path.join(task_dir, 'days.npy'))
+
+            for window in make_windows(days, **window_args):
+                jobs.append((name, task_dir, window))
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(evaluate_window, task_dir, window, model_name)
+                        for name, task_dir, window in jobs]
+            results = [future.result() for future in futures]
+
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report = {'model': model_name, 'windows': {}, 'tasks': {}, 'time_of_day': {}}
+
+    residuals = {}
+    tods = {}
+
+    for (name, task_dir, window), (resid, tod) in zip(jobs, results):
+
+        origin = str(pd.Timestamp('1970-01-01') + pd.Timedelta(days=window[1]))[:10]
+
+        report['windows'].setdefault(name, []).append({
+            'origin': origin,
+            'train_days': window[1] - window[0],
+            'test_trips': len(resid),
+            'rmse': rmse(resid)
+        })
+
+        residuals.setdefault(name, []).append(resid)
+        tods.setdefault(name, []).append(tod)
+
+    for name in residuals:
+
+        resid = np.concatenate(residuals[name])
+        tod = np.concatenate(tods[name])
+
+        report['tasks'][name] = rmse(resid)
+        report['time_of_day'][name] = {label: rmse(resid[tod == idx])
+                                        for idx, label in enumerate(TOD_LABELS)}
+
+    return report
@@ -1,6 +1,5 @@
 from datetime import datetime
 import pandas as pd
-from geopy import distance
 import numpy as np
 
 import random
@@ -8,6 +7,10 @@ import random
 import pymongo
 from pymongo import MongoClient
 
+from src.trip_chunk_collections import trip_duration_pipeline
+from src.geo import add_xy_columns, ping_xy, planar_distance
+import src.instrument as instrument
+
 
 class ChunkBuilder(object):
     """
@@ -16,13 +19,29 @@ class ChunkBuilder(object):
     about that interval and its chunks, and add it to the database.
     """
 
-    def __init__(self, trip_collection, chunk_collection, chunk_list):
+    def __init__(self, trip_collection, chunk_collection, chunk_list,
+                    schedule_path='data/scheduled_stop_info.csv'):
+        """
+        Input:
+            trip_collection:
+                Collection of labeled trips
+            chunk_collection:
+                Collection the chunk details are inserted into
+            chunk_list:
+                List of the number of chunks to divide trips into
+            schedule_path:
+                Sample schedule of the route, from create_sample_schedule
+        """
 
         self.trip_coll = trip_collection
         self.chunk_coll = chunk_collection
         self.chunk_list = chunk_list
 
-        self.sched = pd.read_csv('data/scheduled_stop_info.csv')
+        self.sched = pd.read_csv(schedule_path)
+
+        # Schedules built before stops had projected x/y
+        if 'stop_x' not in self.sched.columns:
+            add_xy_columns(self.sched, 'stop')
 
         # Lets sample 20% of the trips for determining chunk stops
         all_trip_ids = self.trip_coll.distinct('trip_id_iso')
@@ -31,7 +50,8 @@ class ChunkBuilder(object):
         self.trip_sample = random.sample(all_trip_ids, sample_size)
 
         # Get the average trip duration from our sample
-        self.get_average_duration()
+        with instrument.span('get_average_duration'):
+            self.get_average_duration()
 
 
     def get_chunk_info(self):
@@ -67,12 +87,14 @@ class ChunkBuilder(object):
                     time_forward = chunk_block*chunk_seq
 
                     # Get the location of each sample trip after this time
-                    loc_at_chunk = self.locations_at_timestamp(time_forward)
+                    with instrument.span('locations_at_timestamp'):
+                        loc_at_chunk = self.locations_at_timestamp(time_forward)
 
                     # For each stop in our schedule, get the average distance
                     # of each trip, at the chunk interval, to the stop
-                    self.sched['avg_chnk_dist'] = self.sched.apply(\
-                        lambda row: self.get_avg_dist(row, loc_at_chunk), axis=1)
+                    with instrument.span('get_avg_dist'):
+                        self.sched['avg_chnk_dist'] = self.get_avg_dist(
+                            self.sched, loc_at_chunk)
 
                     cnk_stp = self.sched.iloc[self.sched['avg_chnk_dist'].idxmin()]
 
@@ -81,6 +103,8 @@ class ChunkBuilder(object):
                 chunk_dict['chunk_stop_seq'] = int(cnk_stp['stop_sequence'])
                 chunk_dict['chunk_stop_lat'] = float(cnk_stp['stop_lat'])
                 chunk_dict['chunk_stop_lon'] = float(cnk_stp['stop_lon'])
+                chunk_dict['chunk_stop_x'] = float(cnk_stp['stop_x'])
+                chunk_dict['chunk_stop_y'] = float(cnk_stp['stop_y'])
                 chunk_dict['chunk_stop_name'] = cnk_stp['stop_name']
 
                 # Get the distance of the individual chunk by comparing its
@@ -105,31 +129,22 @@ class ChunkBuilder(object):
         Gets the mean of all trip durations in our sample
         """
 
-        durations = []
-
-        for trip_id in self.trip_sample:
+        # Summarise the sampled trips on the server, then average them
+        pipeline = trip_duration_pipeline(self.trip_sample)
+        pipeline.append({'$group': {
+            '_id': None,
+            'avg_duration': {'$avg': '$duration'}
+        }})
 
-            start = self.trip_coll.find_one({
-                'trip_start': 1,
-                'trip_id_iso' : trip_id
-            })
+        summary = list(self.trip_coll.aggregate(pipeline))
 
-            end = self.trip_coll.find_one({
-                'trip_end': 1,
-                'trip_id_iso' : trip_id
-            })
-
-            durations.append(end['time_stamp'] - start['time_stamp'])
-
-        numps = np.array(durations)
-
-        self.avg_duration =  round(numps.mean())
+        self.avg_duration = round(summary[0]['avg_duration'])
 
 
     def locations_at_timestamp(self, chunk_time):
         """
         For each trip in our sample trips, find the document just after the
-        given chunk interval, and get its location.
+        given chunk interval, and get its projected x/y.
         """
 
         locations = []
@@ -157,26 +172,26 @@ class ChunkBuilder(object):
 
             # If it exists, get the document's location
             if chnk_end:
-                locations.append(\
-                    (chnk_end[0]['LATITUDE'], chnk_end[0]['LONGITUDE']))
+                locations.append(ping_xy(chnk_end[0]))
 
         return locations
 
 
-    def get_avg_dist(self, row, location_list):
+    def get_avg_dist(self, stops, location_list):
         """
-        Get the average distance from a list of coordinates to a bus stop
+        Get the average distance from a list of locations to each bus stop
         Input:
-            - row: a row from our stop schedule, containing the coordinates of a stop
-            - location_list: a list of different trip locations at the same time point
+            - stops: our stop schedule, with the projected x/y of each stop
+            - location_list: a list of different trip x/y's at the same time point
+        Output: Array of the average distance to each stop
         """
 
-        dists = []
-
-        stop_tup = (float(row['stop_lat']), float(row['stop_lon']))
-
-        for loc in location_list:
+        locations = np.array(location_list, dtype=float).reshape(-1, 2)
 
-            dists.append(distance.distance(stop_tup, loc).m)
+        # Distance from every stop to every location, as a (stops, locations)
+        # matrix
+        dists = planar_distance(stops['stop_x'].values[:, None],
+                    stops['stop_y'].values[:, None],
+                    locations[None, :, 0], locations[None, :, 1])
 
-        return np.array(dists).mean()
+        return dists.mean(axis=1)
@@ -1,12 +1,12 @@
 from datetime import datetime
 import pandas as pd
-from geopy.distance import distance
 import numpy as np
 
-import random
-
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateMany
+
+from src.geo import docs_xy, planar_distance, to_utm
+import src.instrument as instrument
 
 
 class TripChunker(object):
@@ -15,80 +15,197 @@ class TripChunker(object):
     calucalted chunks in the chunks collection. Chunk Chunk Chunkity Chunk.
     """
 
-    def __init__(self, trip_collection, chunk_collection):
+    def __init__(self, trip_collection, chunk_collection, batch_size=50,
+                    trip_ids=None, chunk_list=None):
+        """
+        Input:
+            trip_collection:
+                Collection of labeled trip documents
+            chunk_collection:
+                Collection with the chunk stops of each chunk interval
+            batch_size:
+                Number of trips whose updates are sent in one bulk write
+            trip_ids:
+                Trips to chunk. Defaults to every trip in the collection
+            chunk_list:
+                Chunk intervals to label. Defaults to every interval in the
+                chunk collection
+        """
 
         self.trip_coll = trip_collection
         self.chunk_coll = chunk_collection
+        self.batch_size = batch_size
+
+        if trip_ids is None:
+            trip_ids = self.trip_coll.distinct('trip_id_iso')
+
+        self.all_trip_ids = trip_ids
 
-        self.all_trip_ids = self.trip_coll.distinct('trip_id_iso')
+        # Every trip is chunked against the same interval sets, so only load
+        # them once
+        search = {}
+        if chunk_list is not None:
+            search['number_chunks'] = {'$in': list(chunk_list)}
 
-    def chunk_trips(self):
+        self.chunk_sets = list(self.chunk_coll.find(search))
+
+    def chunk_trips(self, verbose=True):
+
+        updates = []
 
         # For each trip...
         for idx, trip in enumerate(self.all_trip_ids):
 
-            print ("Chunking Trip ", trip)
-            print ("Number ", idx+1, " of ", len(self.all_trip_ids))
+            with instrument.span('chunk_trip'):
+                updates.extend(self.chunk_trip(trip))
+
+            # Send the updates of a batch of trips in one go
+            if (idx + 1) % self.batch_size == 0:
+                with instrument.span('write_updates'):
+                    self.write_updates(updates)
+                updates = []
+
+                if verbose:
+                    print ("Chunked ", idx+1, " of ", len(self.all_trip_ids), " trips")
+
+        with instrument.span('write_updates'):
+            self.write_updates(updates)
+
+        instrument.count('chunked_trips', len(self.all_trip_ids))
+
+    def chunk_trip(self, trip):
+        """
+        Labels a trip's documents with every chunk interval in one pass.
+        Input: The trip_id_iso of the trip
+        Output: List of bulk update operations for the trip's documents
+        """
+
+        # Load the trip's pings once, sorted by time
+        search = {"trip_id_iso": trip}
+        fields = {'time_stamp': 1, 'x': 1, 'y': 1, 'LATITUDE': 1, 'LONGITUDE': 1}
+        docs = list(self.trip_coll.find(search, fields).sort('time_stamp'))
+
+        if not docs:
+            return []
+
+        doc_ids = [doc['_id'] for doc in docs]
+        time_stamps = np.array([doc['time_stamp'] for doc in docs], dtype=float)
+        xs, ys = docs_xy(docs)
+
+        # Get the chunk label of each document, for each chunk interval set
+        labels = {}
+        for chunk in self.chunk_sets:
+            chnk_num = "chunk_" + str(chunk['number_chunks'])
+            labels[chnk_num] = self.assign_chunks(time_stamps, xs, ys,
+                                    chunk['chunks'])
 
-            # For each chunk interval set...
-            for chunk in self.chunk_coll.find():
+        return self.build_updates(doc_ids, labels)
 
-                chnk_num = "chunk_" + str(chunk['number_chunks'])
+    def assign_chunks(self, time_stamps, xs, ys, chunks):
+        """
+        Find the ping closest to each chunk stop, and label every ping between
+        the previous chunk stop and this one with the chunk's sequence.
+        Input:
+            time_stamps, xs, ys: Arrays of the trip's pings, sorted by time,
+                with their projected x/y
+            chunks: The 'chunks' dictionary of a chunk interval set
+        Output: Array with the chunk sequence of each ping (None if unlabeled)
+        """
 
-                start_ts = 0
+        seqs = list(chunks.keys())
+        cnk_xs, cnk_ys = self.chunk_stop_xy(chunks, seqs)
 
-                # For each chunk in that interval...
-                for seq, chunk_info in chunk['chunks'].items():
+        # Distance from every ping to every chunk stop, as a (pings, chunks)
+        # matrix
+        dists = planar_distance(xs[:, None], ys[:, None],
+                            cnk_xs[None, :], cnk_ys[None, :])
 
-                    # For accuring the closest document
-                    best_dist = {
-                        'stop_dist':100000,
-                        'time_stamp': 0}
+        labels = np.full(len(time_stamps), None, dtype=object)
 
-                    filter_search = {
-                        "trip_id_iso": trip,
-                        "time_stamp": {"$gte": start_ts}
-                    }
+        start_ts = 0
 
-                    # For each document in the trip...
-                    # Yes, a quadruple inset for-loop!
-                    # Test each trip document to see which is closest to the
-                    # chunk stop
-                    for doc in self.trip_coll.find(filter_search).sort('time_stamp'):
+        for col, seq in enumerate(seqs):
 
-                        doc_lat = doc['LATITUDE']
-                        doc_lon = doc['LONGITUDE']
+            # Only pings after the last chunk stop can be closest to this one
+            after = time_stamps >= start_ts
 
-                        cnk_lat = chunk_info['chunk_stop_lat']
-                        cnk_lon = chunk_info['chunk_stop_lon']
+            best_ts = 0
+            if after.any():
+                candidates = np.where(after, dists[:, col], np.inf)
+                best_idx = candidates.argmin()
 
-                        doc_dist = distance((doc_lat, doc_lon), (cnk_lat, cnk_lon)).m
+                # Ignore chunk stops that the trip never got near
+                if candidates[best_idx] < 100000:
+                    best_ts = time_stamps[best_idx]
 
-                        # Update the accural dictionary if a better distance is
-                        # found
-                        if doc_dist < best_dist['stop_dist']:
-                            best_dist['stop_dist'] = doc_dist
-                            best_dist['time_stamp'] = doc['time_stamp']
+            in_chunk = after & (time_stamps < best_ts)
+            labels[in_chunk] = seq
 
-                    # Given our closest time, search all documents in this trip
-                    # that occur after our last chunk and before the closest time
-                    label_search = {
-                        "trip_id_iso": trip,
-                        "time_stamp": {
-                            "$gte": start_ts,
-                            "$lt": best_dist['time_stamp']
-                        }
-                    }
+            start_ts = best_ts
 
-                    for doc in self.trip_coll.find(label_search).sort('time_stamp'):
+        return labels
 
-                        doc_id = doc['_id']
+    def chunk_stop_xy(self, chunks, seqs):
+        """
+        Arrays of the projected x/y of the chunk stops. Chunks built before
+        stops had x/y are projected from their latitude and longitude
+        """
 
-                        self.trip_coll.update_one({"_id": doc_id}, {
-                            "$set": {
-                                chnk_num: seq
-                            }
-                        })
+        if all('chunk_stop_x' in chunks[seq] for seq in seqs):
+            return (np.array([chunks[seq]['chunk_stop_x'] for seq in seqs]),
+                    np.array([chunks[seq]['chunk_stop_y'] for seq in seqs]))
 
+        return to_utm([chunks[seq]['chunk_stop_lat'] for seq in seqs],
+                      [chunks[seq]['chunk_stop_lon'] for seq in seqs])
+
+    def build_updates(self, doc_ids, labels):
+        """
+        Group documents that share the same chunk labels, so that each group
+        can be labeled with a single update.
+        Input:
+            doc_ids: List of document ids
+            labels: Dictionary of chunk field to an array of labels
+        Output: List of UpdateMany operations
+        """
+
+        fields = list(labels.keys())
+        groups = {}
+
+        for idx, doc_id in enumerate(doc_ids):
+            key = tuple(labels[field][idx] for field in fields)
+            groups.setdefault(key, []).append(doc_id)
+
+        updates = []
+
+        for key, ids in groups.items():
+
+            new_labels = {field: seq for field, seq in zip(fields, key)
+                            if seq is not None}
+
+            if new_labels:
+                updates.append(UpdateMany({"_id": {"$in": ids}},
+                                    {"$set": new_labels}))
+
+        return updates
+
+    def write_updates(self, updates):
+        """
+        Send a list of update operations to the trip collection in one bulk
+        write.
+        """
+
+        if updates:
+            self.trip_coll.bulk_write(updates, ordered=False)
+
+
+def chunk_trip_shard(db, trip_ids, trip_collection, chunk_collection,
+                        chunk_list=None, batch_size=50):
+    """
+    Worker for chunking a shard of trips in its own process, see
+    src/parallel.py
+    """
 
-                    start_ts = best_dist['time_stamp']
+    trip_chunker = TripChunker(db[trip_collection], db[chunk_collection],
+                        batch_size=batch_size, trip_ids=trip_ids,
+                        chunk_list=chunk_list)
+    trip_chunker.chunk_trips(verbose=False)
@@ -1,9 +1,47 @@
+import os
 import pandas as pd
 from ftplib import FTP
 from datetime import datetime
 import pymongo
 from pymongo import MongoClient
 
+import src.gtfs as gtfs
+import src.instrument as instrument
+from src.geo import add_xy
+
+# Columns of the raw AVL files, as given in their first line
+AVL_HEADER = ['REV', 'REPORT_TIME', 'VEHICLE_TAG', 'LONGITUDE', 'LATITUDE',
+                'SPEED', 'HEADING', 'TRAIN_ASSIGNMENT', 'PREDICTABLE']
+
+# Kept lines are projected and inserted this many at a time
+INSERT_BATCH_SIZE = 5000
+
+
+def parse_avl_line(line_list, header=AVL_HEADER):
+    """
+    Given a split line of AVL data, zip it to headers and turn it into a
+    dictionary, with a time_stamp for easier sorting.
+    Input: A comma-split line of AVL data
+    Output: Dictionary of the line
+    """
+
+    line_dict = {}
+
+    # Format of injesting time strings
+    time_format = '%m/%d/%Y %H:%M:%S'
+
+    # Convert the reported time to a datetime object
+    cln_date = datetime.strptime(line_list[1], time_format)
+
+    # Add a timestamp to our data for easier sorting
+    line_dict['time_stamp'] = cln_date.timestamp()
+
+    for key, val in zip(header, line_list):
+        line_dict[key] = val
+
+    return line_dict
+
+
 class Extractor(object):
 
     """
@@ -13,8 +51,8 @@ class Extractor(object):
         -Loading the data into MongoDB
     """
 
-    def __init__(self, collection, bus='33', direction=0,
-                    gtfs_period=0, days=30):
+    def __init__(self, collection, bus, direction, gtfs_period=0, days=30,
+                    cache_dir=None):
 
         """
         Input:
@@ -33,9 +71,14 @@ class Extractor(object):
             -days:
                 The number of days for which we want data, starting with the most
                 recent of the gtfs period first. If None, will get all days
+            -cache_dir:
+                Optional directory where files from the FTP server are kept,
+                so that runs for other routes over the same days only download
+                each file once
         """
 
         self.days = days
+        self.cache_dir = cache_dir
         self.collection = collection
         self.bus = bus
         self.direction = direction
@@ -47,6 +90,9 @@ class Extractor(object):
         self.total_count = 0
         self.filter_count = 0
 
+        # Kept lines waiting to be inserted
+        self.pending = []
+
     ############
     # MAIN METHODS
     ############
@@ -73,7 +119,8 @@ class Extractor(object):
         """
 
         # Get all file names from the server
-        server_files = self.get_server_files()
+        with instrument.span('list_files'):
+            server_files = self.get_server_files()
 
         # Get the files that fall within our date range
         target_files = self.clean_file_list(server_files)[::-1]
@@ -89,11 +136,21 @@ class Extractor(object):
             file_date = data_file[15:-4]
             print ("Getting data from ", file_date)
 
-            self.connect_read_ftp(data_file)
+            with instrument.span('read_file'):
+                if self.cache_dir:
+                    self.read_cached_file(data_file)
+                else:
+                    self.connect_read_ftp(data_file)
+
+            self.flush()
 
         print ("Total lines read: ", self.total_count)
         print ("Filtered lines kept: ", self.filter_count)
 
+        instrument.count('files', len(target_files))
+        instrument.count('lines_read', self.total_count)
+        instrument.count('lines_kept', self.filter_count)
+
 
     def run(self):
         """
@@ -114,8 +171,7 @@ class Extractor(object):
             gtfs_period: Index of the gtfs_lookup file to use
         """
 
-        gtfs_df = pd.read_csv('data/gtfs_lookup.csv')
-        gtfs_series = gtfs_df.iloc[gtfs_period]
+        gtfs_series = gtfs.period_info(gtfs_period)
 
         from_txt = gtfs_series['from_date']
         self.from_date = datetime.strptime(from_txt, '%Y-%m-%d')
@@ -134,14 +190,13 @@ class Extractor(object):
         Gets the route ID of the bus route given
         """
 
-        route_txt = 'data/gtfs/{}/routes.txt'.format(self.gtfs_dir)
-        routes = pd.read_csv(route_txt)
+        routes = gtfs.read_table(self.gtfs_dir, 'routes')
 
         # Cleaning route names to make look-up easier
-        routes['cln_rts'] = routes['route_short_name'].apply(lambda x: x.strip())
+        cln_rts = routes['route_short_name'].astype(str).str.strip()
 
         # Get the routes id for our busline
-        self.route_id = routes[routes['cln_rts'] == bus]['route_id'].values[0]
+        self.route_id = routes[cln_rts == bus]['route_id'].values[0]
 
     def get_trip_ids(self, direction):
         """
@@ -149,8 +204,7 @@ class Extractor(object):
         """
 
         # Load in the trips
-        trip_txt = 'data/gtfs/{}/trips.txt'.format(self.gtfs_dir)
-        trips = pd.read_csv(trip_txt)
+        trips = gtfs.read_table(self.gtfs_dir, 'trips')
 
         # Get all the trips on the route, going in the same direction
         trip_mask = (trips['route_id'] == self.route_id) \
@@ -168,7 +222,7 @@ class Extractor(object):
         # Load in the block reference data for connecting blocks in the
         # AVL data to our specific time periods
         blckrf_txt = 'data/lookUpBlockIDToBlockNumNam.csv'
-        blockref = pd.read_csv(blckrf_txt)
+        blockref = gtfs.read_csv(blckrf_txt)
 
         # Get all blocks in our time frame
         date_blocks = blockref[blockref['SIGNID'] == self.sign_id]
@@ -178,7 +232,8 @@ class Extractor(object):
         dt_trp_blcks = date_blocks[dt_trp_mask]
 
         # Finally, get all the block names that correspond to the block numbers
-        self.block_names = dt_trp_blcks['BLOCKNAME'].unique()
+        # A set, as every line of every file is looked up in it
+        self.block_names = set(dt_trp_blcks['BLOCKNAME'])
 
     ############
     # Get Data Tools
@@ -235,6 +290,38 @@ class Extractor(object):
         ftp.cwd('AVL_DATA/AVL_RAW/')
         ftp.retrlines('RETR ' + file, self.read_ftp)
 
+    def read_cached_file(self, file):
+        """
+        Read a file from the cache directory, downloading it from the FTP
+        server first if it isn't there yet
+        Input:
+            File: The name of the file on the server
+        """
+
+        path = os.path.join(self.cache_dir, file)
+
+        if not os.path.exists(path):
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+            # Downloaded to a temporary file first, as other processes may be
+            # reading the same file
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+            with instrument.span('download_file'):
+                ftp = FTP('avl-data.sfmta.com')
+                ftp.login()
+                ftp.cwd('AVL_DATA/AVL_RAW/')
+                with open(tmp_path, 'wb') as f:
+                    ftp.retrbinary('RETR ' + file, f.write)
+
+            os.replace(tmp_path, path)
+
+        # Lines are passed on as retrlines would, without their line endings
+        with open(path) as f:
+            for line in f:
+                self.read_ftp(line.rstrip('\r\n'))
+
     def read_ftp(self, line):
         """
         Read a line from the FTP server, detecting and cleaning the first line
@@ -274,22 +361,26 @@ class Extractor(object):
     def dict_db_insert(self, line_list):
         """
         Given a split line of data, zip it to headers, turn it into a dictionary
-        and insert it in the database.
+        and queue it for inserting in the database.
         Input: A comma-split line of AVL data
         """
 
-        line_dict = {}
+        self.pending.append(parse_avl_line(line_list, self.header))
 
-        # Format of injesting time strings
-        time_format = '%m/%d/%Y %H:%M:%S'
+        if len(self.pending) >= INSERT_BATCH_SIZE:
+            self.flush()
 
-        # Convert the reported time to a datetime object
-        cln_date = datetime.strptime(line_list[1], time_format)
+    def flush(self):
+        """
+        Add the projected x/y of the queued lines, all at once, and insert them
+        in one go. Called at the end of each file
+        """
 
-        # Add a timestamp to our data for easier sorting
-        line_dict['time_stamp'] = cln_date.timestamp()
+        if not self.pending:
+            return
 
-        for key, val in zip(self.header, line_list):
-            line_dict[key] = val
+        with instrument.span('insert_lines'):
+            add_xy(self.pending)
+            self.collection.insert_many(self.pending)
 
-        self.collection.insert_one(line_dict)
+        self.pending = []
@@ -0,0 +1,173 @@
+import json
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Where feature tables are written, one directory per table and version
+FEATURE_DIR = 'data/features'
+
+
+class FeatureTable(object):
+    """
+    A versioned feature table, loaded as one memory-mapped numpy array per
+    column. Nothing is read from disk until a column is actually used.
+    """
+
+    def __init__(self, path, mmap=True):
+        """
+        Input:
+            path: Directory of the table version, containing manifest.json
+            mmap: Memory-map the columns rather than reading them in
+        """
+
+        self.path = path
+
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+
+        mmap_mode = 'r' if mmap else None
+
+        self.columns = {}
+        for column in self.manifest['columns']:
+            col_path = os.path.join(path, column['file'])
+            self.columns[column['name']] = np.load(col_path, mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def to_frame(self, columns=None):
+        """
+        Build a DataFrame from some or all of the columns
+        """
+
+        if columns is None:
+            columns = list(self.columns.keys())
+
+        return pd.DataFrame({name: self.columns[name] for name in columns})
+
+
+def table_versions(name, root=FEATURE_DIR):
+    """
+    Get the sorted version numbers written for a table
+    """
+
+    table_dir = os.path.join(root, name)
+
+    if not os.path.isdir(table_dir):
+        return []
+
+    return sorted(int(ver[1:]) for ver in os.listdir(table_dir)
+                    if ver.startswith('v') and ver[1:].isdigit())
+
+
+def column_values(series):
+    """
+    A column as a typed array that can be memory-mapped. Numbers with nulls,
+    and columns that are entirely null, become floats with NaN for the nulls.
+    Strings become fixed width unicode, with nulls as empty strings.
+    """
+
+    values = np.asarray(series)
+
+    if values.dtype.kind != 'O':
+        return values
+
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+
+    if kind in ('empty', 'integer', 'floating', 'mixed-integer-float',
+                'decimal', 'boolean'):
+        return pd.to_numeric(series, errors='coerce').to_numpy(dtype=float,
+                    na_value=np.nan)
+
+    return series.astype(object).where(series.notna(), '').to_numpy().astype(str)
+
+
+def write_feature_table(name, frame, root=FEATURE_DIR, source=None):
+    """
+    Write a DataFrame as a new version of a feature table: one typed .npy file
+    per column, plus a manifest describing them.
+    Input:
+        name: Name of the table, usually its collection name
+        frame: DataFrame of features
+        root: Directory of all feature tables
+        source: Optional description of where the data came from
+    Output: Path of the new table version
+    """
+
+    versions = table_versions(name, root)
+    version = versions[-1] + 1 if versions else 1
+
+    table_dir = os.path.join(root, name)
+    out_path = os.path.join(table_dir, 'v{:04d}'.format(version))
+
+    # Write to a temporary directory first, so readers never see half a table
+    tmp_path = out_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    columns = []
+
+    for idx, col in enumerate(frame.columns):
+
+        values = column_values(frame[col])
+
+        file_name = '{:03d}.npy'.format(idx)
+        np.save(os.path.join(tmp_path, file_name), values)
+
+        columns.append({'name': col, 'dtype': values.dtype.str,
+                        'file': file_name})
+
+    manifest = {
+        'table': name,
+        'version': version,
+        'rows': len(frame),
+        'columns': columns,
+        'source': source,
+        'created': datetime.now().isoformat()
+    }
+
+    with open(os.path.join(tmp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    os.rename(tmp_path, out_path)
+
+    return out_path
+
+
+def write_collection(name, collection, root=FEATURE_DIR):
+    """
+    Write a feature collection from the database into the feature store
+    Output: Path of the new table version
+    """
+
+    frame = pd.DataFrame(list(collection.find({}, {'_id': 0})))
+
+    source = '{}.{}'.format(collection.database.name, collection.name)
+
+    return write_feature_table(name, frame, root=root, source=source)
+
+
+def load_feature_table(name, version=None, root=FEATURE_DIR, mmap=True):
+    """
+    Load a version of a feature table, by default the latest
+    Output: FeatureTable
+    """
+
+    if version is None:
+        versions = table_versions(name, root)
+
+        if not versions:
+            raise IOError("No feature table named {} in {}".format(name, root))
+
+        version = versions[-1]
+
+    path = os.path.join(root, name, 'v{:04d}'.format(version))
+
+    return FeatureTable(path, mmap=mmap)
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+
+
+def fingerprint_files(paths):
+    """
+    Hash the contents of a list of files, so we can tell when any of them
+    has changed.
+    Input: List of file paths
+    Output: Hex digest string
+    """
+
+    sha = hashlib.sha1()
+
+    for path in paths:
+
+        sha.update(path.encode())
+
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+
+    return sha.hexdigest()
+
+
+def file_stamps(paths):
+    """
+    The modification time and size of a list of files: a cheap check of
+    whether any of them may have changed, before hashing them
+    Output: List of [path, mtime, size]
+    """
+
+    stamps = []
+
+    for path in paths:
+        stat = os.stat(path)
+        stamps.append([path, stat.st_mtime, stat.st_size])
+
+    return stamps
+
+
+def fingerprint_values(values):
+    """
+    Hash any JSON-serializable value (parameters, lists of ids, other
+    fingerprints).
+    Output: Hex digest string
+    """
+
+    dumped = json.dumps(values, sort_keys=True, default=str)
+
+    return hashlib.sha1(dumped.encode()).hexdigest()
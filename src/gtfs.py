@@ -0,0 +1,315 @@
+import os
+import pickle
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from src.geo import add_xy_columns
+
+# Lookup of the GTFS periods, most recent first
+GTFS_LOOKUP = 'data/gtfs_lookup.csv'
+
+# Parsed GTFS tables, shared by every process and job reading the same period
+GTFS_CACHE_DIR = 'data/gtfs_cache'
+
+# Bumped when the cached tables change, such as gaining columns
+CACHE_VERSION = 2
+
+# Tables with latitude/longitude columns, by their prefix, which also get
+# projected x/y columns
+PROJECTED_PREFIXES = ['stop', 'shape_pt']
+
+# Tables read by the pipeline, which warm_cache parses ahead of time
+TABLES = ['routes', 'trips', 'stop_times', 'stops', 'shapes', 'calendar',
+            'calendar_dates']
+
+# Trips are scheduled up to 30:34 (6:34 the next morning), so starts up to
+# this hour may belong to the previous day's service
+OVERNIGHT_HOUR = 7
+
+# Columns of calendar.txt, in the order of datetime's weekday()
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+            'sunday']
+
+# calendar_dates.txt exception types
+SERVICE_ADDED = 1
+SERVICE_REMOVED = 2
+
+# Tables already loaded by this process, by path and modification time
+_tables = {}
+_calendars = {}
+_lock = threading.Lock()
+
+
+def period_info(gtfs_period):
+    """
+    The row of the GTFS lookup for a period: from_date, to_date, directory
+    and sign_id
+    Input: Index of the period in data/gtfs_lookup.csv
+    """
+
+    return read_csv(GTFS_LOOKUP).iloc[gtfs_period]
+
+
+def gtfs_directory(gtfs_period):
+
+    return period_info(gtfs_period)['directory']
+
+
+def table_path(gtfs_dir, name):
+
+    return 'data/gtfs/{}/{}.txt'.format(gtfs_dir, name)
+
+
+def read_table(gtfs_dir, name):
+    """
+    Read a table of a GTFS period, such as 'stop_times'. See read_csv.
+    """
+
+    return read_csv(table_path(gtfs_dir, name))
+
+
+def read_csv(path):
+    """
+    Read a csv that doesn't change during a run, such as a GTFS table, parsing
+    it once per process. The parsed table is also pickled to the GTFS cache,
+    so other processes and later runs skip the parsing. Cached tables are
+    shared, so callers must not modify them in place.
+    Stops and shape points also get projected x/y columns, such as stop_x and
+    stop_y, see src/geo.py
+    """
+
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+
+    with _lock:
+        table = _tables.get(key)
+
+    if table is not None:
+        return table
+
+    cache_path = os.path.join(GTFS_CACHE_DIR,
+                    '{}_{}_{}_v{}.pkl'.format(path.replace('/', '_'),
+                        int(stat.st_mtime), stat.st_size, CACHE_VERSION))
+
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            table = pickle.load(f)
+
+    else:
+        table = pd.read_csv(path)
+
+        for prefix in PROJECTED_PREFIXES:
+            if prefix + '_lat' in table.columns:
+                add_xy_columns(table, prefix)
+
+        # Written to a temporary file first, as other processes may be
+        # reading the same table
+        os.makedirs(GTFS_CACHE_DIR, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    with _lock:
+        _tables[key] = table
+
+    return table
+
+
+def warm_cache(gtfs_periods, tables=TABLES):
+    """
+    Parse the tables of some GTFS periods into the cache, before starting
+    worker processes that read them
+    """
+
+    for gtfs_period in gtfs_periods:
+
+        gtfs_dir = gtfs_directory(gtfs_period)
+
+        for name in tables:
+            if os.path.exists(table_path(gtfs_dir, name)):
+                read_table(gtfs_dir, name)
+
+
+def epoch_day(date):
+    """
+    Days since 1970-01-01 of a date, such as 20160215 from calendar.txt or
+    '2016-02-15' from the GTFS lookup
+    """
+
+    return (pd.Timestamp(str(date)) - pd.Timestamp(0)).days
+
+
+def local_seconds(time_stamps):
+    """
+    The local wall clock time of each time_stamp, as seconds since
+    1970-01-01, the same as datetime.fromtimestamp, which the time_stamps
+    were made with
+    Input: Array of time_stamps
+    Output: Array of local seconds
+    """
+
+    stamps = np.asarray(time_stamps, dtype=float)
+
+    # The UTC offset only changes on the hour, so it is looked up once per
+    # distinct hour
+    hours, inverse = np.unique(np.floor(stamps / 3600) * 3600,
+                                return_inverse=True)
+    offsets = np.array([(datetime.fromtimestamp(hour) - datetime.fromtimestamp(
+                            hour, timezone.utc).replace(tzinfo=None)).total_seconds()
+                        for hour in hours])
+
+    return stamps + offsets[inverse.reshape(-1)]
+
+
+def local_days(time_stamps):
+    """
+    The local date and hour of each time_stamp
+    Input: Array of time_stamps
+    Output: Arrays of days since 1970-01-01, and hours
+    """
+
+    local = local_seconds(time_stamps)
+
+    days = np.floor(local / 86400).astype(np.int64)
+    hours = ((local - days * 86400) // 3600).astype(np.int64)
+
+    return days, hours
+
+
+class ServiceCalendar(object):
+    """
+    The services running on each day of a GTFS period, from calendar.txt with
+    the holidays and other exceptions of calendar_dates.txt, expanded once into
+    a table of days by services
+    """
+
+    def __init__(self, gtfs_period):
+        """
+        Input: Index of the period in data/gtfs_lookup.csv
+        """
+
+        gtfs_dir = gtfs_directory(gtfs_period)
+        info = period_info(gtfs_period)
+
+        calendar = read_table(gtfs_dir, 'calendar')
+
+        self.service_ids = calendar['service_id'].values
+
+        # Which services run on each weekday, as (weekdays, services)
+        self.weekdays = calendar[WEEKDAYS].values.T == 1
+
+        starts = np.array([epoch_day(date) for date in calendar['start_date']])
+        ends = np.array([epoch_day(date) for date in calendar['end_date']])
+
+        exceptions = None
+        if os.path.exists(table_path(gtfs_dir, 'calendar_dates')):
+            exceptions = read_table(gtfs_dir, 'calendar_dates')
+
+        # The table covers the period and the calendar's own date range, with a
+        # day either side for the previous day of the first starts
+        from_day = epoch_day(info['from_date'])
+        to_day = epoch_day(info['to_date'])
+        self.first_day = min(from_day, starts.min()) - 1
+        last_day = max(to_day, ends.max()) + 1
+
+        days = np.arange(self.first_day, last_day + 1)
+
+        # Services run on their weekdays between their start and end dates.
+        # Days outside every service's dates, such as a period that starts
+        # before its calendar, fall back to the weekday pattern alone
+        in_range = (days[:, None] >= starts[None, :]) \
+                    & (days[:, None] <= ends[None, :])
+        in_range[~in_range.any(axis=1)] = True
+
+        self.table = self.weekday_services(days) & in_range
+
+        if exceptions is not None:
+            self.apply_exceptions(exceptions)
+
+    def weekday_services(self, days):
+        """
+        Which services run on the weekday of each day
+        Input: Array of days since 1970-01-01
+        Output: Boolean array of (days, services)
+        """
+
+        # 1970-01-01 was a Thursday
+        return self.weekdays[(days + 3) % 7]
+
+    def apply_exceptions(self, exceptions):
+        """
+        Add and remove services on the dates of calendar_dates.txt
+        """
+
+        columns = {service_id: idx for idx, service_id in enumerate(self.service_ids)}
+
+        for service_id, date, exception_type in exceptions[
+                ['service_id', 'date', 'exception_type']].values:
+
+            row = epoch_day(date) - self.first_day
+
+            if service_id not in columns or not 0 <= row < len(self.table):
+                continue
+
+            self.table[row, columns[service_id]] = exception_type == SERVICE_ADDED
+
+    def day_services(self, days):
+        """
+        Which services run on each day. Days outside the table use the weekday
+        pattern
+        Input: Array of days since 1970-01-01
+        Output: Boolean array of (days, services)
+        """
+
+        rows = days - self.first_day
+        inside = (rows >= 0) & (rows < len(self.table))
+
+        services = self.weekday_services(days)
+        services[inside] = self.table[rows[inside]]
+
+        return services
+
+    def resolve(self, time_stamps):
+        """
+        The services a trip starting at each time_stamp could belong to: the
+        services of its day, and early in the morning, also those of the
+        previous day, whose trips are scheduled past 24:00
+        Input: Array of time_stamps
+        Output: List of arrays of service_id's, one per time_stamp
+        """
+
+        days, hours = local_days(time_stamps)
+
+        running = self.day_services(days)
+
+        overnight = hours <= OVERNIGHT_HOUR
+        running[overnight] |= self.day_services(days[overnight] - 1)
+
+        return [self.service_ids[row] for row in running]
+
+
+def service_calendar(gtfs_period):
+    """
+    The ServiceCalendar of a GTFS period, built once per process
+    """
+
+    gtfs_dir = gtfs_directory(gtfs_period)
+
+    paths = [table_path(gtfs_dir, name) for name in ['calendar', 'calendar_dates']]
+    key = (gtfs_period, tuple((path, os.stat(path).st_mtime) for path in paths
+                                if os.path.exists(path)))
+
+    with _lock:
+        calendar = _calendars.get(key)
+
+    if calendar is None:
+        calendar = ServiceCalendar(gtfs_period)
+
+        with _lock:
+            _calendars[key] = calendar
+
+    return calendar
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+
+from src.trip_chunk_collections import chunk_frame
+
+
+def passing_frame(trip_collection, chunk_interval, trip_id_list=None):
+    """
+    Get when each trip entered each chunk, when it passed the chunk's stop,
+    and how long the chunk took, from the chunk-labeled trip documents.
+    Output: DataFrame with one row per trip and chunk
+    """
+
+    chunks = chunk_frame(trip_collection, chunk_interval, trip_id_list)
+
+    chunks = chunks.rename(columns={'min_ts': 'enter_ts', 'max_ts': 'pass_ts'})
+    chunks['seconds'] = chunks['pass_ts'] - chunks['enter_ts']
+
+    return chunks
+
+
+def headway_features(chunks, window=3, max_gap=3600):
+    """
+    For each trip and chunk, look back at the vehicles that had already passed
+    the chunk's stop when the trip entered the chunk. All chunks of all trips
+    are handled at once with a sorted as-of join per chunk stop.
+    Only what was known when the trip entered the chunk is kept, so its own
+    headway, which depends on when it passes the stop, is not a feature.
+    Input:
+        chunks: DataFrame from passing_frame
+        window: Number of previous vehicles in the rolling features
+        max_gap: Ignore previous vehicles that passed more than this many
+            seconds before the trip entered the chunk
+    Output: Long DataFrame, one row per trip and chunk, with:
+        since_prior_pass: Seconds since the previous vehicle passed the chunk
+            stop, when this trip entered the chunk
+        prior_seconds: The previous vehicle's travel time over the chunk
+        rolling_seconds, rolling_headway: Mean travel time and headway of the
+            last `window` vehicles to pass the chunk stop, up to the previous
+            vehicle (bunching shows up as short headways)
+    """
+
+    # Order the vehicles passing each chunk stop
+    passed = chunks.sort_values(['chunk', 'pass_ts'], kind='mergesort')
+    passed = passed.reset_index(drop=True)
+
+    by_chunk = passed.groupby('chunk', sort=False)
+    passed['headway'] = by_chunk['pass_ts'].diff()
+
+    passed['rolling_seconds'] = by_chunk['seconds'].transform(
+        lambda col: col.rolling(window, min_periods=1).mean())
+    passed['rolling_headway'] = by_chunk['headway'].transform(
+        lambda col: col.rolling(window, min_periods=1).mean())
+
+    # Everything known about a chunk stop once a vehicle has passed it
+    known = passed[['chunk', 'pass_ts', 'seconds', 'rolling_seconds',
+                    'rolling_headway']]
+    known = known.rename(columns={'pass_ts': 'prior_pass_ts',
+                                    'seconds': 'prior_seconds'})
+    known = known.sort_values('prior_pass_ts', kind='mergesort')
+
+    entering = passed[['trip_id_iso', 'start_timestamp', 'chunk', 'enter_ts']]
+    entering = entering.sort_values('enter_ts', kind='mergesort')
+
+    # The latest vehicle to pass each chunk stop before the trip entered it
+    joined = pd.merge_asof(entering, known, left_on='enter_ts',
+                right_on='prior_pass_ts', by='chunk', direction='backward',
+                tolerance=max_gap, allow_exact_matches=False)
+
+    joined['since_prior_pass'] = joined['enter_ts'] - joined['prior_pass_ts']
+
+    columns = ['trip_id_iso', 'start_timestamp', 'chunk', 'since_prior_pass',
+                'prior_seconds', 'rolling_seconds', 'rolling_headway']
+
+    return joined[columns].reset_index(drop=True)
+
+
+def headway_table(features):
+    """
+    Pivot long headway features into one row per trip, with columns such as
+    since_prior_pass_chnk_2
+    """
+
+    values = ['since_prior_pass', 'prior_seconds', 'rolling_seconds',
+                'rolling_headway']
+
+    wide = features.set_index(['trip_id_iso', 'chunk'])[values].unstack('chunk')
+    wide.columns = [value + '_chnk_' + str(chunk) for value, chunk in wide.columns]
+
+    starts = features.groupby('trip_id_iso')['start_timestamp'].max()
+
+    table = pd.concat([starts, wide], axis=1).reset_index()
+
+    return table.rename(columns={'index': 'trip_id_iso'})
+
+
+def headway_data_interval(trip_collection, output_collection, chunk_interval,
+                            window=3, max_gap=3600):
+    """
+    Build the headway features of every trip for a chunk interval and insert
+    them, in bulk, into the output collection
+    """
+
+    chunks = passing_frame(trip_collection, chunk_interval)
+
+    if chunks.empty:
+        return
+
+    table = headway_table(headway_features(chunks, window, max_gap))
+
+    # Missing priors become None, which BSON can store
+    table = table.astype(object).where(table.notnull(), None)
+
+    output_collection.insert_many(table.to_dict('records'))
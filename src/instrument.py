@@ -0,0 +1,339 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from bson import BSON
+from pymongo import monitoring
+
+# Where run reports are written
+REPORT_DIR = 'reports'
+
+# Stage that work done outside of any span is recorded under
+UNSCOPED = 'unscoped'
+
+
+class Recorder(object):
+    """
+    Records where a run's time goes:
+        Spans: wall and CPU seconds, and call counts, of named stages and
+            their sub-steps. Spans nest, and are keyed by their path, such as
+            'label_starts/cluster_starts'
+        Counters: Tallies such as good or sparse trips, per stage
+        Mongo commands: Count, latency and bytes sent and received, per stage,
+            collection and command, from a CommandMonitor
+    Spans and commands are attributed per thread, so worker threads can
+    record at the same time. CPU time is that of the whole process.
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        # Optional StageProfiler, see src/profiling.py
+        self.profiler = None
+
+        self.reset()
+
+    def reset(self):
+
+        with self.lock:
+            self.started = time.time()
+            self.cpu_started = time.process_time()
+            self.spans = {}
+            self.counters = {}
+            self.mongo = {}
+
+    ############
+    # Spans and counters
+
+    def stack(self):
+
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+
+        return self.local.stack
+
+    def current_path(self):
+
+        return '/'.join(self.stack())
+
+    def current_stage(self):
+        """
+        The outermost span of this thread, which commands and counters are
+        attributed to
+        """
+
+        stack = self.stack()
+
+        return stack[0] if stack else UNSCOPED
+
+    @contextmanager
+    def span(self, name):
+        """
+        Time a block of code as a span nested in the current one
+        """
+
+        stack = self.stack()
+        stack.append(name)
+        path = '/'.join(stack)
+
+        # Profile the span if it was asked for. Without a profiler this is the
+        # only cost
+        profiler = self.profiler
+        profiling = profiler is not None and profiler.wants(name, len(stack))
+
+        if profiling:
+            profiler.start(name)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        try:
+            yield
+
+        finally:
+            self.add_span(path, time.perf_counter() - wall,
+                            time.process_time() - cpu)
+            stack.pop()
+
+            if profiling:
+                profiler.stop(name)
+
+    def add_span(self, path, wall, cpu, calls=1):
+
+        with self.lock:
+            totals = self.spans.setdefault(path,
+                        {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            totals['calls'] += calls
+            totals['wall_seconds'] += wall
+            totals['cpu_seconds'] += cpu
+
+    def count(self, name, value=1, stage=None):
+        """
+        Add to a counter of the current stage
+        """
+
+        stage = stage or self.current_stage()
+
+        with self.lock:
+            counters = self.counters.setdefault(stage, {})
+            counters[name] = counters.get(name, 0) + value
+
+    def peak(self, name, value, stage=None):
+        """
+        Keep the largest value seen of a counter of the current stage, such as
+        peak memory
+        """
+
+        stage = stage or self.current_stage()
+
+        with self.lock:
+            counters = self.counters.setdefault(stage, {})
+            counters[name] = max(counters.get(name, value), value)
+
+    ############
+    # Mongo commands
+
+    def add_command(self, stage, collection, command, seconds, sent=0,
+                        received=0, failed=False):
+
+        with self.lock:
+            by_coll = self.mongo.setdefault(stage, {}).setdefault(collection, {})
+            stats = by_coll.setdefault(command, {'count': 0, 'seconds': 0.0,
+                        'bytes_sent': 0, 'bytes_received': 0, 'failures': 0})
+            stats['count'] += 1
+            stats['seconds'] += seconds
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+            stats['failures'] += int(failed)
+
+    ############
+    # Reports
+
+    def snapshot(self):
+        """
+        Copy of everything recorded so far, which can be sent between processes
+        and merged into another recorder
+        """
+
+        with self.lock:
+            return json.loads(json.dumps({
+                'spans': self.spans,
+                'counters': self.counters,
+                'mongo': self.mongo
+            }))
+
+    def merge(self, snapshot):
+        """
+        Merge a snapshot from another recorder, such as a worker process's.
+        Its spans are nested under the current span, and its counters and
+        commands are attributed to the current stage.
+        """
+
+        prefix = self.current_path()
+        stage = self.current_stage()
+
+        for path, totals in snapshot['spans'].items():
+            full_path = prefix + '/' + path if prefix else path
+            self.add_span(full_path, totals['wall_seconds'],
+                            totals['cpu_seconds'], totals['calls'])
+
+        for counters in snapshot['counters'].values():
+            for name, value in counters.items():
+                self.count(name, value, stage=stage)
+
+        with self.lock:
+            for by_coll in snapshot['mongo'].values():
+                for collection, commands in by_coll.items():
+                    for command, stats in commands.items():
+
+                        target = self.mongo.setdefault(stage, {}) \
+                            .setdefault(collection, {}) \
+                            .setdefault(command, {'count': 0, 'seconds': 0.0,
+                                'bytes_sent': 0, 'bytes_received': 0,
+                                'failures': 0})
+
+                        for key, value in stats.items():
+                            target[key] += value
+
+    def report(self, **details):
+        """
+        The run report: total wall and CPU time, spans slowest first, counters
+        and Mongo commands, plus any details given (such as parameters)
+        """
+
+        report = {
+            'started': datetime.fromtimestamp(self.started).isoformat(),
+            'wall_seconds': time.time() - self.started,
+            'cpu_seconds': time.process_time() - self.cpu_started
+        }
+        report.update(details)
+
+        snapshot = self.snapshot()
+
+        spans = sorted(snapshot['spans'].items(),
+                        key=lambda item: item[1]['wall_seconds'], reverse=True)
+        report['spans'] = dict(spans)
+        report['counters'] = snapshot['counters']
+        report['mongo'] = snapshot['mongo']
+
+        return report
+
+    def write_report(self, name, report_dir=REPORT_DIR, **details):
+        """
+        Write the run report as JSON to <report_dir>/<name>_<time>.json
+        Output: Path of the report
+        """
+
+        os.makedirs(report_dir, exist_ok=True)
+
+        stamp = datetime.fromtimestamp(self.started).strftime('%Y%m%d_%H%M%S')
+        path = os.path.join(report_dir, '{}_{}.json'.format(name, stamp))
+
+        with open(path, 'w') as f:
+            json.dump(self.report(script=name, **details), f, indent=2,
+                        default=str)
+
+        return path
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """
+    pymongo command listener that records every command's latency on a
+    Recorder, under the stage of the thread that sent it. Measuring the size
+    of commands and replies re-encodes each of them, so it is only done when
+    asked for
+    """
+
+    def __init__(self, recorder, measure_bytes=False):
+
+        self.recorder = recorder
+        self.measure_bytes = measure_bytes
+        self.pending = {}
+
+    def started(self, event):
+
+        command = event.command
+        name = event.command_name
+
+        # Most commands name their collection as the command's value, getMore
+        # names it separately
+        if name == 'getMore':
+            collection = command.get('collection')
+        else:
+            collection = command.get(name)
+
+        if not isinstance(collection, str):
+            collection = event.database_name
+
+        key = (event.connection_id, event.request_id)
+        self.pending[key] = (self.recorder.current_stage(), collection,
+                                self.size(command))
+
+    def succeeded(self, event):
+
+        self.finish(event, self.size(event.reply), False)
+
+    def failed(self, event):
+
+        self.finish(event, 0, True)
+
+    def size(self, document):
+
+        return len(BSON.encode(document)) if self.measure_bytes else 0
+
+    def finish(self, event, received, failed):
+
+        pending = self.pending.pop((event.connection_id, event.request_id), None)
+
+        if pending is None:
+            return
+
+        stage, collection, sent = pending
+
+        self.recorder.add_command(stage, collection, event.command_name,
+                                    event.duration_micros / 1e6, sent,
+                                    received, failed)
+
+
+# The recorder of this process
+RECORDER = Recorder()
+
+
+def span(name):
+    """
+    Time a stage or sub-step on the process's recorder:
+        with instrument.span('label_starts'):
+            ...
+    """
+
+    return RECORDER.span(name)
+
+
+def count(name, value=1):
+
+    RECORDER.count(name, value)
+
+
+def peak(name, value):
+
+    RECORDER.peak(name, value)
+
+
+def command_listener(measure_bytes=False):
+    """
+    A listener to pass to MongoClient(event_listeners=[...]), recording the
+    client's commands on the process's recorder, with their sizes in bytes if
+    measure_bytes
+    """
+
+    return CommandMonitor(RECORDER, measure_bytes)
+
+
+def write_report(name, report_dir=REPORT_DIR, **details):
+
+    return RECORDER.write_report(name, report_dir, **details)
@@ -4,10 +4,24 @@ import time
 import numpy as np
 import pymongo
 from pymongo import MongoClient
-from geopy import distance
 import random
 import string
 
+import src.gtfs as gtfs
+import src.geo as geo
+import src.instrument as instrument
+import src.partition as partition
+
+# A document within this many meters of the starting stop is a start
+START_RADIUS = 25
+
+# Starts within this many seconds of each other belong to the same cluster
+START_CLUSTER_SECONDS = 900
+
+# Starts further than this many seconds from any scheduled departure are
+# dropped
+MAX_SCHEDULE_DIFF = 1800
+
 class StartLabeler(object):
     """
     Class for labeling raw AVL data with trip_ids
@@ -17,7 +31,10 @@ class StartLabeler(object):
         In one direction
     """
 
-    def __init__(self, in_collection, out_collection, gtfs_period=0):
+    def __init__(self, in_collection, out_collection, gtfs_period=0,
+                    direction=0, partition_days=None,
+                    overlap=partition.WINDOW_OVERLAP,
+                    batch_size=partition.CURSOR_BATCH_SIZE, budget=None):
         """
         Input:
             in_collection:
@@ -28,10 +45,27 @@ class StartLabeler(object):
                 Index of the gtfs period we wish to get data for.
                 Indices can be looked up in data/gtfs_lookup.csv. The file is
                 sorted with most recent periods first
+            direction:
+                The direction_id of the trips to label
+            partition_days:
+                Label this many service days at a time, so memory doesn't grow
+                with the number of days. None labels each block in one go
+            overlap:
+                Seconds read either side of each window, for start clusters
+                crossing its edge
+            batch_size:
+                Documents fetched per round trip from the in collection
+            budget:
+                MemoryBudget checked after each window
         """
 
         self.in_coll = in_collection
         self.out_coll = out_collection
+        self.direction = direction
+        self.partition_days = partition_days
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.budget = budget or partition.MemoryBudget()
 
         # Get all unique blocks in the gtfs-specific collection
         self.blocks = self.in_coll.distinct('TRAIN_ASSIGNMENT')
@@ -62,10 +96,8 @@ class StartLabeler(object):
             gtfs_period: Index of the gtfs_lookup file to use
         """
 
-        gtfs_df = pd.read_csv('data/gtfs_lookup.csv')
-        gtfs_series = gtfs_df.iloc[gtfs_period]
-
-        self.gtfs_directory = gtfs_series['directory']
+        self.gtfs_period = gtfs_period
+        self.gtfs_directory = gtfs.gtfs_directory(gtfs_period)
 
     def load_filter_gtfs(self):
         """
@@ -75,32 +107,22 @@ class StartLabeler(object):
         """
 
         # Trips
-        trip_txt = 'data/gtfs/{}/trips.txt'.format(self.gtfs_directory)
-        trips = pd.read_csv(trip_txt)
+        trips = gtfs.read_table(self.gtfs_directory, 'trips')
         self.trip_blocks = trips[(trips['block_id'].isin(self.int_blocks)) \
-            & (trips['direction_id'] == 0)]
+            & (trips['direction_id'] == self.direction)]
         trip_ids = self.trip_blocks['trip_id'].unique()
 
         # Schedule
-        sched_txt = 'data/gtfs/{}/stop_times.txt'.format(self.gtfs_directory)
-        sched = pd.read_csv(sched_txt)
+        sched = gtfs.read_table(self.gtfs_directory, 'stop_times')
         self.sched_trps = sched[sched['trip_id'].isin(trip_ids)]
         stop_ids = self.sched_trps['stop_id'].unique()
 
         # Stops
-        stop_txt = 'data/gtfs/{}/stops.txt'.format(self.gtfs_directory)
-        stops = pd.read_csv(stop_txt)
+        stops = gtfs.read_table(self.gtfs_directory, 'stops')
         self.stop_sched = stops[stops['stop_id'].isin(stop_ids)]
 
-        # Calendar
-        cal_txt = 'data/gtfs/{}/calendar.txt'.format(self.gtfs_directory)
-        calendar = pd.read_csv(cal_txt)
-
-        # Since the datetime module gives day the week as an interger (0 for Monday,
-        # 6 for Sunday), we need to relabel the calendar columns
-        cal_col_mapping = {'monday':0, 'tuesday':1, 'wednesday':2, 'thursday':3,
-                       'friday':4, 'saturday':5, 'sunday':6}
-        self.cal_colnum = calendar.rename(columns=cal_col_mapping)
+        # Calendar, with its holiday exceptions, as the services of each day
+        self.calendar = gtfs.service_calendar(self.gtfs_period)
 
     def find_starting_stop(self):
         """
@@ -124,13 +146,17 @@ class StartLabeler(object):
         self.strting_latlon = (self.strtng_stop['stop_lat'].values[0], \
             self.strtng_stop['stop_lon'].values[0])
 
+        # And its projected x/y, for comparing with the pings'
+        self.strting_xy = (self.strtng_stop['stop_x'].values[0], \
+            self.strtng_stop['stop_y'].values[0])
+
 
 
     #########
     # Start Detection and Labeling
     def label_single_starts(self):
         """
-        For each block:
+        For each block, and each window of service days:
             Find all rows that are within 20 meters of the starting stop
             Cluster these rows based on time (within 2 minutes of each other)
             From each cluster, get the row that occurs last
@@ -140,27 +166,43 @@ class StartLabeler(object):
 
         start_intersection_count = 0
 
-        # For each block
-        for block in self.blocks:
+        # For each block, and window of days
+        for block, window in self.block_windows():
 
             # Get all intersections with the starting stop
-            starts = self.get_all_starts(block)
+            with instrument.span('get_all_starts'):
+                starts = self.get_all_starts(block, window)
             start_intersection_count += len(starts)
 
             # Cluster all these starts in a dictionary
-            clusters = self.cluster_starts(starts)
+            with instrument.span('cluster_starts'):
+                clusters = self.cluster_starts(starts)
 
-            # Get the latest row from each cluster
-            single_starts = self.get_single_starts(clusters)
+            # Get the latest row from each cluster. Clusters are read with the
+            # window's overlap, but only the starts inside it are kept, so
+            # neighbouring windows don't both label them
+            single_starts = [start for start in self.get_single_starts(clusters)
+                                if partition.in_window(start['time_stamp'], window)]
 
             # Find the trip_id that matches each start, and update the start row
-            labeled_starts = self.get_start_labels(single_starts)
+            with instrument.span('get_start_labels'):
+                labeled_starts = self.get_start_labels(single_starts)
 
             # Add labeled starts to the output collection
-            self.add_to_out_collection(labeled_starts)
+            with instrument.span('add_to_out_collection'):
+                self.add_to_out_collection(labeled_starts)
+
+            instrument.count('windows')
+            instrument.count('start_intersections', len(starts))
+            instrument.count('start_clusters', len(clusters))
+            instrument.count('labeled_starts', len(labeled_starts))
 
-            unique_count = len(self.out_coll.find().distinct('trip_id_iso'))
-            start_count = self.out_coll.count()
+            self.budget.check('label_starts, block ' + str(block))
+
+        self.budget.record()
+
+        unique_count = len(self.out_coll.find().distinct('trip_id_iso'))
+        start_count = self.out_coll.count_documents({})
 
         print ("\n")
         print ("----------------")
@@ -171,24 +213,64 @@ class StartLabeler(object):
         print ("Duplicate ID Count: ", unique_count-start_count)
         print ("\n")
 
-    def get_all_starts(self, block):
+    def block_windows(self):
+        """
+        Each block, with the windows of days its documents fall in
+        Output: Generator of (block, window), window being None when not
+            partitioned
         """
-        For each row, check if it comes within 25 meters of the starting stop
-        Input: block_id (as string)
+
+        for block in self.blocks:
+            for window in partition.collection_windows(self.in_coll,
+                                {'TRAIN_ASSIGNMENT': block}, self.partition_days):
+                yield block, window
+
+    def get_all_starts(self, block, window=None):
+        """
+        For each row, check if it comes within 25 meters of the starting stop.
+        Rows are streamed from the cursor, and checked a batch at a time.
+        Input:
+            block: block_id (as string)
+            window: (start, end) time_stamps to search, widened by the overlap.
+                None searches every day
         Output: List of all block intersections
         """
         start_intersections = []
 
-        for doc in self.in_coll.find({'TRAIN_ASSIGNMENT': block}).sort('time_stamp'):
+        search = partition.window_search({'TRAIN_ASSIGNMENT': block}, window,
+                        self.overlap)
+
+        cursor = self.in_coll.find(search).sort('time_stamp') \
+                    .batch_size(self.batch_size)
 
-            doc_latlon = (doc['LATITUDE'], doc['LONGITUDE'])
+        batch = []
 
-            if distance.distance(self.strting_latlon, doc_latlon).m <= 25:
+        for doc in cursor:
 
-                    start_intersections.append(doc)
+            batch.append(doc)
+
+            if len(batch) == self.batch_size:
+                start_intersections.extend(self.near_start(batch))
+                batch = []
+
+        start_intersections.extend(self.near_start(batch))
 
         return start_intersections
 
+    def near_start(self, docs):
+        """
+        The documents within START_RADIUS of the starting stop, by the
+        Euclidean distance of their projected x/y
+        """
+
+        if not docs:
+            return []
+
+        xs, ys = geo.docs_xy(docs)
+        near = geo.planar_distance(xs, ys, *self.strting_xy) <= START_RADIUS
+
+        return [doc for doc, is_near in zip(docs, near) if is_near]
+
     def cluster_starts(self, starts):
         """
         Clusters starting_stop intersections by time (within 15 minutes of any
@@ -233,7 +315,7 @@ class StartLabeler(object):
                             break
 
                         # If these two rows occured within 2 minutes of each other
-                        if time_diff.total_seconds() < 900:
+                        if time_diff.total_seconds() < START_CLUSTER_SECONDS:
 
                             # This row belongs in the cluster! Add it, break the
                             # loop, add to 'matched'
@@ -286,11 +368,23 @@ class StartLabeler(object):
 
         output = []
 
-        for start in single_starts:
+        # The services each start could belong to, looked up for every start
+        # at once
+        service_lists = self.calendar.resolve(
+                            [start['time_stamp'] for start in single_starts])
+
+        for start, service_id_lst in zip(single_starts, service_lists):
 
             # Get all possible scheduled starts, and a cleaned list of possible
             # departure times
-            schedule, departures = self.get_schedule_departs(start)
+            schedule, departures = self.get_schedule_departs(start,
+                                        service_id_lst)
+
+            # Skip starts on days with no service for their block, such as
+            # weekday blocks on a holiday
+            if departures.empty:
+                instrument.count('unscheduled_starts')
+                continue
 
             # Parse the doc time to match the departure time
             raw_time = (start['REPORT_TIME'].split(" ")[1])
@@ -308,7 +402,7 @@ class StartLabeler(object):
 
             # Skip potential starts with a scheduled departure time over 30
             # minutes away
-            if time_diff > 1800:
+            if time_diff > MAX_SCHEDULE_DIFF:
                 continue
 
             # Start adding new fields to the documents. Ints have to be cast, to
@@ -324,10 +418,13 @@ class StartLabeler(object):
 
             start['trip_id_iso'] = str(sched_start['trip_id']) + '_' + iso + '_' + rand
 
-            # Getting seconds from noon
+            # Getting seconds from noon, and since midnight. time_stamps are
+            # in the local time of the host that extracted them, so they are
+            # decoded with fromtimestamp
             start_dt = datetime.fromtimestamp(start['time_stamp'])
-            ssn = (((start_dt.hour * 60) + start_dt.minute) - 720)**2
-            start['minutes_noon_sqr'] = ssn
+            mins = (start_dt.hour * 60) + start_dt.minute
+            start['minutes_noon_sqr'] = (mins - 720)**2
+            start['min_since_midnight'] = mins
 
             # Now that we know the trip, get the actual service id
             trip_mask = self.trip_blocks['trip_id'] == start['trip_id']
@@ -342,11 +439,14 @@ class StartLabeler(object):
 
     ##########
     # Detection/Labeling Utilities
-    def get_schedule_departs(self, start):
+    def get_schedule_departs(self, start, service_id_lst=None):
         """
         Get a dataframe of all possible scheduled departures and a cleaned list
         of possible departure times as strings.
-        Input: Start Document
+        Input:
+            start: Start Document
+            service_id_lst: The start's possible service_id's, if already
+                looked up
         Output: DataFrame of scheduled starts, series of start times
         """
 
@@ -354,7 +454,8 @@ class StartLabeler(object):
         # Can be multiple, as buses can be schedule beyond 24 hours (up to
         # 30:34:00!), and these 'late' buses can overlap with early buses
         # the next day
-        service_id_lst = self.get_start_service_list(start['time_stamp'])
+        if service_id_lst is None:
+            service_id_lst = self.get_start_service_list(start['time_stamp'])
 
         # # Bonus! We can add this data to the start itself
         # start['service_id'] = service_id
@@ -383,37 +484,12 @@ class StartLabeler(object):
     def get_start_service_list(self, start_timestamp):
         """
         Lookup a start's service ID for better trip filtering when labeling
-        Accounts for gosh-darn crazy schedule hours
-        Input: A doc's raw 'reported time', as a string
-        Output: A service_id (integer between 1 and 3)
+        Accounts for gosh-darn crazy schedule hours, and holidays
+        Input: A doc's time_stamp
+        Output: List of service_id's (integers between 1 and 3)
         """
 
-        # Convert the timestamp into a datetime object and get the weekday
-        cln_date = datetime.fromtimestamp(start_timestamp)
-        wkdy_num = cln_date.weekday()
-
-        # The system-wide max departure time is 30:34 (6:34 the next day)
-        # The system-wide min departure time is 02:54 (2:54 this day)
-        # Any departure between these hours could be from a schedule on this day
-        # or the previous day
-        if cln_date.hour <= 7:
-
-            # Careful! Can't have negative weekdays
-            if wkdy_num == 0:
-                weekdays = list(set([wkdy_num, 6]))
-            else:
-                weekdays = list(set([wkdy_num, wkdy_num-1]))
-
-        else:
-            weekdays = [wkdy_num]
-
-        # Using the GTFS calendar, return the service_id for each possible weekday
-        service_ids = []
-        for day in weekdays:
-            service_row = self.cal_colnum[self.cal_colnum[day] == 1]
-            service_ids.append(service_row['service_id'].values[0])
-
-        return service_ids
+        return list(self.calendar.resolve([start_timestamp])[0])
 
     def get_scheduled_starts(self, block_id, service_id_list):
         """
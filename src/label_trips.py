@@ -1,13 +1,31 @@
 import pandas as pd
 from datetime import datetime
+import math
 import time
 import numpy as np
 import pymongo
 from pymongo import MongoClient
-from geopy import distance
 import random
 import string
 
+import src.gtfs as gtfs
+import src.geo as geo
+import src.instrument as instrument
+import src.partition as partition
+
+# A document within this many meters of the last stop ends the trip
+END_RADIUS = 150
+
+# Trips with a gap of more than this many seconds between documents are sparse
+MAX_PING_GAP = 180
+
+# Trips are searched for up to this many seconds after their start
+MAX_TRIP_SECONDS = 10800
+
+# Good trips have between this many documents
+MIN_TRIP_DOCS = 40
+MAX_TRIP_DOCS = 150
+
 class TripLabeler(object):
     """
     Class for labeling raw AVL data with trip_ids
@@ -17,7 +35,9 @@ class TripLabeler(object):
         In one direction
     """
 
-    def __init__(self, raw_collection, trip_collection, gtfs_period=0):
+    def __init__(self, raw_collection, trip_collection, gtfs_period=0,
+                    direction=0, partition_days=None,
+                    batch_size=partition.CURSOR_BATCH_SIZE, budget=None):
         """
         Input:
             raw_collection:
@@ -28,10 +48,23 @@ class TripLabeler(object):
                 Index of the gtfs period we wish to get data for.
                 Indices can be looked up in data/gtfs_lookup.csv. The file is
                 sorted with most recent periods first
+            direction:
+                The direction_id of the trips to label
+            partition_days:
+                Label the trips starting in this many service days at a time.
+                None labels every trip in one pass
+            batch_size:
+                Documents fetched per round trip when streaming cursors
+            budget:
+                MemoryBudget checked after each window
         """
 
         self.raw_coll = raw_collection
         self.trip_coll = trip_collection
+        self.direction = direction
+        self.partition_days = partition_days
+        self.batch_size = batch_size
+        self.budget = budget or partition.MemoryBudget()
 
         # Get all unique blocks in the gtfs-specific collection
         self.blocks = self.raw_coll.distinct('TRAIN_ASSIGNMENT')
@@ -54,10 +87,7 @@ class TripLabeler(object):
             gtfs_period: Index of the gtfs_lookup file to use
         """
 
-        gtfs_df = pd.read_csv('data/gtfs_lookup.csv')
-        gtfs_series = gtfs_df.iloc[gtfs_period]
-
-        self.gtfs_directory = gtfs_series['directory']
+        self.gtfs_directory = gtfs.gtfs_directory(gtfs_period)
 
     def load_filter_gtfs(self):
         """
@@ -67,26 +97,22 @@ class TripLabeler(object):
         """
 
         # Trips
-        trip_txt = 'data/gtfs/{}/trips.txt'.format(self.gtfs_directory)
-        trips = pd.read_csv(trip_txt)
+        trips = gtfs.read_table(self.gtfs_directory, 'trips')
         self.trip_blocks = trips[(trips['block_id'].isin(self.int_blocks)) \
-            & (trips['direction_id'] == 0)]
+            & (trips['direction_id'] == self.direction)]
         trip_ids = self.trip_blocks['trip_id'].unique()
 
         # Schedule
-        sched_txt = 'data/gtfs/{}/stop_times.txt'.format(self.gtfs_directory)
-        sched = pd.read_csv(sched_txt)
+        sched = gtfs.read_table(self.gtfs_directory, 'stop_times')
         self.sched_trps = sched[sched['trip_id'].isin(trip_ids)]
         stop_ids = self.sched_trps['stop_id'].unique()
 
         # Stops
-        stop_txt = 'data/gtfs/{}/stops.txt'.format(self.gtfs_directory)
-        stops = pd.read_csv(stop_txt)
+        stops = gtfs.read_table(self.gtfs_directory, 'stops')
         self.stop_sched = stops[stops['stop_id'].isin(stop_ids)]
 
         # Calendar
-        cal_txt = 'data/gtfs/{}/calendar.txt'.format(self.gtfs_directory)
-        calendar = pd.read_csv(cal_txt)
+        calendar = gtfs.read_table(self.gtfs_directory, 'calendar')
 
         # Since the datetime module gives day the week as an interger (0 for Monday,
         # 6 for Sunday), we need to relabel the calendar columns
@@ -110,6 +136,7 @@ class TripLabeler(object):
         edstp_ltln = (ed_stp['stop_lat'].values[0], ed_stp['stop_lon'].values[0])
 
         self.last_stop = edstp_ltln
+        self.last_stop_xy = (ed_stp['stop_x'].values[0], ed_stp['stop_y'].values[0])
 
 
     #########
@@ -129,8 +156,57 @@ class TripLabeler(object):
         self.empty = 0
         self.sparse = 0
 
-        # For each start in our out collection
-        for start in self.trip_coll.find({ 'trip_start': 1}):
+        windows = partition.collection_windows(self.trip_coll, {'trip_start': 1},
+                        self.partition_days)
+
+        # For each window of days, and each start in our out collection
+        for window in windows:
+            self.label_window(window)
+            self.budget.check('label_trips')
+
+        self.budget.record()
+
+        start_count = self.trip_coll.count_documents({'trip_start': 1})
+
+        instrument.count('good', self.good_trip_count)
+        instrument.count('good_docs', self.good_doc_count + start_count)
+        instrument.count('empty', self.empty)
+        instrument.count('mini', self.mini)
+        instrument.count('giant', self.giant)
+        instrument.count('endless', self.endless)
+        instrument.count('sparse', self.sparse)
+
+        # Print labelling stats
+        print ("----------------")
+        print ("Total Good Trips: ", self.good_trip_count)
+        print ("\n")
+        print ("Total Good Documents", self.good_doc_count + start_count)
+        print ("\n")
+        print ("Total Emtpy Trips: ", self.empty)
+        print ("\n")
+        print ("Total Mini Trips: ", self.mini)
+        print ("\n")
+        print ("Total Gigantic Trips: ", self.giant)
+        print ("\n")
+        print ("Total 'Endless' Trips: ", self.endless)
+        print ("\n")
+        print ("Total Sparse Trips: ", self.sparse)
+        print ("\n")
+
+    def label_window(self, window):
+        """
+        Label the trips of the starts in a window of days. A trip's documents
+        are searched for after its start, so trips running past the end of
+        the window are still labeled whole.
+        Input: (start, end) time_stamps, or None for every start
+        """
+
+        # The starts are read up front, as rejected trips delete theirs
+        starts = list(self.trip_coll.find(
+                        partition.window_search({'trip_start': 1}, window))
+                        .batch_size(self.batch_size))
+
+        for start in starts:
 
             # Build our search parameters for the in collection
             search = {}
@@ -138,7 +214,7 @@ class TripLabeler(object):
             search['VEHICLE_TAG'] = start['VEHICLE_TAG']
 
             # Get documents that occur after the trip start, up to 3 hours
-            plus_3hr = start['time_stamp'] + 10800
+            plus_3hr = start['time_stamp'] + MAX_TRIP_SECONDS
             search['time_stamp'] = {"$gt": start['time_stamp'], "$lt": plus_3hr}
 
             # Don't get other trip starts
@@ -154,27 +230,8 @@ class TripLabeler(object):
             tripid_iso = start['trip_id_iso']
 
             # Get a list of all labeled documents on this trip
-            self.get_trip_docs(search, tripid_iso)
-
-
-        start_count = self.trip_coll.find({ 'trip_start': 1}).count()
-
-        # Print labelling stats
-        print ("----------------")
-        print ("Total Good Trips: ", self.good_trip_count)
-        print ("\n")
-        print ("Total Good Documents", self.good_doc_count + start_count)
-        print ("\n")
-        print ("Total Emtpy Trips: ", self.empty)
-        print ("\n")
-        print ("Total Mini Trips: ", self.mini)
-        print ("\n")
-        print ("Total Gigantic Trips: ", self.giant)
-        print ("\n")
-        print ("Total 'Endless' Trips: ", self.endless)
-        print ("\n")
-        print ("Total Sparse Trips: ", self.sparse)
-        print ("\n")
+            with instrument.span('get_trip_docs'):
+                self.get_trip_docs(search, tripid_iso)
 
 
     def get_last_stop(self, start):
@@ -218,38 +275,37 @@ class TripLabeler(object):
         # Where to collect our labeled trip_docs
         trip_docs = []
 
-        # Get all relevant docs after our search, sorted
-        search = list(self.raw_coll.find(search_params).sort('time_stamp'))
+        # Get all relevant docs after our search, sorted. The cursor is
+        # streamed, and stops being read once the trip ends
+        search = self.raw_coll.find(search_params).sort('time_stamp') \
+                    .batch_size(self.batch_size)
 
-        # Account for starts that occur right at the end of our data
-        if not search:
-            self.empty += 1
-            self.trip_coll.delete_one({'trip_id_iso': tripid_iso})
-            return None
+        last_ts = None
 
         # Get all documents that match our search, sorted by time_stamp
-        for idx, data in enumerate(search):
+        for data in search:
             data_ts = data['time_stamp']
 
-            if idx != 0:
-                last_doc = search[idx-1]
-                last_ts = last_doc['time_stamp']
+            if last_ts is not None:
                 diff = data_ts - last_ts
 
                 # If the time_stamp of this document is 5 minutes after the next:
-                if diff > 180:
+                if diff > MAX_PING_GAP:
                     sparse = True
                     breakin += 1
                     break
 
+            last_ts = data_ts
+
             # Add the label to the document
             data['trip_id_iso'] = tripid_iso
 
-            # Get the document's lat/lon
-            data_latlon = (data['LATITUDE'], data['LONGITUDE'])
+            # Get the document's projected x/y
+            data_x, data_y = geo.ping_xy(data)
 
             # Check for last_stop intersection
-            if distance.distance(self.last_stop, data_latlon).m <= 150:
+            if math.hypot(data_x - self.last_stop_xy[0],
+                            data_y - self.last_stop_xy[1]) <= END_RADIUS:
 
                 # Label the document as the end
                 data['trip_end'] = int(1)
@@ -274,8 +330,14 @@ class TripLabeler(object):
             trip_docs.append(data)
 
 
+        # Account for starts that occur right at the end of our data
+        if last_ts is None:
+            self.empty += 1
+            self.trip_coll.delete_one({'trip_id_iso': tripid_iso})
+            return None
+
         # Check for lack of ending intersection! :-(
-        if breakin == 0:
+        elif breakin == 0:
 
             # Add the trip to a separate array
             self.endless += 1
@@ -289,7 +351,7 @@ class TripLabeler(object):
             return None
 
         # Check if the trip is unreasonably sparse
-        elif count < 40:
+        elif count < MIN_TRIP_DOCS:
 
             # Add the trip to a separate array
             self.mini += 1
@@ -297,7 +359,7 @@ class TripLabeler(object):
             return None
 
         # Check if trip is unreasonably dense
-        elif count > 150:
+        elif count > MAX_TRIP_DOCS:
 
             # Add the trip to a separate array
             self.giant +=1
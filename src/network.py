@@ -0,0 +1,182 @@
+import contextlib
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import src.feature_store as ftr_store
+import src.gtfs as gtfs
+import src.instrument as instrument
+import src.orchestrator as orchestrator
+import src.stages as stages
+import src.storage as storage
+
+# Every route of the network
+ROUTES_CSV = 'data/muni_routes.csv'
+
+# Where AVL files are kept once downloaded, as every route reads the same days
+AVL_CACHE_DIR = 'data/avl_cache'
+
+
+def network_routes(path=ROUTES_CSV):
+    """
+    Names of all the routes in the network, as used for the 'bus' parameter
+    """
+
+    routes = pd.read_csv(path, dtype=str)
+
+    return routes['muni_routes'].str.strip().tolist()
+
+
+def job_matrix(routes=None, directions=(0, 1), gtfs_periods=(0,)):
+    """
+    One job per route, direction and GTFS period
+    Input:
+        routes: Route names. Defaults to every route in data/muni_routes.csv
+        directions: direction_id's
+        gtfs_periods: Indices of data/gtfs_lookup.csv
+    Output: List of job dictionaries, with bus, direction and gtfs_period
+    """
+
+    if routes is None:
+        routes = network_routes()
+
+    return [{'bus': bus, 'direction': direction, 'gtfs_period': gtfs_period}
+                for gtfs_period in gtfs_periods
+                for bus in routes
+                for direction in directions]
+
+
+def job_name(job):
+
+    return '{}_{}_{}'.format(job['bus'], job['direction'], job['gtfs_period'])
+
+
+def job_params(params, job, workers=1):
+    """
+    The parameters of one job: the base parameters with the job's route,
+    direction and period, and its own database (or in-memory path), feature
+    store and report directory, so jobs don't overwrite each other
+    Input:
+        params: Base parameters, from parameters.json
+        job: Dictionary from job_matrix
+        workers: Worker processes each job may use to chunk trips
+    """
+
+    name = job_name(job)
+
+    merged = dict(params)
+    merged.update(job)
+
+    merged['job'] = name
+    merged['database'] = '{}_{}'.format(params['database'], name)
+    merged['memory_path'] = os.path.join(
+        params.get('memory_path', storage.MEMORY_PATH), name)
+    merged['feature_dir'] = os.path.join(
+        params.get('feature_dir', ftr_store.FEATURE_DIR), name)
+    merged['report_dir'] = os.path.join(
+        params.get('report_dir', instrument.REPORT_DIR), name)
+    merged['workers'] = workers
+
+    return merged
+
+
+def run_job(params, options):
+    """
+    Run the pipeline for one job, in a worker process. The job's output is
+    written to a log in its report directory, and errors are returned rather
+    than raised, so one bad route doesn't stop the others.
+    Input:
+        params: Parameters from job_params
+        options: Keyword arguments of Orchestrator.run
+    Output: Dictionary with the job's name, status, stages run and seconds
+    """
+
+    instrument.RECORDER.reset()
+
+    os.makedirs(params['report_dir'], exist_ok=True)
+    log_path = os.path.join(params['report_dir'], 'job.log')
+
+    summary = {'job': params['job'], 'status': 'done', 'ran': [],
+                'log': log_path}
+    start = time.time()
+
+    with open(log_path, 'a') as log, contextlib.redirect_stdout(log):
+
+        db = storage.open_storage(params,
+                event_listeners=[instrument.command_listener(
+                    params.get('measure_command_bytes', False))])
+
+        runner = orchestrator.Orchestrator(stages.pipeline_stages(params), db,
+                    params)
+
+        try:
+            summary['ran'] = runner.run(**options)
+
+        except Exception as error:
+            traceback.print_exc(file=log)
+            summary['status'] = 'failed'
+            summary['error'] = repr(error)
+
+        finally:
+            db.save()
+
+        summary['report'] = instrument.write_report('job', params['report_dir'],
+                                parameters=params)
+
+    summary['seconds'] = time.time() - start
+
+    return summary
+
+
+def run_jobs(params, jobs, concurrency=None, **options):
+    """
+    Run the pipeline for many jobs on a pool of worker processes.
+    The GTFS tables of every period are parsed once, before the pool starts,
+    and read from the shared cache by the workers.
+    Input:
+        params: Base parameters
+        jobs: List of jobs from job_matrix
+        concurrency: Number of jobs run at once. Defaults to the number of
+            CPUs
+        options: Keyword arguments of Orchestrator.run, such as force
+    Output: List of job summaries, in the order of the jobs
+    """
+
+    concurrency = concurrency or os.cpu_count()
+
+    # CPUs left over from the jobs are used to chunk each job's trips
+    workers = max(1, (os.cpu_count() or 1) // concurrency)
+
+    gtfs.warm_cache(sorted(set(job['gtfs_period'] for job in jobs)))
+
+    summaries = {}
+    start = time.time()
+
+    with ProcessPoolExecutor(max_workers=concurrency) as pool:
+
+        futures = {pool.submit(run_job, job_params(params, job, workers),
+                                options): job_name(job)
+                    for job in jobs}
+
+        for future in as_completed(futures):
+
+            name = futures[future]
+
+            try:
+                summary = future.result()
+            except Exception as error:
+                # The worker process itself died
+                summary = {'job': name, 'status': 'failed', 'error': repr(error),
+                            'ran': []}
+
+            summaries[name] = summary
+
+            print ("Finished ", len(summaries), " of ", len(jobs), " jobs, ",
+                    name, ": ", summary['status'], " in ",
+                    "{0:.0f}".format(summary.get('seconds', 0)), " seconds, ",
+                    "{0:.0f}".format(time.time() - start), " seconds total")
+
+    return [summaries[job_name(job)] for job in jobs]
@@ -0,0 +1,390 @@
+import time
+import uuid
+from datetime import datetime
+
+from src.fingerprint import fingerprint_files, fingerprint_values
+import src.instrument as instrument
+
+# Collection the stage checkpoints are kept in, next to the data they describe
+CHECKPOINT_COLLECTION = 'pipeline_checkpoints'
+
+
+class Stage(object):
+    """
+    A node of the pipeline DAG
+    """
+
+    def __init__(self, name, run, deps=(), params=(), files=None,
+                    shares=(), batch=None, interval=None):
+        """
+        Input:
+            name:
+                Unique name of the stage, such as 'build_chunks_6'
+            run:
+                Function called as run(ctx, stages), with the stages being
+                run together (just this one unless it is batched). May return
+                a JSON-serializable result, kept in the checkpoint
+            deps:
+                Names of the stages whose output this one reads
+            params:
+                Parameters the stage's output depends on
+            files:
+                Function of the parameters giving the input files the stage's
+                output depends on
+            shares:
+                Upstream stages that write to the same output, and so have to
+                be rerun with this one
+            batch:
+                Stages with the same batch name that run back to back are run
+                in a single call, such as chunking trips for every interval in
+                one pass
+            interval:
+                Chunk interval of per-interval stages
+        """
+
+        self.name = name
+        self.run = run
+        self.deps = list(deps)
+        self.params = list(params)
+        self.files = files
+        self.shares = list(shares)
+        self.batch = batch
+        self.interval = interval
+
+
+class Orchestrator(object):
+    """
+    Runs a DAG of stages, skipping the ones whose inputs haven't changed since
+    they last succeeded.
+    A stage's fingerprint covers its parameters, its input files, and the run
+    ids of the stages it depends on. Every time a stage runs it gets a new run
+    id, so its dependents rerun too. Checkpoints are kept in a collection of
+    the storage the stages write to, so they are lost with the data.
+    """
+
+    def __init__(self, stages, db, params,
+                    checkpoint_collection=CHECKPOINT_COLLECTION):
+        """
+        Input:
+            stages:
+                List of Stage's, with every stage after its dependencies
+            db:
+                Storage the stages read and write, see src/storage.py
+            params:
+                The pipeline's parameters
+        """
+
+        self.stages = stages
+        self.by_name = {stage.name: stage for stage in stages}
+        self.db = db
+        self.params = params
+        self.checkpoint_coll = db[checkpoint_collection]
+
+        self.ctx = {'db': db, 'params': params, 'orchestrator': self}
+
+    ############
+    # Checkpoints
+
+    def checkpoint(self, name):
+
+        return self.checkpoint_coll.find_one({'_id': name})
+
+    def result(self, name):
+        """
+        What a stage returned the last time it succeeded
+        """
+
+        checkpoint = self.checkpoint(name)
+
+        if checkpoint is None or checkpoint['status'] != 'done':
+            raise RuntimeError('Stage {} has not been run'.format(name))
+
+        return checkpoint.get('result')
+
+    def save_checkpoint(self, name, **fields):
+
+        checkpoint = self.checkpoint(name) or {'_id': name}
+        checkpoint.update(fields)
+
+        self.checkpoint_coll.replace_one({'_id': name}, checkpoint, upsert=True)
+
+    def fingerprint(self, stage):
+        """
+        Fingerprint of a stage's inputs, given the last runs of its
+        dependencies
+        """
+
+        upstream = {}
+        for dep in stage.deps:
+            checkpoint = self.checkpoint(dep)
+            upstream[dep] = checkpoint.get('run_id') if checkpoint else None
+
+        files = stage.files(self.params) if stage.files else []
+
+        return fingerprint_values({
+            'stage': stage.name,
+            'params': {key: self.params.get(key) for key in stage.params},
+            'files': fingerprint_files(files) if files else None,
+            'upstream': upstream
+        })
+
+    ############
+    # Planning
+
+    def select(self, names):
+        """
+        Stages matching names, either exactly or by their name without the
+        interval, so 'build_chunks' selects every build_chunks_N
+        """
+
+        selected = []
+
+        for name in names:
+
+            matches = [stage.name for stage in self.stages
+                        if stage.name == name
+                        or (stage.interval is not None
+                            and stage.name == '{}_{}'.format(name, stage.interval))]
+
+            if not matches:
+                raise ValueError('Unknown stage ' + name)
+
+            selected.extend(matches)
+
+        return set(selected)
+
+    def ancestors(self, names):
+        """
+        The named stages and everything they depend on
+        """
+
+        found = set()
+        pending = list(names)
+
+        while pending:
+            name = pending.pop()
+            if name in found:
+                continue
+            found.add(name)
+            pending.extend(self.by_name[name].deps)
+
+        return found
+
+    def descendants(self, names):
+        """
+        The named stages and everything that depends on them
+        """
+
+        found = set(names)
+
+        for stage in self.stages:
+            if any(dep in found for dep in stage.deps):
+                found.add(stage.name)
+
+        return found
+
+    def plan(self, targets=None, only=None, resume=False, force=False):
+        """
+        Decide which stages to run, and why.
+        Input:
+            targets:
+                Stages that should be up to date once the run is done, with
+                everything they depend on. Defaults to every stage
+            only:
+                Run just these stages, whether or not their inputs changed,
+                without checking the stages they depend on
+            resume:
+                Run from the stages that failed last time, trusting the
+                stages before them
+            force:
+                Rerun every stage
+        Output: List of (stage, reason) to run, in order
+        """
+
+        wanted = self.ancestors(targets) if targets else set(self.by_name)
+        forced = set()
+        scope = None
+
+        if only:
+            forced = self.select(only)
+            scope = set(forced)
+
+        elif resume:
+            unfinished = [stage.name for stage in self.stages
+                            if stage.name in wanted
+                            and self.status(stage.name) in ('failed', 'running')]
+
+            if unfinished:
+                forced = set(unfinished)
+                scope = self.descendants(forced) & wanted
+            else:
+                print ("No failed stage to resume from, running what changed")
+
+        while True:
+
+            running = {}
+
+            for stage in self.stages:
+
+                if stage.name not in wanted:
+                    continue
+
+                if scope is not None and stage.name not in scope:
+                    continue
+
+                reason = self.reason(stage, running, force or stage.name in forced)
+
+                if reason:
+                    running[stage.name] = reason
+
+            # Stages that share an output with a running stage have to be
+            # rerun with it
+            shared = [(dep, stage) for stage in running
+                        for dep in self.by_name[stage].shares
+                        if dep not in running]
+
+            if not shared:
+                break
+
+            for dep, stage in shared:
+                forced.add(dep)
+                if scope is not None:
+                    scope.add(dep)
+                print ("Rerunning ", dep, ", which shares its output with ", stage)
+
+        for name in running:
+            for dep in self.by_name[name].deps:
+                if dep not in running and self.status(dep) != 'done':
+                    raise RuntimeError('Stage {} needs {} to have run first'
+                                        .format(name, dep))
+
+        return [(stage, running[stage.name]) for stage in self.stages
+                    if stage.name in running]
+
+    def status(self, name):
+
+        checkpoint = self.checkpoint(name)
+
+        return checkpoint['status'] if checkpoint else None
+
+    def reason(self, stage, running, forced):
+        """
+        Why a stage needs to run, or None if it is up to date
+        """
+
+        if forced:
+            return 'selected'
+
+        checkpoint = self.checkpoint(stage.name)
+
+        if checkpoint is None:
+            return 'never run'
+
+        if checkpoint['status'] != 'done':
+            return 'last run ' + checkpoint['status']
+
+        rerun_deps = [dep for dep in stage.deps if dep in running]
+        if rerun_deps:
+            return 'upstream rerun: ' + ', '.join(rerun_deps)
+
+        if checkpoint['fingerprint'] != self.fingerprint(stage):
+            return 'inputs changed'
+
+        return None
+
+    ############
+    # Running
+
+    def run(self, targets=None, only=None, resume=False, force=False,
+                dry_run=False):
+        """
+        Run the planned stages in order. Batched stages that are planned back
+        to back run in one call. A failed stage is checkpointed as failed and
+        its error raised, so the run can be resumed from it.
+        Output: List of the names of the stages that ran
+        """
+
+        plan = self.plan(targets, only, resume, force)
+        reasons = {stage.name: reason for stage, reason in plan}
+        wanted = self.ancestors(targets) if targets else set(self.by_name)
+
+        for stage in self.stages:
+            if stage.name in reasons:
+                print ("Run  ", stage.name, ": ", reasons[stage.name])
+            elif stage.name in wanted and not (only or resume):
+                print ("Skip ", stage.name, ": up to date")
+
+        if dry_run:
+            return list(reasons)
+
+        ran = []
+
+        for group in self.groups([stage for stage, _ in plan]):
+
+            names = [stage.name for stage in group]
+
+            for name in names:
+                self.save_checkpoint(name, status='running',
+                                        started=datetime.now().isoformat())
+
+            start = time.time()
+
+            try:
+                with instrument.span(group[0].batch or group[0].name):
+                    result = group[0].run(self.ctx, group)
+
+            except Exception as error:
+                for name in names:
+                    self.save_checkpoint(name, status='failed', error=repr(error))
+                print ("Stage ", ', '.join(names), " failed, rerun with --resume")
+                raise
+
+            seconds = time.time() - start
+
+            # Fingerprints are taken now, with the new run ids of the stages
+            # this group depends on
+            for stage in group:
+                self.save_checkpoint(stage.name, status='done', error=None,
+                                        fingerprint=self.fingerprint(stage),
+                                        run_id=uuid.uuid4().hex,
+                                        finished=datetime.now().isoformat(),
+                                        seconds=seconds, result=result)
+
+            ran.extend(names)
+
+        return ran
+
+    def groups(self, stages):
+        """
+        Split the stages to run into groups run in one call: batched stages
+        planned back to back, whose dependencies are outside the group
+        """
+
+        groups = []
+
+        for stage in stages:
+
+            if groups and stage.batch and groups[-1][0].batch == stage.batch \
+                    and not any(dep in [s.name for s in groups[-1]]
+                                for dep in stage.deps):
+                groups[-1].append(stage)
+            else:
+                groups.append([stage])
+
+        return groups
+
+
+def add_run_arguments(parser):
+    """
+    Add the orchestrator's options to a script's argument parser
+    """
+
+    parser.add_argument('--stage', nargs='+', metavar='STAGE',
+                        help="Only run these stages, such as label_trips, "
+                             "build_chunks (every interval) or chunk_trips_6")
+    parser.add_argument('--resume', action='store_true',
+                        help='Run from the stage that failed last time')
+    parser.add_argument('--force', action='store_true',
+                        help='Rerun every stage, even if nothing changed')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Print which stages would run, and why')
@@ -0,0 +1,168 @@
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import pymongo
+from pymongo import MongoClient
+
+import src.instrument as instrument
+
+# Each worker process keeps its own connection, created when the process starts
+_worker_client = None
+
+
+def shard_trip_ids(trip_ids, n_shards, shard_by='hash'):
+    """
+    Partition trip_id_iso's into shards.
+    Input:
+        trip_ids: List of trip_id_iso's
+        n_shards: Number of shards to hash trips into
+        shard_by: 'hash' to spread trips evenly across n_shards, or 'day' to
+            make one shard per service day
+    Output: Dictionary of shard key to list of trip_id_iso's
+    """
+
+    shards = {}
+
+    for trip in trip_ids:
+
+        if shard_by == 'day':
+            # trip_id_iso's look like '<trip_id>_<YYYY-MM-DD>_<random>'
+            key = trip.split('_')[1]
+        else:
+            # crc32 rather than hash(), which is randomised per process
+            key = zlib.crc32(trip.encode()) % n_shards
+
+        shards.setdefault(key, []).append(trip)
+
+    return shards
+
+
+def _init_worker(host, port, measure_bytes):
+    """
+    Open the worker process's own database connection, recording its
+    commands on the worker's recorder.
+    """
+
+    global _worker_client
+    _worker_client = MongoClient(host, port,
+                        event_listeners=[instrument.command_listener(measure_bytes)])
+
+
+def _run_shard(worker, database, trip_ids, args):
+    """
+    Run a worker function over one shard, returning the trip count, the
+    time it took, and what the worker's recorder recorded for the shard.
+    """
+
+    instrument.RECORDER.reset()
+
+    start = time.time()
+
+    with instrument.span(worker.__name__):
+        worker(_worker_client[database], trip_ids, *args)
+
+    return len(trip_ids), time.time() - start, instrument.RECORDER.snapshot()
+
+
+class ShardedExecutor(object):
+    """
+    Runs a per-trip stage over shards of trips on a pool of worker processes.
+    Failed shards are retried on their own, and progress is reported per shard
+    rather than per trip.
+    """
+
+    def __init__(self, database, host='localhost', port=27017, workers=None,
+                    shard_by='hash', retries=2, measure_bytes=False):
+        """
+        Input:
+            database:
+                Name of the database the workers connect to
+            host, port:
+                Location of the Mongo server
+            workers:
+                Number of worker processes. Defaults to the number of CPUs
+            shard_by:
+                'hash' or 'day', see shard_trip_ids
+            retries:
+                How many times a failed shard is retried before giving up
+            measure_bytes:
+                Record the size of the workers' Mongo commands, see
+                instrument.CommandMonitor
+        """
+
+        self.database = database
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count()
+        self.shard_by = shard_by
+        self.retries = retries
+        self.measure_bytes = measure_bytes
+
+    def run(self, worker, trip_ids, *args):
+        """
+        Input:
+            worker:
+                Module-level function called as worker(db, trip_ids, *args)
+            trip_ids:
+                All trip_id_iso's to process
+            args:
+                Extra arguments passed on to the worker
+        Output: List of the keys of shards that failed every attempt
+        """
+
+        # A few shards per worker keeps the pool busy when shards are uneven
+        shards = shard_trip_ids(trip_ids, self.workers * 4, self.shard_by)
+
+        total = len(trip_ids)
+        done = 0
+        failed = []
+        start = time.time()
+
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                    initializer=_init_worker,
+                                    initargs=(self.host, self.port,
+                                              self.measure_bytes)) as pool:
+
+            pending = {}
+
+            for key, shard in shards.items():
+                future = pool.submit(_run_shard, worker, self.database, shard, args)
+                pending[future] = (key, 0)
+
+            while pending:
+
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+
+                    key, attempt = pending.pop(future)
+
+                    try:
+                        count, seconds, snapshot = future.result()
+
+                    except Exception as error:
+
+                        if attempt < self.retries:
+                            print ("Shard ", key, " failed, retrying: ", error)
+                            retry = pool.submit(_run_shard, worker,
+                                        self.database, shards[key], args)
+                            pending[retry] = (key, attempt + 1)
+                        else:
+                            print ("Shard ", key, " failed: ", error)
+                            failed.append(key)
+
+                        continue
+
+                    # Spans, counters and commands of the shard are added
+                    # to the current stage of this process's report
+                    instrument.RECORDER.merge(snapshot)
+
+                    done += count
+                    elapsed = time.time() - start
+
+                    print ("Processed ", done, " of ", total, " trips, ",
+                            "{0:.1f}".format(done / elapsed), " trips/sec")
+
+        return failed
@@ -0,0 +1,164 @@
+import gc
+import os
+import resource
+from datetime import datetime, timedelta
+
+import src.instrument as instrument
+
+# Service days start at 3am: the latest trips of a day run until about 2:54,
+# and the first ones of the next day leave after that
+SERVICE_DAY_START_HOUR = 3
+
+# Documents this many seconds either side of a window are also read, so that
+# trips and start clusters crossing a window's edge are seen whole
+WINDOW_OVERLAP = 3600
+
+# Documents fetched per round trip when streaming a cursor
+CURSOR_BATCH_SIZE = 1000
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+class MemoryBudget(object):
+    """
+    A limit on the resident memory of the process, checked between units of
+    work such as day windows. Going over the limit raises
+    MemoryBudgetExceeded, rather than letting the machine start swapping.
+    """
+
+    def __init__(self, limit_mb=None):
+        """
+        Input:
+            limit_mb: Resident memory limit in megabytes. None only records
+                the peak
+        """
+
+        self.limit_mb = limit_mb
+        self.peak_mb = 0.0
+
+    def check(self, where=''):
+        """
+        Record resident memory, and raise if it is over the limit even after
+        collecting garbage
+        """
+
+        rss = rss_mb()
+        self.peak_mb = max(self.peak_mb, rss)
+
+        if self.limit_mb is None or rss <= self.limit_mb:
+            return
+
+        gc.collect()
+        rss = rss_mb()
+
+        if rss > self.limit_mb:
+            raise MemoryBudgetExceeded(
+                'Resident memory of {:.0f}MB at {} is over the budget of {}MB. '
+                'Use smaller partition_days or cursor_batch_size'.format(
+                    rss, where or 'a check', self.limit_mb))
+
+    def record(self):
+        """
+        Record the peak resident memory on the current stage's counters
+        """
+
+        instrument.peak('peak_rss_mb', round(self.peak_mb, 1))
+
+
+def rss_mb():
+    """
+    Current resident memory of the process, in megabytes
+    """
+
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+    except (IOError, ValueError):
+        # No /proc, such as on macOS: fall back to the peak, in kilobytes
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def service_day_windows(start_ts, end_ts, days=1):
+    """
+    Split a time range into windows of whole service days
+    Input:
+        start_ts, end_ts: First and last time_stamp of the data
+        days: Number of service days per window
+    Output: List of (start, end) time_stamps, end exclusive
+    """
+
+    first = datetime.fromtimestamp(start_ts)
+    boundary = first.replace(hour=SERVICE_DAY_START_HOUR, minute=0, second=0,
+                                microsecond=0)
+    if boundary > first:
+        boundary -= timedelta(days=1)
+
+    windows = []
+
+    while boundary.timestamp() <= end_ts:
+        next_boundary = boundary + timedelta(days=days)
+        windows.append((boundary.timestamp(), next_boundary.timestamp()))
+        boundary = next_boundary
+
+    return windows
+
+
+def time_range(collection, search):
+    """
+    First and last time_stamp of the documents matching a search, or None if
+    there are none
+    """
+
+    first = list(collection.find(search, {'time_stamp': 1})
+                    .sort('time_stamp', 1).limit(1))
+    last = list(collection.find(search, {'time_stamp': 1})
+                    .sort('time_stamp', -1).limit(1))
+
+    if not first:
+        return None
+
+    return first[0]['time_stamp'], last[0]['time_stamp']
+
+
+def collection_windows(collection, search, days=None):
+    """
+    Day windows covering the documents matching a search
+    Input:
+        days: Service days per window, or None for a single window covering
+            everything
+    Output: List of (start, end) time_stamps, or [None] when not partitioned
+    """
+
+    if not days:
+        return [None]
+
+    span = time_range(collection, search)
+
+    if span is None:
+        return []
+
+    return service_day_windows(span[0], span[1], days)
+
+
+def window_search(search, window, overlap=0):
+    """
+    Add a window's time range, widened by the overlap, to a search
+    """
+
+    if window is None:
+        return search
+
+    search = dict(search)
+    search['time_stamp'] = {'$gte': window[0] - overlap,
+                            '$lt': window[1] + overlap}
+
+    return search
+
+
+def in_window(time_stamp, window):
+
+    return window is None or window[0] <= time_stamp < window[1]
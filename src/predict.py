@@ -0,0 +1,320 @@
+import json
+import pickle
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import numpy as np
+
+
+def save_artifact(models, path):
+    """
+    Save trained models to a single artifact file.
+    Input:
+        models: Dictionary of model name to a dictionary with:
+            model: The fitted regressor, trained on scaled data
+            scaler, scaler_y: The fitted StandardScalers for X and y
+            features: Ordered list of feature names
+            target: Name of the predicted column
+        path: File to write
+    """
+
+    with open(path, 'wb') as f:
+        pickle.dump(models, f)
+
+
+def load_artifact(path):
+    """
+    Load a dictionary of models saved with save_artifact
+    """
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class CompiledModel(object):
+    """
+    A model and its scalers, rearranged so a prediction is a few numpy
+    operations rather than a chain of scikit-learn calls:
+        Linear models fold both scalers into one weight vector and intercept
+        Tree ensembles are flattened into node arrays and walked for all trees
+        at once
+    Anything else falls back to scaling by hand and calling model.predict
+    """
+
+    def __init__(self, name, spec):
+
+        self.name = name
+        self.features = spec['features']
+        self.target = spec.get('target')
+        self.metrics = spec.get('metrics', {})
+
+        model = spec['model']
+        scaler = spec['scaler']
+        scaler_y = spec['scaler_y']
+
+        self.x_mean = scaler.mean_
+        self.x_scale = scaler.scale_
+        self.y_mean = scaler_y.mean_[0]
+        self.y_scale = scaler_y.scale_[0]
+
+        self.model = model
+
+        if hasattr(model, 'coef_') and hasattr(model, 'intercept_'):
+            self.kind = 'linear'
+            self.compile_linear(model)
+
+        elif hasattr(model, 'estimators_') and \
+                all(hasattr(est, 'tree_') for est in model.estimators_):
+            self.kind = 'forest'
+            self.compile_forest(model)
+
+        else:
+            self.kind = 'generic'
+
+    def compile_linear(self, model):
+        """
+        y = ((X - mu) / sigma) @ w + b, rescaled by scaler_y, is just another
+        linear function of X
+        """
+
+        coef = np.ravel(model.coef_)
+        intercept = np.ravel(model.intercept_)[0]
+
+        self.weights = coef / self.x_scale * self.y_scale
+        self.bias = (intercept - np.sum(self.x_mean / self.x_scale * coef)) \
+            * self.y_scale + self.y_mean
+
+    def compile_forest(self, model):
+        """
+        Stack every tree's nodes into (trees, nodes) arrays, padded to the
+        largest tree
+        """
+
+        trees = [est.tree_ for est in model.estimators_]
+        n_nodes = max(tree.node_count for tree in trees)
+        n_trees = len(trees)
+
+        self.left = np.full((n_trees, n_nodes), -1, dtype=np.intp)
+        self.right = np.full((n_trees, n_nodes), -1, dtype=np.intp)
+        self.feature = np.zeros((n_trees, n_nodes), dtype=np.intp)
+        self.threshold = np.zeros((n_trees, n_nodes))
+        self.value = np.zeros((n_trees, n_nodes))
+
+        for idx, tree in enumerate(trees):
+            count = tree.node_count
+            self.left[idx, :count] = tree.children_left
+            self.right[idx, :count] = tree.children_right
+            self.feature[idx, :count] = np.maximum(tree.feature, 0)
+            self.threshold[idx, :count] = tree.threshold
+            self.value[idx, :count] = tree.value[:, 0, 0]
+
+        self.depth = max(tree.max_depth for tree in trees)
+        self.tree_idx = np.arange(n_trees)[:, None]
+
+    def predict_matrix(self, X):
+        """
+        Predict from an unscaled (samples, features) matrix
+        Output: Array of predictions, in the target's units
+        """
+
+        if self.kind == 'linear':
+            return X @ self.weights + self.bias
+
+        X_norm = (X - self.x_mean) / self.x_scale
+
+        if self.kind == 'forest':
+            # scikit-learn compares features as float32
+            X_norm = X_norm.astype(np.float32)
+            samples = np.arange(len(X_norm))[None, :]
+
+            # Walk every tree for every sample, one level at a time
+            node = np.zeros((len(self.tree_idx), len(X_norm)), dtype=np.intp)
+            for _ in range(self.depth):
+                feat = self.feature[self.tree_idx, node]
+                go_left = X_norm[samples, feat] <= self.threshold[self.tree_idx, node]
+                child = np.where(go_left, self.left[self.tree_idx, node],
+                            self.right[self.tree_idx, node])
+                node = np.where(child == -1, node, child)
+
+            y_norm = self.value[self.tree_idx, node].mean(axis=0)
+
+        else:
+            y_norm = np.ravel(self.model.predict(X_norm))
+
+        return y_norm * self.y_scale + self.y_mean
+
+
+class Predictor(object):
+    """
+    In-process prediction service for the total duration and chunk interval
+    models. Keeps the latency of recent requests so it can report percentiles.
+    """
+
+    def __init__(self, artifact_path, history=10000):
+        """
+        Input:
+            artifact_path: Model artifact written by save_artifact
+            history: Number of recent request latencies to keep
+        """
+
+        self.latencies = deque(maxlen=history)
+
+        # Bumped every time models are (re)loaded
+        self.generation = 0
+
+        self.load(artifact_path)
+
+    def load(self, artifact_path):
+        """
+        Load, or reload, the models from an artifact
+        """
+
+        models = load_artifact(artifact_path)
+
+        self.models = {name: CompiledModel(name, spec)
+                        for name, spec in models.items()}
+        self.artifact_path = artifact_path
+        self.generation += 1
+
+    def predict(self, model_name, trips):
+        """
+        Batch prediction.
+        Input:
+            model_name: Name of the model in the artifact
+            trips: List of dictionaries (or a DataFrame) with the model's
+                features
+        Output: List of predicted travel times, in seconds
+        """
+
+        start = time.perf_counter()
+
+        model = self.models[model_name]
+
+        if hasattr(trips, 'columns'):
+            X = trips[model.features].values.astype(float)
+        else:
+            X = np.array([[trip[feat] for feat in model.features]
+                            for trip in trips], dtype=float)
+
+        predictions = model.predict_matrix(X).tolist()
+
+        self.latencies.append(time.perf_counter() - start)
+
+        return predictions
+
+    def latency_stats(self):
+        """
+        p50/p99 request latency, in milliseconds
+        """
+
+        if not self.latencies:
+            return {'requests': 0}
+
+        millis = np.array(self.latencies) * 1000
+
+        return {
+            'requests': len(millis),
+            'p50_ms': float(np.percentile(millis, 50)),
+            'p99_ms': float(np.percentile(millis, 99))
+        }
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(predictor, cache=None):
+    """
+    Build a request handler class serving the given predictor:
+        GET /models: Names and features of the loaded models
+        GET /stats: Latency percentiles, and cache counters
+        POST /predict: {"model": name, "trips": [{feature: value}, ...]}
+            With a cache, requests that also give "route" and "direction",
+            and a min_since_midnight for each trip, are served from it
+        POST /observe: {"route": route, "direction": direction}, when a new
+            trip completes
+    """
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+
+            if self.path == '/models':
+                models = {name: model.features
+                            for name, model in predictor.models.items()}
+                self.send_json(200, models)
+
+            elif self.path == '/stats':
+                stats = predictor.latency_stats()
+                if cache is not None:
+                    stats['cache'] = cache.stats()
+                self.send_json(200, stats)
+
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+
+            if self.path not in ('/predict', '/observe'):
+                self.send_json(404, {'error': 'not found'})
+                return
+
+            length = int(self.headers.get('Content-Length', 0))
+
+            try:
+                request = json.loads(self.rfile.read(length).decode())
+
+                if self.path == '/observe':
+                    if cache is not None:
+                        cache.observe(request['route'], request['direction'])
+                    self.send_json(200, {})
+                    return
+
+                if cache is not None and 'route' in request:
+                    predictions = [cache.predict(request['model'], trip,
+                                        request['route'], request['direction'],
+                                        trip['min_since_midnight'])
+                                    for trip in request['trips']]
+                else:
+                    predictions = predictor.predict(request['model'],
+                                        request['trips'])
+
+            except (ValueError, KeyError, TypeError) as error:
+                self.send_json(400, {'error': repr(error)})
+                return
+
+            self.send_json(200, {'predictions': predictions})
+
+        def log_message(self, format, *args):
+            # Don't print a line per request
+            pass
+
+    return PredictionHandler
+
+
+def serve(predictor, host='127.0.0.1', port=8500, cache=None):
+    """
+    Serve predictions over a small local HTTP front end, optionally through a
+    PredictionCache
+    """
+
+    server = ThreadingHTTPServer((host, port), make_handler(predictor, cache))
+
+    print ("Serving predictions at http://{}:{}/predict".format(host, port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Prefixes of the time of day features, which the bucket stands for: those of
+# the total duration model, and the chunk models' mfn_sq_chnk_N
+TIME_OF_DAY_FEATURES = ('min_since_midnight', 'min_noon_sqr', 'minutes_noon_sqr',
+                        'mfn_sq_chnk_')
+
+
+class PredictionCache(object):
+    """
+    Time-bucketed LRU cache in front of a Predictor.
+    Predictions are keyed by (route, direction, model, departure time bucket),
+    since their inputs only change when a new prior trip completes. Entries
+    expire after a TTL, are evicted least-recently-used past a capacity, and
+    are invalidated when:
+        A newer prior-trip observation arrives for their route and direction
+        The predictor reloads its model artifact
+    """
+
+    def __init__(self, predictor, bucket_minutes=5, capacity=10000, ttl=300,
+                    key_features=None, clock=time.time):
+        """
+        Input:
+            predictor:
+                The Predictor to cache
+            bucket_minutes:
+                Width of the departure time buckets, in min_since_midnight
+            capacity:
+                Most entries kept before evicting the least recently used
+            ttl:
+                Seconds an entry stays valid
+            key_features:
+                Features that vary between requests in the same bucket (such
+                as the trip's own previous chunk) and so must be part of the
+                key. Defaults to each model's features, other than the time of
+                day
+            clock:
+                Function returning the current time, in seconds
+        """
+
+        self.predictor = predictor
+        self.bucket_minutes = bucket_minutes
+        self.capacity = capacity
+        self.ttl = ttl
+        self.key_features = key_features
+        self.clock = clock
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Bumped for a route and direction when a new prior trip completes
+        self.observations = {}
+        self.generation = predictor.generation
+
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0,
+                        'invalidations': 0, 'reloads': 0}
+
+    def observe(self, route, direction):
+        """
+        Record that a trip on this route and direction completed, so cached
+        predictions that used the previous prior trip are stale
+        """
+
+        with self.lock:
+            key = (route, direction)
+            self.observations[key] = self.observations.get(key, 0) + 1
+
+    def predict(self, model_name, trip, route, direction, min_since_midnight):
+        """
+        Predict a single trip, from the cache if possible.
+        Input:
+            model_name: Name of the model in the predictor's artifact
+            trip: Dictionary of the model's features
+            route, direction: The trip's route and direction
+            min_since_midnight: The trip's departure time
+        Output: Predicted travel time, in seconds
+        """
+
+        bucket = int(min_since_midnight // self.bucket_minutes)
+        key = (route, direction, model_name, bucket) + \
+            tuple(trip[feat] for feat in self.model_key_features(model_name))
+
+        now = self.clock()
+
+        with self.lock:
+
+            # A reloaded model makes every entry stale
+            if self.predictor.generation != self.generation:
+                self.counts['reloads'] += 1
+                self.counts['invalidations'] += len(self.entries)
+                self.entries.clear()
+                self.generation = self.predictor.generation
+
+            observed = self.observations.get((route, direction), 0)
+            entry = self.entries.get(key)
+
+            if entry is not None:
+
+                prediction, expires, entry_observed = entry
+
+                if entry_observed != observed:
+                    self.counts['invalidations'] += 1
+                    del self.entries[key]
+                elif expires <= now:
+                    self.counts['expirations'] += 1
+                    del self.entries[key]
+                else:
+                    self.counts['hits'] += 1
+                    self.entries.move_to_end(key)
+                    return prediction
+
+            self.counts['misses'] += 1
+
+        prediction = self.predictor.predict(model_name, [trip])[0]
+
+        with self.lock:
+
+            self.entries[key] = (prediction, now + self.ttl, observed)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+
+        return prediction
+
+    def model_key_features(self, model_name):
+        """
+        The features of a trip that are part of its key for this model
+        """
+
+        if self.key_features is not None:
+            return self.key_features
+
+        features = self.predictor.models[model_name].features
+
+        return [feat for feat in features
+                if not feat.startswith(TIME_OF_DAY_FEATURES)]
+
+    def stats(self):
+        """
+        Hit rate and counters
+        """
+
+        with self.lock:
+
+            stats = dict(self.counts)
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+            stats['size'] = len(self.entries)
+
+        return stats
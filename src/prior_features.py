@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+
+
+def prior_name(column, lag):
+    """
+    Name of a prior-trip feature: 'prior_<column>' for the previous trip,
+    'prior_<lag>_<column>' for trips further back
+    """
+
+    if lag == 1:
+        return 'prior_' + column
+
+    return 'prior_{}_{}'.format(lag, column)
+
+
+def add_prior_features(df, columns, max_lag=1, max_gap=1800,
+                        time_col='start_timestamp', available_col=None,
+                        dropna=True):
+    """
+    Add the values of previous trips as features of each trip, using sorted
+    shifts (or an as-of join) rather than looking up each row's prior.
+    Input:
+        df: DataFrame of trips, such as a duration or chunk interval table
+        columns: Columns to take from prior trips
+        max_lag: How many prior trips to take values from
+        max_gap: Priors that started this many seconds or more before the
+            trip are left empty
+        time_col: Column with the trip start time
+        available_col: Optional column with the time a trip's values become
+            known (for example its end time). If given, the prior is the last
+            trip whose values were known when this trip started, found with an
+            as-of join, and max_lag is ignored
+        dropna: Drop trips without a (first) prior, as the notebooks did
+    Output: DataFrame sorted by time_col, with the prior columns added
+    """
+
+    sort_df = df.sort_values(time_col, kind='mergesort').reset_index(drop=True)
+
+    if available_col is not None:
+        sort_df = asof_prior(sort_df, columns, max_gap, time_col, available_col)
+
+    else:
+        times = sort_df[time_col]
+
+        for lag in range(1, max_lag + 1):
+
+            # Skip priors that started too long before this trip
+            too_old = ~((times - times.shift(lag)) < max_gap)
+
+            priors = sort_df[columns].shift(lag)
+            priors[too_old] = np.nan
+            priors.columns = [prior_name(col, lag) for col in columns]
+
+            sort_df = pd.concat([sort_df, priors], axis=1)
+
+    if dropna:
+        first_priors = [prior_name(col, 1) for col in columns]
+        sort_df = sort_df.dropna(subset=first_priors).reset_index(drop=True)
+
+    return sort_df
+
+
+def asof_prior(sort_df, columns, max_gap, time_col, available_col):
+    """
+    As-of join each trip with the latest trip whose values were available at
+    the trip's start.
+    """
+
+    known = sort_df[[available_col] + columns].dropna(subset=[available_col])
+    known = known.sort_values(available_col, kind='mergesort')
+    known.columns = ['_prior_available'] + [prior_name(col, 1) for col in columns]
+
+    joined = pd.merge_asof(sort_df, known, left_on=time_col,
+                right_on='_prior_available', direction='backward',
+                tolerance=max_gap, allow_exact_matches=True)
+
+    return joined.drop('_prior_available', axis=1)
+
+
+def duration_priors(df, max_lag=1, max_gap=1800, **kwargs):
+    """
+    Prior-trip durations for the total duration table
+    """
+
+    return add_prior_features(df, ['duration'], max_lag=max_lag,
+                max_gap=max_gap, **kwargs)
+
+
+def chunk_priors(df, chunk_interval, max_lag=1, max_gap=1800, **kwargs):
+    """
+    Prior-trip features for every chunk of a chunk interval table, such as
+    prior_seconds_chnk_2
+    """
+
+    features = ['seconds', 'mfn_sq', 'avg_speed']
+    columns = [feature + '_chnk_' + str(seq) for seq in range(1, chunk_interval + 1)
+                for feature in features if feature + '_chnk_' + str(seq) in df]
+
+    return add_prior_features(df, columns, max_lag=max_lag, max_gap=max_gap,
+                **kwargs)
@@ -0,0 +1,297 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+
+# Where profiles are written
+PROFILE_DIR = 'profiles'
+
+
+def frame_key(code):
+    """
+    pstats-style key of a function: (file, first line, name)
+    """
+
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+
+def frame_label(key):
+    """
+    Label of a function in a collapsed stack
+    """
+
+    filename, line, name = key
+
+    return '{} ({}:{})'.format(name, os.path.basename(filename), line)
+
+
+class Sampler(object):
+    """
+    Sampling profiler: a background thread records the call stack of one
+    thread every `interval` seconds. Cheaper than cProfile on code with many
+    small calls, at the cost of only seeing where time is spent statistically.
+    """
+
+    def __init__(self, interval=0.005):
+
+        self.interval = interval
+        self.samples = Counter()
+        self.thread_id = None
+        self.thread = None
+        self.stopped = None
+
+    def enable(self):
+
+        self.thread_id = threading.get_ident()
+
+        # A sampling thread runs for each enable, until disable stops it
+        if self.thread is None:
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.sample,
+                                            args=(self.stopped,), daemon=True)
+            self.thread.start()
+
+    def disable(self):
+
+        if self.thread is None:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def sample(self, stopped):
+
+        # Waiting on the event is the pause between samples, and ends as soon
+        # as the sampler is disabled
+        while not stopped.wait(self.interval):
+
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None:
+                stack.append(frame_key(frame.f_code))
+                frame = frame.f_back
+
+            # Leave out the frames of context managers
+            stack = [key for key in stack if not key[0].endswith('contextlib.py')]
+
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+
+    def create_stats(self):
+        """
+        Build pstats-style stats from the samples, so they can be sorted,
+        printed and saved like cProfile's
+        """
+
+        # The samples are only complete once the sampling thread has stopped
+        self.disable()
+
+        stats = {}
+
+        def entry(key):
+            if key not in stats:
+                stats[key] = [0, 0, 0.0, 0.0, {}]
+            return stats[key]
+
+        for stack, count in self.samples.items():
+
+            seconds = count * self.interval
+
+            # Count each function once per stack, even if it recursed
+            for key in set(stack):
+                func = entry(key)
+                func[0] += count
+                func[1] += count
+                func[3] += seconds
+
+            entry(stack[-1])[2] += seconds
+
+            for caller, callee in zip(stack[:-1], stack[1:]):
+                callers = entry(callee)[4]
+                edge = callers.get(caller, (0, 0, 0.0, 0.0))
+                callers[caller] = (edge[0] + count, edge[1] + count,
+                                    edge[2], edge[3] + seconds)
+
+        self.stats = {key: tuple(value) for key, value in stats.items()}
+
+    def collapsed(self):
+        """
+        Collapsed stacks, one 'root;...;leaf count' line per stack, counted in
+        samples
+        """
+
+        for stack, count in self.samples.items():
+            yield ';'.join(frame_label(key) for key in stack), count
+
+
+def collapse_stats(stats, max_depth=64, min_seconds=0.001):
+    """
+    Collapsed stacks rebuilt from cProfile's caller/callee statistics. Each
+    function's time is split between its callers in proportion to the time
+    each call edge took, so the stacks are estimates, counted in microseconds.
+    Branches under min_seconds are left out, to keep the file small.
+    Input: The stats dictionary of a pstats.Stats
+    Output: Generator of (stack, microseconds)
+    """
+
+    callees = {}
+    for key, (_, _, _, _, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((key, edge[3]))
+
+    # Functions nobody in the profile called are the roots
+    roots = [key for key, value in stats.items() if not value[4]]
+
+    def walk(key, path, seconds):
+
+        total = stats[key][3]
+        if total <= 0 or seconds < min_seconds:
+            return
+
+        share = seconds / total
+        path = path + [frame_label(key)]
+
+        self_us = int(stats[key][2] * share * 1e6)
+        if self_us > 0:
+            yield ';'.join(path), self_us
+
+        if len(path) >= max_depth:
+            return
+
+        for callee, edge_seconds in callees.get(key, []):
+            if frame_label(callee) in path:
+                continue
+            for item in walk(callee, path, edge_seconds * share):
+                yield item
+
+    for root in roots:
+        for item in walk(root, [], stats[root][3]):
+            yield item
+
+
+class StageProfiler(object):
+    """
+    Profiles chosen stages and sub-steps, by the names of their
+    instrument spans, with cProfile or the sampling profiler. Each name's
+    profile accumulates over every time its span is entered. Only one
+    profiled span is active per thread at a time: spans nested in a profiled
+    span are covered by its profile.
+    """
+
+    def __init__(self, stages, mode='cprofile', profile_dir=PROFILE_DIR,
+                    top=20, interval=0.005, prefix=''):
+        """
+        Input:
+            stages:
+                Span names to profile, or ['all'] for every top-level stage
+            mode:
+                'cprofile' for deterministic profiles, or 'sampling'
+            profile_dir:
+                Where .pstats and collapsed stack (.folded) files are written
+            top:
+                Number of functions to print per stage, by cumulative time
+            interval:
+                Seconds between samples of the sampling profiler
+            prefix:
+                Prefix of the file names, such as the script's name
+        """
+
+        self.stages = set(stages)
+        self.mode = mode
+        self.profile_dir = profile_dir
+        self.top = top
+        self.interval = interval
+        self.prefix = prefix
+
+        self.profiles = {}
+        self.local = threading.local()
+
+    def wants(self, name, depth):
+
+        if getattr(self.local, 'active', None) is not None:
+            return False
+
+        return name in self.stages or ('all' in self.stages and depth == 1)
+
+    def start(self, name):
+
+        profile = self.profiles.get(name)
+
+        if profile is None:
+            if self.mode == 'sampling':
+                profile = Sampler(self.interval)
+            else:
+                profile = cProfile.Profile()
+            self.profiles[name] = profile
+
+        self.local.active = name
+        profile.enable()
+
+    def stop(self, name):
+
+        self.profiles[name].disable()
+        self.local.active = None
+
+    def write(self):
+        """
+        Write each profiled stage's .pstats and .folded files, and print its
+        top functions by cumulative time
+        """
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+        for name, profile in self.profiles.items():
+
+            path = os.path.join(self.profile_dir, self.prefix + name)
+
+            stats = pstats.Stats(profile)
+            stats.dump_stats(path + '.pstats')
+
+            if self.mode == 'sampling':
+                stacks = profile.collapsed()
+            else:
+                stacks = collapse_stats(stats.stats)
+
+            with open(path + '.folded', 'w') as f:
+                for stack, count in stacks:
+                    f.write('{} {}\n'.format(stack, count))
+
+            print ("\n")
+            print ("----------------")
+            print ("Profile of ", name, ": ", path + '.pstats')
+            stats.sort_stats('cumulative').print_stats(self.top)
+
+
+def add_profile_arguments(parser):
+    """
+    Add the profiling options to a script's argument parser
+    """
+
+    parser.add_argument('--profile', nargs='+', metavar='STAGE',
+                        help="Profile these stages or sub-steps, by span name "
+                             "(such as label_starts or get_start_labels), or 'all'")
+    parser.add_argument('--profiler', choices=['cprofile', 'sampling'],
+                        default='cprofile')
+    parser.add_argument('--profile-top', type=int, default=20,
+                        help='Number of functions to print per profiled stage')
+    parser.add_argument('--profile-dir', default=PROFILE_DIR)
+    parser.add_argument('--sample-interval', type=float, default=0.005,
+                        help='Seconds between samples of the sampling profiler')
+
+
+def profiler_from_args(args, prefix=''):
+    """
+    A StageProfiler from parsed profiling options, or None if no stage is
+    profiled
+    """
+
+    if not args.profile:
+        return None
+
+    return StageProfiler(args.profile, mode=args.profiler,
+                            profile_dir=args.profile_dir, top=args.profile_top,
+                            interval=args.sample_interval, prefix=prefix)
@@ -0,0 +1,245 @@
+import heapq
+import queue
+import threading
+import time
+from array import array
+from collections import deque
+from datetime import datetime
+
+import numpy as np
+
+from src.extract import AVL_HEADER, parse_avl_line
+
+
+############
+# Sources
+
+def collection_pings(collection, search=None, batch_size=5000):
+    """
+    Stream stored raw AVL pings (such as avl_raw) in time_stamp order
+    """
+
+    cursor = collection.find(search or {}, {'_id': 0}).sort('time_stamp')
+
+    return cursor.batch_size(batch_size)
+
+
+def read_day_file(path, header=AVL_HEADER):
+    """
+    Read an original AVL day file, sorted by time_stamp. The sort is stable,
+    so each vehicle's pings keep their order.
+    """
+
+    pings = []
+
+    with open(path) as f:
+        for line in f:
+
+            line = line.strip()
+
+            # Skip blank lines and the header
+            if not line or line.startswith('REV'):
+                continue
+
+            pings.append(parse_avl_line(line.split(","), header))
+
+    pings.sort(key=lambda ping: ping['time_stamp'])
+
+    return pings
+
+
+def first_time_stamp(path):
+    """
+    The earliest time_stamp of an AVL day file, without keeping its pings.
+    Only the REPORT_TIME's numbers are compared, which order the same way as
+    their time_stamps.
+    Output: The time_stamp, or None for a file without pings
+    """
+
+    earliest = None
+
+    with open(path) as f:
+        for line in f:
+
+            line = line.strip()
+
+            if not line or line.startswith('REV'):
+                continue
+
+            date, clock = line.split(",", 2)[1].split()
+            month, day, year = date.split('/')
+            hour, minute, second = clock.split(':')
+            key = (int(year), int(month), int(day), int(hour), int(minute),
+                    int(second))
+
+            if earliest is None or key < earliest:
+                earliest = key
+
+    if earliest is None:
+        return None
+
+    return datetime(*earliest).timestamp()
+
+
+def file_pings(paths, header=AVL_HEADER):
+    """
+    Stream pings from several day files, merged in time_stamp order.
+    Each file is only read once the merge reaches its first time_stamp, and let
+    go once its pings have been streamed, so only the files overlapping the
+    current time are held in memory: usually one day, plus its neighbour
+    around midnight.
+    """
+
+    starts = [(first_time_stamp(path), order, path)
+                for order, path in enumerate(paths)]
+    pending = deque(sorted(start for start in starts if start[0] is not None))
+
+    # The next ping of every open file, ordered by time_stamp then file, so
+    # ties keep the order the files were given in
+    heads = []
+
+    def open_file():
+
+        _, order, path = pending.popleft()
+        pings = iter(read_day_file(path, header))
+
+        ping = next(pings, None)
+        if ping is not None:
+            heapq.heappush(heads, (ping['time_stamp'], order, ping, pings))
+
+    while heads or pending:
+
+        # Open every file starting no later than the next ping to stream
+        while pending and (not heads or pending[0][0] <= heads[0][0]):
+            open_file()
+
+        _, order, ping, pings = heapq.heappop(heads)
+
+        yield ping
+
+        ping = next(pings, None)
+        if ping is not None:
+            heapq.heappush(heads, (ping['time_stamp'], order, ping, pings))
+
+
+############
+# Replay
+
+class Replayer(object):
+    """
+    Re-emits pings in time_stamp order at a chosen speed-up, handing them to a
+    consumer on its own thread. Measures how far the consumer lags behind the
+    replay clock, its throughput, and how big its backlog gets.
+    """
+
+    def __init__(self, consumer, speedup=1.0, max_backlog=100000,
+                    report_every=100000):
+        """
+        Input:
+            consumer:
+                Function called with each ping, such as TripStream.process
+            speedup:
+                How many times faster than real time to replay. None replays
+                as fast as possible
+            max_backlog:
+                Pings waiting for the consumer before the replay has to wait
+            report_every:
+                Print progress every this many pings
+        """
+
+        self.consumer = consumer
+        self.speedup = speedup
+        self.report_every = report_every
+
+        self.backlog = queue.Queue(maxsize=max_backlog)
+
+        # Lag, in seconds, of every consumed ping behind when it was due
+        self.lags = array('d')
+        self.backlog_sizes = array('l')
+        self.errors = 0
+
+    def consume(self):
+
+        while True:
+
+            item = self.backlog.get()
+
+            if item is None:
+                return
+
+            ping, due = item
+
+            try:
+                self.consumer(ping)
+            except Exception:
+                self.errors += 1
+
+            self.lags.append(time.perf_counter() - due)
+
+    def run(self, pings):
+        """
+        Replay the pings, blocking until the consumer has caught up
+        Output: Dictionary of replay statistics
+        """
+
+        worker = threading.Thread(target=self.consume)
+        worker.start()
+
+        wall_start = time.perf_counter()
+        first_ts = None
+        last_ts = None
+        count = 0
+
+        for ping in pings:
+
+            ts = ping['time_stamp']
+
+            if first_ts is None:
+                first_ts = ts
+
+            last_ts = ts
+
+            # When this ping is due, on the replay clock
+            if self.speedup:
+                due = wall_start + (ts - first_ts) / self.speedup
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            else:
+                due = time.perf_counter()
+
+            self.backlog_sizes.append(self.backlog.qsize())
+            self.backlog.put((ping, due))
+            count += 1
+
+            if count % self.report_every == 0:
+                print ("Replayed ", count, " pings, backlog ",
+                        self.backlog.qsize())
+
+        self.backlog.put(None)
+        worker.join()
+
+        wall = time.perf_counter() - wall_start
+
+        return self.stats(count, wall, first_ts, last_ts)
+
+    def stats(self, count, wall, first_ts, last_ts):
+
+        if count == 0:
+            return {'pings': 0}
+
+        lags = np.frombuffer(self.lags, dtype=float)
+        backlog = np.frombuffer(self.backlog_sizes, dtype=self.backlog_sizes.typecode)
+
+        return {
+            'pings': count,
+            'errors': self.errors,
+            'wall_seconds': wall,
+            'replayed_seconds': last_ts - first_ts,
+            'throughput_per_sec': count / wall if wall else float('inf'),
+            'lag_p50_ms': float(np.percentile(lags, 50) * 1000),
+            'lag_p99_ms': float(np.percentile(lags, 99) * 1000),
+            'lag_max_ms': float(lags.max() * 1000),
+            'backlog_mean': float(backlog.mean()),
+            'backlog_max': int(backlog.max())
+        }
@@ -2,90 +2,177 @@ import pandas as pd
 # Turn off the pandas chained assignment warning
 pd.options.mode.chained_assignment = None
 
-from geopy import distance
+import json
+import os
 
 import pymongo
 from pymongo import MongoClient
 
-def get_dist(row, stop_tuple):
+import src.gtfs as gtfs
+from src.geo import project_xy_onto_polyline
+from src.fingerprint import file_stamps, fingerprint_files, fingerprint_values
+
+# Where sample schedules are cached, one per route/direction/period/pattern
+SCHEDULE_DIR = 'data/schedules'
+
+
+def schedule_path(gtfs_dir, bus, direction, pattern):
+    """
+    Path of the cached sample schedule for a route, direction, GTFS period and
+    stop pattern
     """
-    Function for finding the distance between a sequential stop and
-    shape points along the route.
-    Intended to be applied to the shapes DataFrame
+
+    name = '{}_{}_{}_{}.csv'.format(gtfs_dir, bus, direction, pattern)
+
+    return os.path.join(SCHEDULE_DIR, name)
+
+
+def cached_schedule(gtfs_dir, bus, direction, trips_print, stamps):
     """
+    Find a cached sample schedule built from the same labeled trips and
+    untouched GTFS files, without reading the GTFS files
+    Output: Path of the schedule csv, or None
+    """
+
+    prefix = '{}_{}_{}_'.format(gtfs_dir, bus, direction)
+
+    if not os.path.isdir(SCHEDULE_DIR):
+        return None
+
+    for name in sorted(os.listdir(SCHEDULE_DIR)):
+
+        if not (name.startswith(prefix) and name.endswith('.json')):
+            continue
+
+        manifest_path = os.path.join(SCHEDULE_DIR, name)
+        out_path = manifest_path[:-5] + '.csv'
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
 
-    shape_lat = float(row['shape_pt_lat'])
-    shape_lon = float(row['shape_pt_lon'])
-    return distance.distance((shape_lat, shape_lon), stop_tuple).m
+        if manifest.get('trips_fingerprint') == trips_print and \
+                manifest.get('gtfs_stamps') == stamps and \
+                os.path.exists(out_path):
+            return out_path
 
+    return None
 
-def create_sample_schedule(gtfs_period, trip_collection):
+
+def create_sample_schedule(gtfs_period, trip_collection, bus, direction):
+    """
+    Builds a schedule of the stops of the longest trip in the trip collection,
+    with the distance of each stop along the trip's shape.
+    The schedule is cached, and only rebuilt if the GTFS files or the longest
+    trip's stop pattern change. If neither the labeled trips nor the GTFS
+    files' modification times changed, the GTFS files aren't read at all.
+    Input:
+        gtfs_period: Index of the gtfs_lookup file to use
+        trip_collection: Collection of labeled trips
+        bus, direction: Route and direction the trips belong to
+    Output: Path of the sample schedule csv
+    """
 
     # Load in all the data
     trip_ids = trip_collection.distinct('trip_id')
 
-    gtfs_lkup = pd.read_csv('data/gtfs_lookup.csv')
-    gtfs_dir = gtfs_lkup.iloc[gtfs_period]['directory']
+    gtfs_dir = gtfs.gtfs_directory(gtfs_period)
+
+    shapes_txt = gtfs.table_path(gtfs_dir, 'shapes')
+    sched_txt = gtfs.table_path(gtfs_dir, 'stop_times')
+    trips_txt = gtfs.table_path(gtfs_dir, 'trips')
+    stops_txt = gtfs.table_path(gtfs_dir, 'stops')
+    gtfs_txts = [shapes_txt, sched_txt, trips_txt, stops_txt]
 
-    shapes_txt = 'data/gtfs/{}/shapes.txt'.format(gtfs_dir)
-    shapes = pd.read_csv(shapes_txt)
+    trips_print = fingerprint_values(sorted(trip_ids))
+    stamps = file_stamps(gtfs_txts)
 
-    sched_txt = 'data/gtfs/{}/stop_times.txt'.format(gtfs_dir)
-    sched = pd.read_csv(sched_txt)
+    out_path = cached_schedule(gtfs_dir, bus, direction, trips_print, stamps)
 
-    trips_txt = 'data/gtfs/{}/trips.txt'.format(gtfs_dir)
-    trips = pd.read_csv(trips_txt)
+    if out_path is not None:
+        print ("Using cached sample schedule ", out_path)
+        return out_path
 
-    stops_txt = 'data/gtfs/{}/stops.txt'.format(gtfs_dir)
-    stops = pd.read_csv(stops_txt)
+    sched = gtfs.read_table(gtfs_dir, 'stop_times')
 
     # Get a sample trip with the longest route possible
     sched_trips = sched[sched['trip_id'].isin(trip_ids)]
     seq_max_idx = sched_trips['stop_sequence'].idxmax()
     samp_trip_id = sched_trips.loc[seq_max_idx]['trip_id']
 
-    # Get the schedule of our sample trip, and get the columns we want
+    # Get the schedule of our sample trip
     samp_sched = sched_trips[sched_trips['trip_id'] == samp_trip_id]
+    samp_sched = samp_sched.sort_values('stop_sequence')
+
+    # Look for a cached schedule with the same stop pattern, built from the
+    # same GTFS files
+    pattern = fingerprint_values(samp_sched['stop_id'].tolist())[:12]
+    gtfs_print = fingerprint_files(gtfs_txts)
+
+    out_path = schedule_path(gtfs_dir, bus, direction, pattern)
+    manifest_path = out_path[:-4] + '.json'
+
+    if os.path.exists(out_path) and os.path.exists(manifest_path):
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        if manifest['gtfs_fingerprint'] == gtfs_print:
+
+            # Remember these trips and stamps, for a quicker check next time
+            manifest['trips_fingerprint'] = trips_print
+            manifest['gtfs_stamps'] = stamps
+
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f)
+
+            print ("Using cached sample schedule ", out_path)
+            return out_path
+
+    shapes = gtfs.read_table(gtfs_dir, 'shapes')
+    trips = gtfs.read_table(gtfs_dir, 'trips')
+    stops = gtfs.read_table(gtfs_dir, 'stops')
+
+    # Get the columns we want from the sample schedule
     small_sched = samp_sched[['stop_id', 'stop_sequence']]
     small_sched.reset_index(drop=True, inplace=True)
     small_sched['seq_str'] = small_sched['stop_sequence'].astype(str);
 
-    # Lookup the shape ID of our sample trip
+    # Lookup the shape ID of our sample trip, with its points in order
     shape_id = trips[trips['trip_id'] == samp_trip_id]['shape_id'].values[0]
     trip_shape = shapes[shapes['shape_id'] == shape_id]
-
-    # Iterate over our sample schedule, getting info for each row
-    stops_distances = []
-    stop_lat = []
-    stop_lon = []
-    stop_name = []
-
-    for idx, stp_srs in small_sched.iterrows():
-
-        # Get the details of the stops
-        stp_id = stp_srs['stop_id']
-        stp_dtls = stops[stops['stop_id'] == stp_id]
-
-        stop_name.append(stp_dtls['stop_name'].values[0])
-
-        # Get the stop lat/lon
-        stp_lat = float(stp_dtls['stop_lat'])
-        stp_lon = float(stp_dtls['stop_lon'])
-        stop_lat.append(stp_lat)
-        stop_lon.append(stp_lon)
-        stop_coords = (stp_lat, stp_lon)
-
-        # Get the distance from the stop to each shape. Choose the closest.
-        trip_shape['stop_dist'] = trip_shape.apply\
-            (lambda row: get_dist(row, stop_coords), axis=1)
-        closest_idx = trip_shape['stop_dist'].idxmin()
-        stops_distances.append\
-            (trip_shape.loc[closest_idx]['shape_dist_traveled'])
-
-    # Assign this values to columns in our small DataFrame
-    small_sched['stop_distance'] = stops_distances
-    small_sched['stop_lat'] = stop_lat
-    small_sched['stop_lon'] = stop_lon
-    small_sched['stop_name'] = stop_name
-
-    small_sched.to_csv('data/scheduled_stop_info.csv', index=False)
+    trip_shape = trip_shape.sort_values('shape_pt_sequence')
+
+    # Get the details of every stop at once
+    stop_cols = ['stop_id', 'stop_lat', 'stop_lon', 'stop_name', 'stop_x',
+                    'stop_y']
+    small_sched = small_sched.merge(stops[stop_cols], on='stop_id', how='left')
+
+    # Project each stop onto the shape, and interpolate how far along the
+    # shape it is
+    small_sched['stop_distance'] = project_xy_onto_polyline(
+        trip_shape['shape_pt_x'].values, trip_shape['shape_pt_y'].values,
+        trip_shape['shape_dist_traveled'].values,
+        small_sched['stop_x'].values, small_sched['stop_y'].values)
+
+    small_sched = small_sched[['stop_id', 'stop_sequence', 'seq_str',
+        'stop_distance', 'stop_lat', 'stop_lon', 'stop_name', 'stop_x',
+        'stop_y']]
+
+    os.makedirs(SCHEDULE_DIR, exist_ok=True)
+    small_sched.to_csv(out_path, index=False)
+
+    manifest = {
+        'gtfs_directory': gtfs_dir,
+        'bus': bus,
+        'direction': direction,
+        'sample_trip_id': int(samp_trip_id),
+        'pattern': pattern,
+        'gtfs_fingerprint': gtfs_print,
+        'trips_fingerprint': trips_print,
+        'gtfs_stamps': stamps
+    }
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+
+    return out_path
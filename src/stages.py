@@ -0,0 +1,382 @@
+import os
+
+import src.extract as extract
+import src.label_starts as label_starts
+import src.label_trips as label_trips
+import src.sample_schedule as smpl_schd
+import src.build_chunks as bld_chnks
+import src.chunk_trips as chnk_trps
+import src.trip_chunk_collections as trp_chnks_coll
+import src.parallel as parallel
+import src.feature_store as ftr_store
+import src.gtfs as gtfs
+import src.headways as headways
+import src.stop_events as stop_events
+import src.partition as partition
+from src.orchestrator import Orchestrator, Stage
+
+# The stages of pipeline.py, extracting and labeling trips. chunk_data.py runs
+# everything after them
+LABEL_STAGES = ['extract', 'label_starts', 'label_trips']
+
+
+def gtfs_files(*names):
+    """
+    Input files from the parameters' GTFS period, for fingerprinting
+    """
+
+    def files(params):
+
+        gtfs_dir = gtfs.gtfs_directory(params['gtfs_period'])
+
+        paths = [gtfs.GTFS_LOOKUP]
+        for name in names:
+            path = name if name.startswith('data/') \
+                else gtfs.table_path(gtfs_dir, name)
+            if os.path.exists(path):
+                paths.append(path)
+
+        return paths
+
+    return files
+
+
+def feature_dir(params):
+    """
+    Where the feature tables of the parameters' route are written
+    """
+
+    return params.get('feature_dir', ftr_store.FEATURE_DIR)
+
+
+def memory_budget(params):
+    """
+    The budget on resident memory of the stages that work a window of days at
+    a time
+    """
+
+    return partition.MemoryBudget(params.get('memory_budget_mb'))
+
+
+def partition_options(params):
+    """
+    Keyword arguments of the labelers for working a window of days at a time
+    """
+
+    return {'partition_days': params.get('partition_days'),
+            'batch_size': params.get('cursor_batch_size',
+                            partition.CURSOR_BATCH_SIZE),
+            'budget': memory_budget(params)}
+
+
+def chunk_collection_name(chunk_interval):
+
+    return "chunk_" + str(chunk_interval) + "_collection"
+
+
+def headway_collection_name(chunk_interval):
+
+    return "headway_" + str(chunk_interval) + "_collection"
+
+
+############
+# Stages
+# Each runs as run(ctx, stages), and clears what it is about to rewrite
+
+def run_extract(ctx, stages):
+
+    params = ctx['params']
+    raw_coll = ctx['db'][params['avl_collection']]
+
+    raw_coll.delete_many({});
+
+    extractor = extract.Extractor(raw_coll, gtfs_period=params['gtfs_period'],
+                    days=params['ftp_days'], bus=params['bus'],
+                    direction=params['direction'],
+                    cache_dir=params.get('avl_cache_dir'))
+    extractor.run()
+
+    # Not every route runs in both directions, or in every period
+    if extractor.filter_count == 0:
+        raise ValueError('No AVL data for route {} in direction {}'.format(
+                            params['bus'], params['direction']))
+
+    return {'lines_kept': extractor.filter_count}
+
+
+def run_label_starts(ctx, stages):
+
+    params = ctx['params']
+    label_coll = ctx['db'][params['labeled_collection']]
+
+    label_coll.delete_many({});
+
+    start_labeler = label_starts.StartLabeler(ctx['db'][params['avl_collection']],
+                        label_coll, gtfs_period=params['gtfs_period'],
+                        direction=params['direction'],
+                        overlap=params.get('partition_overlap',
+                                    partition.WINDOW_OVERLAP),
+                        **partition_options(params))
+    start_labeler.label_single_starts()
+
+
+def run_label_trips(ctx, stages):
+
+    params = ctx['params']
+
+    trip_labeler = label_trips.TripLabeler(ctx['db'][params['avl_collection']],
+                        ctx['db'][params['labeled_collection']],
+                        gtfs_period=params['gtfs_period'],
+                        direction=params['direction'],
+                        **partition_options(params))
+    trip_labeler.label_trips()
+
+    return {'good': trip_labeler.good_trip_count}
+
+
+def run_sample_schedule(ctx, stages):
+
+    params = ctx['params']
+
+    # Create the sample schedule with distances, or reuse the cached one for
+    # this route
+    schedule_path = smpl_schd.create_sample_schedule(params['gtfs_period'],
+                        ctx['db'][params['labeled_collection']],
+                        bus=params['bus'], direction=params['direction'])
+
+    return {'schedule_path': schedule_path}
+
+
+def run_build_chunks(ctx, stages):
+
+    params = ctx['params']
+    chunk_coll = ctx['db'][params['chunk_collection']]
+    chunks = [stage.interval for stage in stages]
+
+    chunk_coll.delete_many({'number_chunks': {'$in': chunks}});
+
+    schedule_path = ctx['orchestrator'].result('sample_schedule')['schedule_path']
+
+    # Get details, such as the average stop, for each interval of the data
+    chunky = bld_chnks.ChunkBuilder(ctx['db'][params['labeled_collection']],
+                chunk_coll, chunks, schedule_path=schedule_path)
+    chunky.get_chunk_info()
+
+
+def run_chunk_trips(ctx, stages):
+
+    params = ctx['params']
+    db = ctx['db']
+    labeled_collection = params['labeled_collection']
+    label_coll = db[labeled_collection]
+    chunks = [stage.interval for stage in stages]
+
+    # Clear the old labels of the intervals being chunked
+    for chunk_interval in chunks:
+        field = 'chunk_' + str(chunk_interval)
+        label_coll.update_many({field: {'$exists': True}}, {'$unset': {field: ''}})
+
+    # For each trip, label which documents belong to which chunks
+    # Each trip's documents are loaded once and labeled for every chunk
+    # interval, with the updates sent in bulk
+    print ("\n")
+    print ("Labelling trip documents with chunks ", chunks)
+
+    budget = memory_budget(params)
+
+    # Trips are chunked a window of days at a time, by when they started
+    for window in partition.collection_windows(label_coll, {'trip_start': 1},
+                        params.get('partition_days')):
+
+        trips = label_coll.distinct('trip_id_iso',
+                    partition.window_search({'trip_start': 1}, window))
+
+        if db.shared:
+            # Trips are split into shards and processed on a pool of worker
+            # processes, each with its own database connection
+            executor = parallel.ShardedExecutor(params['database'], host=db.host,
+                            port=db.port, workers=params.get('workers'),
+                            shard_by=params.get('shard_by', 'hash'),
+                            measure_bytes=params.get('measure_command_bytes', False))
+            failed = executor.run(chnk_trps.chunk_trip_shard, trips,
+                            labeled_collection, params['chunk_collection'], chunks)
+
+            if failed:
+                raise RuntimeError('Chunking failed for shards {}'.format(failed))
+
+        else:
+            # In-memory collections only exist in this process
+            chnk_trps.chunk_trip_shard(db, trips, labeled_collection,
+                            params['chunk_collection'], chunks)
+
+        budget.check('chunk_trips')
+
+    budget.record()
+
+
+def run_duration_features(ctx, stages):
+
+    params = ctx['params']
+    label_coll = ctx['db'][params['labeled_collection']]
+    duration_coll = ctx['db'][params['duration_collection']]
+
+    # Total Trip Duration, Time of Day
+    print ("Getting trip data based on total trip duration")
+
+    duration_coll.delete_many({});
+    trp_chnks_coll.temporal_features_total(label_coll.distinct('trip_id_iso'),
+                        label_coll, duration_coll)
+
+    # Also write the table to the feature store, for fast loading when training
+    ftr_store.write_collection(params['duration_collection'], duration_coll,
+                    feature_dir(params))
+
+
+def run_chunk_features(ctx, stages):
+
+    params = ctx['params']
+    db = ctx['db']
+    label_coll = db[params['labeled_collection']]
+    chunk_interval = stages[0].interval
+
+    print ("Getting trip data based on ", chunk_interval, " chunks")
+
+    coll_str = chunk_collection_name(chunk_interval)
+    output_collection = db[coll_str]
+
+    output_collection.delete_many({});
+
+    # All chunks of all trips are grouped in a single aggregation
+    trp_chnks_coll.chunk_data_interval(label_coll.distinct('trip_id_iso'),
+                        label_coll, db[params['chunk_collection']],
+                        output_collection, chunk_interval)
+
+    print ("Trips inserted into collection: ", coll_str)
+
+    ftr_store.write_collection(coll_str, output_collection, feature_dir(params))
+
+
+def run_headways(ctx, stages):
+
+    params = ctx['params']
+    db = ctx['db']
+    chunk_interval = stages[0].interval
+
+    # Headway and bunching features, from the vehicles ahead at each chunk stop
+    headway_str = headway_collection_name(chunk_interval)
+    headway_collection = db[headway_str]
+
+    headway_collection.delete_many({});
+
+    headways.headway_data_interval(db[params['labeled_collection']],
+                headway_collection, chunk_interval,
+                window=params.get('headway_window', 3))
+
+    ftr_store.write_collection(headway_str, headway_collection,
+                    feature_dir(params))
+
+
+def run_stop_events(ctx, stages):
+
+    params = ctx['params']
+    db = ctx['db']
+    event_str = params.get('event_collection', 'stop_events')
+    event_collection = db[event_str]
+
+    event_collection.delete_many({});
+
+    schedule_path = ctx['orchestrator'].result('sample_schedule')['schedule_path']
+
+    # When every trip passed every stop of the sample schedule, a day at a
+    # time unless partitioned otherwise
+    print ("Getting stop events of every trip")
+
+    stop_events.stop_event_data(db[params['labeled_collection']],
+                event_collection, schedule_path,
+                days=params.get('partition_days') or 1,
+                batch_size=params.get('cursor_batch_size',
+                                partition.CURSOR_BATCH_SIZE),
+                budget=memory_budget(params))
+
+    ftr_store.write_feature_table(event_str,
+                stop_events.arrival_frame(event_collection, schedule_path),
+                root=feature_dir(params))
+
+
+def pipeline_stages(params):
+    """
+    The pipeline as a DAG, with a build_chunks, chunk_trips, chunk_features
+    and headways stage per chunk interval, so adding an interval only runs
+    the new interval's stages
+    Output: List of Stage's, each after the stages it depends on
+    """
+
+    chunks = params['chunks']
+
+    stages = [
+        Stage('extract', run_extract,
+                params=['gtfs_period', 'ftp_days', 'bus', 'direction',
+                        'avl_collection'],
+                files=gtfs_files('routes', 'trips',
+                        'data/lookUpBlockIDToBlockNumNam.csv')),
+        Stage('label_starts', run_label_starts, deps=['extract'],
+                params=['gtfs_period', 'direction', 'labeled_collection',
+                        'partition_days', 'partition_overlap'],
+                files=gtfs_files('trips', 'stop_times', 'stops', 'calendar',
+                        'calendar_dates')),
+        # Trips the labeler rejects have their starts deleted, so the starts
+        # are relabeled every time trips are
+        Stage('label_trips', run_label_trips, deps=['label_starts'],
+                params=['gtfs_period', 'direction', 'partition_days'],
+                shares=['label_starts'],
+                files=gtfs_files('trips', 'stop_times', 'stops')),
+        Stage('sample_schedule', run_sample_schedule, deps=['label_trips'],
+                params=['gtfs_period', 'bus', 'direction'],
+                files=gtfs_files('shapes', 'stop_times', 'trips', 'stops'))
+    ]
+
+    for chunk_interval in chunks:
+        stages.append(Stage('build_chunks_{}'.format(chunk_interval),
+                        run_build_chunks, deps=['sample_schedule'],
+                        params=['chunk_collection'], batch='build_chunks',
+                        interval=chunk_interval))
+
+    # Trips are chunked for every changed interval in one pass
+    for chunk_interval in chunks:
+        stages.append(Stage('chunk_trips_{}'.format(chunk_interval),
+                        run_chunk_trips,
+                        deps=['build_chunks_{}'.format(chunk_interval)],
+                        batch='chunk_trips', interval=chunk_interval))
+
+    stages.append(Stage('stop_events', run_stop_events,
+                    deps=['label_trips', 'sample_schedule'],
+                    params=['labeled_collection', 'event_collection',
+                            'partition_days', 'cursor_batch_size',
+                            'feature_dir']))
+
+    stages.append(Stage('duration_features', run_duration_features,
+                    deps=['label_trips'],
+                    params=['duration_collection', 'feature_dir']))
+
+    for chunk_interval in chunks:
+        stages.append(Stage('chunk_features_{}'.format(chunk_interval),
+                        run_chunk_features,
+                        deps=['chunk_trips_{}'.format(chunk_interval)],
+                        params=['feature_dir'], interval=chunk_interval))
+        stages.append(Stage('headways_{}'.format(chunk_interval), run_headways,
+                        deps=['chunk_trips_{}'.format(chunk_interval)],
+                        params=['headway_window', 'feature_dir'],
+                        interval=chunk_interval))
+
+    return stages
+
+
+def last_schedule_path(db, params):
+    """
+    Path of the sample schedule built by the last run of the sample_schedule
+    stage, for the scripts that follow a route live
+    """
+
+    runner = Orchestrator(pipeline_stages(params), db, params)
+
+    return runner.result('sample_schedule')['schedule_path']
@@ -0,0 +1,250 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+import src.gtfs as gtfs
+import src.instrument as instrument
+import src.partition as partition
+from src.geo import add_xy_columns, docs_xy, project_xy_onto_polyline
+
+# Trips start and end within a radius of their first and last stops, so stops
+# this many meters before a trip's first ping, or after its last, are given
+# the time of that ping
+REACH_TOLERANCE = 150
+
+
+def schedule_line(schedule_path, schedule):
+    """
+    The polyline the sample schedule's stop_distance's are measured along:
+    the shape of its sample trip, from the schedule's manifest. Schedules
+    without a manifest use the line through their stops.
+    Input:
+        schedule_path: Path of the sample schedule, from create_sample_schedule
+        schedule: The schedule's DataFrame
+    Output: Arrays of the x, y and distance along the line of each vertex
+    """
+
+    manifest_path = schedule_path[:-4] + '.json'
+
+    if os.path.exists(manifest_path):
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        gtfs_dir = manifest['gtfs_directory']
+        trips = gtfs.read_table(gtfs_dir, 'trips')
+        shapes = gtfs.read_table(gtfs_dir, 'shapes')
+
+        shape_id = trips[trips['trip_id'] == manifest['sample_trip_id']] \
+                    ['shape_id'].values[0]
+        shape = shapes[shapes['shape_id'] == shape_id] \
+                    .sort_values('shape_pt_sequence')
+
+        return (shape['shape_pt_x'].values, shape['shape_pt_y'].values,
+                shape['shape_dist_traveled'].values)
+
+    if 'stop_x' not in schedule.columns:
+        schedule = schedule.copy()
+        add_xy_columns(schedule, 'stop')
+
+    return (schedule['stop_x'].values, schedule['stop_y'].values,
+            schedule['stop_distance'].values)
+
+
+def trip_pings(trip_collection, trip_ids, batch_size=partition.CURSOR_BATCH_SIZE):
+    """
+    The pings of some trips, with their projected x/y
+    Output: DataFrame of trip_id_iso, time_stamp, x and y, sorted by trip and
+        time
+    """
+
+    fields = {'trip_id_iso': 1, 'time_stamp': 1, 'x': 1, 'y': 1,
+                'LATITUDE': 1, 'LONGITUDE': 1}
+    docs = list(trip_collection.find({'trip_id_iso': {'$in': list(trip_ids)}},
+                    fields).batch_size(batch_size))
+
+    if not docs:
+        return pd.DataFrame(columns=['trip_id_iso', 'time_stamp', 'x', 'y'])
+
+    xs, ys = docs_xy(docs)
+
+    pings = pd.DataFrame({
+        'trip_id_iso': [doc['trip_id_iso'] for doc in docs],
+        'time_stamp': np.array([doc['time_stamp'] for doc in docs], dtype=float),
+        'x': xs,
+        'y': ys
+    })
+
+    return pings.sort_values(['trip_id_iso', 'time_stamp'], kind='stable') \
+                .reset_index(drop=True)
+
+
+def stop_arrivals(pings, line, stop_distances):
+    """
+    When each trip passed each stop, for many trips at once.
+    Pings are projected onto the line, and made monotone per trip, as buses
+    don't go backwards but GPS noise does. The time at each stop's distance is
+    then interpolated between the first pings to reach the distances either
+    side of it. Every trip is interpolated in one call, by laying the trips
+    end to end along a single axis.
+    Input:
+        pings: DataFrame from trip_pings
+        line: (x, y, distance) arrays from schedule_line
+        stop_distances: Distance along the line of each stop
+    Output:
+        trip_ids: Array of the trips' trip_id_iso
+        starts: Array of the time_stamp of each trip's first ping
+        arrivals: Array of (trips, stops) seconds after the start that each
+            trip passed each stop, NaN for stops the trip didn't cover
+    """
+
+    stop_distances = np.asarray(stop_distances, dtype=float)
+
+    codes, trip_ids = pd.factorize(pings['trip_id_iso'], sort=True)
+    times = pings['time_stamp'].values
+
+    # Distance along the line of every ping, never decreasing within a trip
+    along = project_xy_onto_polyline(line[0], line[1], line[2],
+                pings['x'].values, pings['y'].values)
+    along = pd.Series(along).groupby(codes).cummax().values
+
+    # Only keep the first ping to reach each distance, so the distances are
+    # strictly increasing within each trip and a bus waiting at a stop gets
+    # the time it arrived
+    first = np.ones(len(along), dtype=bool)
+    first[1:] = (codes[1:] != codes[:-1]) | (along[1:] > along[:-1])
+
+    codes = codes[first]
+    along = along[first]
+    times = times[first]
+
+    # First and last ping of each trip, which is also where it is nearest and
+    # furthest along the line
+    trip_first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    trip_last = np.r_[trip_first[1:] - 1, len(codes) - 1]
+    reach_lo = along[trip_first]
+    reach_hi = along[trip_last]
+
+    # Lay the trips end to end: each is offset by more than the length of the
+    # line, so one interpolation covers them all without them overlapping
+    span = along.max() - along.min() + 1
+    offsets = np.arange(len(trip_ids)) * span
+
+    query = np.clip(stop_distances[None, :], reach_lo[:, None],
+                        reach_hi[:, None]) + offsets[:, None]
+
+    arrivals = np.interp(query.ravel(), along + offsets[codes], times) \
+                .reshape(len(trip_ids), len(stop_distances))
+
+    starts = times[trip_first]
+    arrivals -= starts[:, None]
+
+    covered = (stop_distances[None, :] >= reach_lo[:, None] - REACH_TOLERANCE) \
+            & (stop_distances[None, :] <= reach_hi[:, None] + REACH_TOLERANCE)
+    arrivals[~covered] = np.nan
+
+    return np.asarray(trip_ids), starts, arrivals
+
+
+def event_docs(trip_ids, starts, arrivals, schedule_name):
+    """
+    One document per trip, with its arrival at each stop of the schedule as a
+    list of whole seconds after its start (None for stops it didn't cover)
+    """
+
+    docs = []
+
+    for trip_id_iso, start, row in zip(trip_ids, starts, arrivals):
+
+        covered = ~np.isnan(row)
+
+        docs.append({
+            'trip_id_iso': str(trip_id_iso),
+            'start_time': float(start),
+            'schedule': schedule_name,
+            'stops_covered': int(covered.sum()),
+            'arrivals': [int(round(sec)) if ok else None
+                            for sec, ok in zip(row.tolist(), covered.tolist())]
+        })
+
+    return docs
+
+
+def stop_event_data(trip_collection, event_collection, schedule_path,
+                        days=1, batch_size=partition.CURSOR_BATCH_SIZE,
+                        budget=None):
+    """
+    Find when every labeled trip passed every stop of the sample schedule, and
+    insert a document per trip into the event collection.
+    The trips starting in each window of days are processed in one batch.
+    Input:
+        trip_collection: Collection of labeled trip documents
+        event_collection: Collection the trips' stop events are inserted into
+        schedule_path: Sample schedule, from create_sample_schedule
+        days: Service days per batch
+        batch_size: Documents fetched per round trip
+        budget: MemoryBudget checked after each batch
+    """
+
+    budget = budget or partition.MemoryBudget()
+
+    schedule = pd.read_csv(schedule_path)
+    line = schedule_line(schedule_path, schedule)
+    stop_distances = schedule['stop_distance'].values
+    schedule_name = os.path.basename(schedule_path)
+
+    for window in partition.collection_windows(trip_collection,
+                        {'trip_start': 1}, days):
+
+        trips = trip_collection.distinct('trip_id_iso',
+                    partition.window_search({'trip_start': 1}, window))
+
+        if not trips:
+            continue
+
+        with instrument.span('trip_pings'):
+            pings = trip_pings(trip_collection, trips, batch_size)
+
+        if pings.empty:
+            continue
+
+        with instrument.span('stop_arrivals'):
+            trip_ids, starts, arrivals = stop_arrivals(pings, line,
+                                            stop_distances)
+
+        event_collection.insert_many(event_docs(trip_ids, starts, arrivals,
+                                        schedule_name))
+
+        instrument.count('event_trips', len(trip_ids))
+        instrument.count('stop_events', int((~np.isnan(arrivals)).sum()))
+
+        budget.check('stop_events')
+
+    budget.record()
+
+
+def arrival_frame(event_collection, schedule_path):
+    """
+    The stop events of every trip as a table, for deriving chunk times,
+    durations or stop-level features
+    Output: DataFrame with one row per trip: trip_id_iso, start_time, and
+        the seconds after the start it passed each stop, as stop_<sequence>
+    """
+
+    schedule = pd.read_csv(schedule_path)
+    columns = ['stop_{}'.format(seq) for seq in schedule['stop_sequence']]
+
+    events = list(event_collection.find({}, {'trip_id_iso': 1, 'start_time': 1,
+                                                'arrivals': 1}))
+
+    arrivals = np.array([[np.nan if sec is None else sec
+                            for sec in event['arrivals']] for event in events],
+                        dtype=float).reshape(len(events), len(columns))
+
+    frame = pd.DataFrame(arrivals, columns=columns)
+    frame.insert(0, 'trip_id_iso', [event['trip_id_iso'] for event in events])
+    frame.insert(1, 'start_time', [event['start_time'] for event in events])
+
+    return frame
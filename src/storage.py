@@ -0,0 +1,1315 @@
+import copy
+import os
+import pickle
+from datetime import datetime
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from bson import ObjectId
+from pymongo import MongoClient, InsertOne, UpdateOne, UpdateMany, \
+    ReplaceOne, DeleteOne, DeleteMany
+
+# Where the in-memory storage is saved between scripts
+MEMORY_PATH = 'data/memory_db'
+
+
+def open_storage(params, event_listeners=None):
+    """
+    Open the storage named by the 'storage' parameter: 'mongo' (the default)
+    or 'memory'. Either one is indexed by collection name, like a pymongo
+    database.
+    Input:
+        params: The parameters, with 'database', and optionally 'storage',
+            'mongo_host', 'mongo_port' and 'memory_path'
+        event_listeners: pymongo command listeners, for Mongo storage
+    """
+
+    if params.get('storage', 'mongo') == 'memory':
+        return MemoryStorage(params.get('memory_path', MEMORY_PATH))
+
+    return MongoStorage(params['database'], params.get('mongo_host', 'localhost'),
+                            params.get('mongo_port', 27017), event_listeners)
+
+
+class MongoStorage(object):
+    """
+    Storage on a MongoDB server. Collections are pymongo collections.
+    """
+
+    # Worker processes can open their own connections to the same data
+    shared = True
+
+    def __init__(self, database, host='localhost', port=27017,
+                    event_listeners=None):
+
+        self.host = host
+        self.port = port
+        self.name = database
+
+        self.client = MongoClient(host, port,
+                            event_listeners=event_listeners or [])
+        self.db = self.client[database]
+
+    def __getitem__(self, name):
+
+        return self.db[name]
+
+    def save(self):
+        """
+        Nothing to do, the server keeps the data
+        """
+
+        pass
+
+
+class MemoryStorage(object):
+    """
+    Storage in the memory of the current process, with columnar collections,
+    so a whole pipeline can run without a database. Collections can be saved
+    to and loaded from a directory, one pickle per collection, to pass data
+    from one script to the next.
+    """
+
+    # Collections only exist in this process
+    shared = False
+
+    def __init__(self, path=None):
+        """
+        Input:
+            path: Directory the storage is saved to, and loaded from if it
+                exists
+        """
+
+        self.path = path
+        self.name = os.path.basename(path) if path else 'memory'
+        self.collections = {}
+
+        if path and os.path.isdir(path):
+            self.load(path)
+
+    def __getitem__(self, name):
+
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(name, self)
+
+        return self.collections[name]
+
+    def list_collection_names(self):
+
+        return list(self.collections.keys())
+
+    def drop_collection(self, name):
+
+        self.collections.pop(name, None)
+
+    def save(self, path=None):
+        """
+        Save every collection to a directory
+        """
+
+        path = path or self.path
+        os.makedirs(path, exist_ok=True)
+
+        for name, collection in self.collections.items():
+            with open(os.path.join(path, name + '.pkl'), 'wb') as f:
+                pickle.dump(collection.dump(), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+
+        for file_name in os.listdir(path):
+
+            if not file_name.endswith('.pkl'):
+                continue
+
+            with open(os.path.join(path, file_name), 'rb') as f:
+                state = pickle.load(f)
+
+            self[file_name[:-4]].restore(state)
+
+
+############
+# Columns
+
+class _Missing(object):
+    """
+    Marks a field a document doesn't have
+    """
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return (_missing, ())
+
+
+def _missing():
+    return MISSING
+
+
+MISSING = _Missing()
+
+
+def is_number(value):
+
+    return isinstance(value, (int, float, np.integer, np.floating)) \
+        and not isinstance(value, (bool, np.bool_))
+
+
+def is_null(value):
+
+    return value is None or value is MISSING \
+        or (isinstance(value, float) and value != value)
+
+
+def to_array(values):
+    """
+    Turn a list of field values into a numpy array, and a mask of which
+    documents have the field. Numeric fields become float arrays, with NaN for
+    nulls, everything else an object array.
+    """
+
+    present = np.fromiter((value is not MISSING for value in values), dtype=bool,
+                            count=len(values))
+
+    if all(is_number(value) or value is None or value is MISSING
+            for value in values):
+        array = np.fromiter((np.nan if value is None or value is MISSING
+                                else value for value in values),
+                            dtype=float, count=len(values))
+    else:
+        array = np.empty(len(values), dtype=object)
+        for idx, value in enumerate(values):
+            array[idx] = value
+
+    return array, present
+
+
+class Column(object):
+    """
+    The values of one field, as a list that is cheap to append to and update,
+    with a cached numpy array for vectorized queries. The array is updated in
+    place on writes where possible, and extended when documents are added.
+    """
+
+    def __init__(self, size=0):
+
+        self.values = [MISSING] * size
+        self.array = None
+        self.present = None
+        self.codes = None
+
+    def append(self, value):
+
+        self.values.append(value)
+        self.codes = None
+
+    def set(self, row, value):
+
+        self.values[row] = value
+        self.codes = None
+
+        if self.array is None or row >= len(self.array):
+            return
+
+        if self.array.dtype == object:
+            self.array[row] = value
+        elif is_number(value) or value is None or value is MISSING:
+            self.array[row] = np.nan if value is None or value is MISSING else value
+        else:
+            # A non-numeric value in a numeric column
+            self.array = None
+            return
+
+        self.present[row] = value is not MISSING
+
+    def arrays(self):
+        """
+        Output: The column's values as an array, and the mask of documents
+        that have the field
+        """
+
+        size = len(self.values)
+
+        if self.array is not None and len(self.array) < size:
+
+            tail, tail_present = to_array(self.values[len(self.array):])
+
+            if self.array.dtype == object or tail.dtype != object:
+                self.array = np.concatenate([self.array, tail.astype(self.array.dtype)])
+                self.present = np.concatenate([self.present, tail_present])
+            else:
+                self.array = None
+
+        if self.array is None:
+            self.array, self.present = to_array(self.values)
+
+        return self.array, self.present
+
+    def integral(self):
+        """
+        Whether every value of a numeric column is an integer
+        """
+
+        return all(isinstance(value, (int, np.integer)) for value in self.values
+                    if value is not None and value is not MISSING)
+
+    def factorized(self):
+        """
+        Integer codes of an object column's values, and the code of each value,
+        so equality and $in tests compare integers
+        """
+
+        if self.codes is None:
+            array, _ = self.arrays()
+            codes, uniques = pd.factorize(array)
+            self.codes = (codes, {value: code for code, value in enumerate(uniques)})
+
+        return self.codes
+
+
+############
+# Queries
+
+def compare(array, present, op, value):
+    """
+    Evaluate a comparison operator against a whole column. Values of another
+    type than the operand, such as strings against a number, don't match.
+    """
+
+    if op not in ('$gt', '$gte', '$lt', '$lte'):
+        raise NotImplementedError('Unsupported query operator ' + op)
+
+    def test(left):
+        try:
+            if op == '$gt':
+                return left > value
+            if op == '$gte':
+                return left >= value
+            if op == '$lt':
+                return left < value
+            return left <= value
+        except TypeError:
+            return False
+
+    if array.dtype != object:
+        if not is_number(value):
+            return np.zeros(len(array), dtype=bool)
+        with np.errstate(invalid='ignore'):
+            return test(array) & present
+
+    return np.fromiter((not is_null(left) and bool(test(left)) for left in array),
+                        dtype=bool, count=len(array))
+
+
+def equals(array, present, value, column=None):
+
+    if is_null(value):
+        if array.dtype == object:
+            return ~present | np.fromiter((is_null(item) for item in array),
+                                            dtype=bool, count=len(array))
+        return ~present | np.isnan(array)
+
+    if array.dtype != object:
+        if not is_number(value):
+            return np.zeros(len(array), dtype=bool)
+        return array == value
+
+    if column is not None:
+        codes, lookup = column.factorized()
+        try:
+            code = lookup.get(value)
+        except TypeError:
+            code = None
+        else:
+            if code is None:
+                return np.zeros(len(array), dtype=bool)
+            return codes == code
+
+    return np.fromiter((item == value for item in array), dtype=bool,
+                        count=len(array))
+
+
+def is_in(array, present, values, column=None):
+
+    values = list(values)
+    mask = np.zeros(len(array), dtype=bool)
+
+    if any(is_null(value) for value in values):
+        mask |= equals(array, present, None)
+
+    values = [value for value in values if not is_null(value)]
+
+    if array.dtype != object:
+        numbers = [value for value in values if is_number(value)]
+        return mask | np.isin(array, numbers)
+
+    if column is not None:
+        codes, lookup = column.factorized()
+        wanted = [lookup[value] for value in values if value in lookup]
+        return mask | np.isin(codes, wanted)
+
+    return mask | pd.Series(array).isin(values).values
+
+
+def query_mask(query, get_column, size):
+    """
+    Evaluate a Mongo query on columns, all documents at once
+    Input:
+        query: Query document, such as {'time_stamp': {'$gt': 10}}
+        get_column: Function of a field name, returning its array, presence
+            mask, and optionally its Column
+        size: Number of documents
+    Output: Boolean mask of the matching documents
+    """
+
+    mask = np.ones(size, dtype=bool)
+
+    for field, condition in (query or {}).items():
+
+        if field == '$or':
+            sub = np.zeros(size, dtype=bool)
+            for clause in condition:
+                sub |= query_mask(clause, get_column, size)
+            mask &= sub
+            continue
+
+        if field == '$and':
+            for clause in condition:
+                mask &= query_mask(clause, get_column, size)
+            continue
+
+        if field == '$nor':
+            for clause in condition:
+                mask &= ~query_mask(clause, get_column, size)
+            continue
+
+        array, present, column = get_column(field)
+
+        if isinstance(condition, dict) and condition \
+                and all(key.startswith('$') for key in condition):
+
+            for op, value in condition.items():
+
+                if op == '$exists':
+                    mask &= present if value else ~present
+                elif op == '$eq':
+                    mask &= equals(array, present, value, column)
+                elif op == '$ne':
+                    mask &= ~equals(array, present, value, column)
+                elif op == '$in':
+                    mask &= is_in(array, present, value, column)
+                elif op == '$nin':
+                    mask &= ~is_in(array, present, value, column)
+                else:
+                    mask &= compare(array, present, op, value)
+
+        else:
+            mask &= equals(array, present, condition, column)
+
+    return mask
+
+
+############
+# Aggregation expressions
+
+def frame_column(frame, field):
+    """
+    A DataFrame column as an array and presence mask, for query_mask
+    """
+
+    if field not in frame.columns:
+        return (np.full(len(frame), np.nan), np.zeros(len(frame), dtype=bool), None)
+
+    series = frame[field]
+
+    if series.dtype.kind in 'iufb':
+        array = series.to_numpy(dtype=float)
+        return array, ~np.isnan(array), None
+
+    array = series.to_numpy(dtype=object)
+
+    return array, series.notna().to_numpy(), None
+
+
+def numeric(value):
+
+    if isinstance(value, pd.Series) and value.dtype.kind not in 'iufbmM':
+        return pd.to_numeric(value, errors='coerce')
+
+    return value
+
+
+def to_date(value):
+
+    if isinstance(value, pd.Series):
+        return pd.to_datetime(value)
+
+    return pd.Timestamp(value)
+
+
+def date_part(frame, args, part):
+    """
+    $hour or $minute of a date, optionally in a timezone
+    """
+
+    timezone = None
+
+    if isinstance(args, dict) and 'date' in args:
+        timezone = args.get('timezone')
+        args = args['date']
+
+    dates = to_date(evaluate(frame, args))
+
+    if not isinstance(dates, pd.Series):
+        dates = pd.Series([dates] * len(frame), index=frame.index)
+
+    if timezone:
+        dates = dates.dt.tz_localize('UTC').dt.tz_convert(timezone)
+
+    return getattr(dates.dt, part)
+
+
+def evaluate(frame, expression):
+    """
+    Evaluate an aggregation expression over every row of a DataFrame
+    Output: A Series, or a scalar for constant expressions
+    """
+
+    if isinstance(expression, str) and expression.startswith('$'):
+        field = expression[1:]
+        if field in frame.columns:
+            return frame[field]
+        return pd.Series([None] * len(frame), index=frame.index, dtype=object)
+
+    if isinstance(expression, list):
+        return [evaluate(frame, item) for item in expression]
+
+    if not isinstance(expression, dict) or not expression:
+        return expression
+
+    op, args = next(iter(expression.items()))
+
+    if op == '$literal':
+        return args
+
+    if op == '$cond':
+        if isinstance(args, dict):
+            args = [args['if'], args['then'], args['else']]
+        test, then, other = [evaluate(frame, arg) for arg in args]
+        test = pd.Series(test, index=frame.index).fillna(False).astype(bool)
+        then = pd.Series(then, index=frame.index) if not isinstance(then, pd.Series) else then
+        other = pd.Series(other, index=frame.index) if not isinstance(other, pd.Series) else other
+        return then.astype(object).where(test, other.astype(object))
+
+    if op in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte'):
+        left, right = [evaluate(frame, arg) for arg in args]
+        if isinstance(left, pd.Series) and left.dtype == object \
+                and is_number(right):
+            left = numeric(left)
+        result = {
+            '$eq': lambda: left == right,
+            '$ne': lambda: left != right,
+            '$gt': lambda: left > right,
+            '$gte': lambda: left >= right,
+            '$lt': lambda: left < right,
+            '$lte': lambda: left <= right
+        }[op]()
+        return pd.Series(result, index=frame.index) if not isinstance(result, pd.Series) else result
+
+    if op in ('$and', '$or'):
+        values = [pd.Series(evaluate(frame, arg), index=frame.index).fillna(False).astype(bool)
+                    for arg in args]
+        result = values[0]
+        for value in values[1:]:
+            result = result & value if op == '$and' else result | value
+        return result
+
+    if op == '$ifNull':
+        value, default = [evaluate(frame, arg) for arg in args]
+        return value.where(value.notna(), default)
+
+    if op == '$add':
+        values = [evaluate(frame, arg) for arg in args]
+        dates = [value for value in values if isinstance(value, datetime)]
+        numbers = [numeric(value) for value in values if not isinstance(value, datetime)]
+
+        total = numbers[0] if numbers else 0
+        for value in numbers[1:]:
+            total = total + value
+
+        # A date plus numbers is a date, the numbers being milliseconds
+        if dates:
+            return pd.Timestamp(dates[0]) + pd.to_timedelta(total, unit='ms')
+
+        return total
+
+    if op == '$subtract':
+        left, right = [numeric(evaluate(frame, arg)) for arg in args]
+        return left - right
+
+    if op == '$multiply':
+        values = [numeric(evaluate(frame, arg)) for arg in args]
+        total = values[0]
+        for value in values[1:]:
+            total = total * value
+        return total
+
+    if op == '$divide':
+        left, right = [numeric(evaluate(frame, arg)) for arg in args]
+        return left / right
+
+    if op == '$toDouble':
+        value = evaluate(frame, args[0] if isinstance(args, list) else args)
+        if isinstance(value, pd.Series):
+            return pd.to_numeric(value, errors='coerce').astype(float)
+        return float(value)
+
+    if op == '$hour':
+        return date_part(frame, args, 'hour')
+
+    if op == '$minute':
+        return date_part(frame, args, 'minute')
+
+    raise NotImplementedError('Unsupported aggregation operator ' + op)
+
+
+def as_series(frame, value):
+
+    if isinstance(value, pd.Series):
+        return value
+
+    return pd.Series([value] * len(frame), index=frame.index, dtype=object)
+
+
+def group_stage(frame, spec):
+    """
+    $group: one row per distinct _id, with its accumulators
+    """
+
+    group_id = spec['_id']
+    work = pd.DataFrame(index=frame.index)
+
+    if isinstance(group_id, dict):
+        keys = ['_id.' + key for key in group_id]
+        for key, expression in group_id.items():
+            work['_id.' + key] = as_series(frame, evaluate(frame, expression)).astype(object)
+    else:
+        keys = ['_id']
+        work['_id'] = as_series(frame, evaluate(frame, group_id)).astype(object)
+
+    accumulators = {}
+    firsts_lasts = {}
+
+    for name, accumulator in spec.items():
+
+        if name == '_id':
+            continue
+
+        op, expression = next(iter(accumulator.items()))
+        value = as_series(frame, evaluate(frame, expression))
+
+        if op in ('$min', '$max', '$avg', '$sum'):
+            value = numeric(value) if op in ('$avg', '$sum') else value
+            if value.dtype == object:
+                converted = pd.to_numeric(value, errors='coerce',
+                                dtype_backend='numpy_nullable')
+                if converted.notna().sum() == value.notna().sum():
+                    value = converted
+
+        work[name] = value
+
+        # pandas' first and last skip nulls, where Mongo's don't, so they are
+        # taken from each group's first and last row instead
+        if op in ('$first', '$last'):
+            firsts_lasts[name] = op
+            continue
+
+        accumulators[name] = {'$min': 'min', '$max': 'max', '$avg': 'mean',
+                                '$sum': 'sum'}[op]
+
+    if firsts_lasts:
+        work['__first_row'] = np.arange(len(work))
+        work['__last_row'] = np.arange(len(work))
+        accumulators['__first_row'] = 'min'
+        accumulators['__last_row'] = 'max'
+
+    # Null keys are their own group, as in Mongo
+    filled = work[keys].fillna('__null__')
+    for key in keys:
+        work[key] = filled[key]
+
+    grouped = work.groupby(keys, sort=False)
+
+    if accumulators:
+        result = grouped.agg(accumulators).reset_index()
+    else:
+        result = grouped.size().reset_index()[keys]
+
+    if firsts_lasts:
+        for name, op in firsts_lasts.items():
+            row = result['__first_row' if op == '$first' else '__last_row']
+            result[name] = work[name].values[row.values]
+        result = result.drop(columns=['__first_row', '__last_row'])
+
+    for key in keys:
+        result[key] = result[key].where(result[key] != '__null__', None)
+
+    return result
+
+
+def sorted_positions(frame, keys):
+    """
+    Positions of a frame's rows sorted on (field, direction) keys as Mongo
+    sorts them: nulls and missing values come before every other value, so
+    first ascending and last descending
+    Output: Array of row positions
+    """
+
+    order = frame.reset_index(drop=True)
+
+    # A stable sort per key, least significant first
+    for key, direction in reversed(keys):
+
+        # A field no document has doesn't change the order
+        if key not in order.columns:
+            continue
+
+        order = order.sort_values(key, ascending=direction == 1,
+                    kind='mergesort',
+                    na_position='first' if direction == 1 else 'last')
+
+    return order.index.values
+
+
+def project_stage(frame, spec):
+    """
+    $project: keep, drop or compute fields
+    """
+
+    include_id = spec.get('_id', 1) not in (0, False)
+    id_columns = [col for col in frame.columns
+                    if col == '_id' or col.startswith('_id.')]
+
+    fields = {key: value for key, value in spec.items() if key != '_id'}
+
+    # Only exclusions: keep everything else
+    if fields and all(value in (0, False) for value in fields.values()):
+        drop = list(fields.keys()) + ([] if include_id else id_columns)
+        return frame.drop(columns=[col for col in drop if col in frame.columns])
+
+    result = pd.DataFrame(index=frame.index)
+
+    if include_id:
+        for col in id_columns:
+            result[col] = frame[col]
+
+    for key, value in fields.items():
+
+        if value in (1, True):
+            if key in frame.columns:
+                result[key] = frame[key]
+        else:
+            result[key] = as_series(frame, evaluate(frame, value))
+
+    return result
+
+
+def frame_records(frame):
+    """
+    Turn an aggregation frame back into documents, with nested _id's and plain
+    Python values
+    """
+
+    records = []
+    id_keys = [col for col in frame.columns if col.startswith('_id.')]
+
+    for record in frame.astype(object).to_dict('records'):
+
+        doc = {}
+
+        if id_keys:
+            doc['_id'] = {key[4:]: plain(record.pop(key)) for key in id_keys}
+
+        for key, value in record.items():
+            doc[key] = plain(value)
+
+        records.append(doc)
+
+    return records
+
+
+def plain(value):
+
+    if isinstance(value, float) and value != value:
+        return None
+    if value is pd.NaT or value is pd.NA:
+        return None
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+
+    return value
+
+
+############
+# Collections
+
+class MemoryCursor(object):
+    """
+    The result of a find, supporting sort, skip, limit and batch_size
+    """
+
+    def __init__(self, collection, query=None, projection=None):
+
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sort_keys = []
+        self.skip_count = 0
+        self.limit_count = 0
+        self.results = None
+
+    def sort(self, key, direction=1):
+
+        if isinstance(key, (list, tuple)):
+            self.sort_keys = list(key)
+        else:
+            self.sort_keys = [(key, direction)]
+
+        return self
+
+    def skip(self, count):
+
+        self.skip_count = count
+        return self
+
+    def limit(self, count):
+
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size):
+
+        return self
+
+    def rows(self):
+
+        rows = self.collection.match_rows(self.query)
+
+        if self.sort_keys and len(rows):
+
+            order = pd.DataFrame({key: self.collection.column_values(key, rows)
+                                    for key, _ in self.sort_keys})
+            rows = rows[sorted_positions(order, self.sort_keys)]
+
+        rows = rows[self.skip_count:]
+
+        if self.limit_count:
+            rows = rows[:self.limit_count]
+
+        return rows
+
+    def distinct(self, field):
+
+        return self.collection.distinct(field, self.query)
+
+    def __iter__(self):
+
+        fields = self.collection.projected_fields(self.projection)
+
+        for row in self.rows():
+            yield self.collection.document(row, fields)
+
+
+class MemoryCollection(object):
+    """
+    A collection held as columns, with the subset of pymongo's collection API
+    that the pipeline uses. Queries are evaluated on numpy arrays of the
+    queried fields, and lookups by _id go through a dictionary.
+    """
+
+    def __init__(self, name, database):
+
+        self.name = name
+        self.database = database
+
+        self.ids = []
+        self.rows_by_id = {}
+        self.alive = Column()
+        self.columns = {}
+        self.deleted = 0
+
+    ############
+    # Storage
+
+    def __len__(self):
+
+        return len(self.ids)
+
+    def dump(self):
+
+        self.compact(force=True)
+
+        return {'ids': self.ids,
+                'columns': {name: col.values for name, col in self.columns.items()}}
+
+    def restore(self, state):
+
+        self.__init__(self.name, self.database)
+
+        self.ids = list(state['ids'])
+        self.rows_by_id = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self.alive.values = [1] * len(self.ids)
+
+        for name, values in state['columns'].items():
+            column = Column()
+            column.values = list(values)
+            self.columns[name] = column
+
+    def compact(self, force=False):
+        """
+        Drop deleted documents once they make up half the collection
+        """
+
+        if not self.deleted or (not force and self.deleted * 2 < len(self.ids)):
+            return
+
+        keep = [row for row, alive in enumerate(self.alive.values) if alive]
+
+        self.ids = [self.ids[row] for row in keep]
+        self.rows_by_id = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self.alive = Column()
+        self.alive.values = [1] * len(keep)
+
+        for name, column in list(self.columns.items()):
+            values = [column.values[row] for row in keep]
+            self.columns[name] = Column()
+            self.columns[name].values = values
+
+        self.deleted = 0
+
+    def get_column(self, field):
+
+        if field == '_id':
+            array = np.empty(len(self.ids), dtype=object)
+            for idx, doc_id in enumerate(self.ids):
+                array[idx] = doc_id
+            return array, np.ones(len(self.ids), dtype=bool), None
+
+        column = self.columns.get(field)
+
+        if column is None:
+            return (np.full(len(self.ids), np.nan), np.zeros(len(self.ids), dtype=bool),
+                    None)
+
+        array, present = column.arrays()
+
+        return array, present, column
+
+    def column_values(self, field, rows):
+
+        array, present, _ = self.get_column(field)
+        values = array[rows]
+
+        if values.dtype == object:
+            values = np.where(present[rows], values, None)
+
+        return values
+
+    def match_rows(self, query):
+        """
+        Rows of the live documents matching a query, in insertion order
+        """
+
+        rows = self.id_rows(query)
+        if rows is not None:
+            return rows
+
+        alive, _ = self.alive.arrays()
+        mask = alive == 1
+
+        if query:
+            mask &= query_mask(query, self.get_column, len(self.ids))
+
+        return np.flatnonzero(mask)
+
+    def id_rows(self, query):
+        """
+        Rows of a query on _id alone, without scanning
+        """
+
+        if not query or list(query.keys()) != ['_id']:
+            return None
+
+        condition = query['_id']
+
+        if isinstance(condition, dict):
+            if list(condition.keys()) != ['$in']:
+                return None
+            ids = condition['$in']
+        else:
+            ids = [condition]
+
+        rows = sorted(set(self.rows_by_id[doc_id] for doc_id in ids
+                            if doc_id in self.rows_by_id))
+
+        return np.array(rows, dtype=int)
+
+    def projected_fields(self, projection):
+
+        fields = ['_id'] + list(self.columns.keys())
+
+        if not projection:
+            return fields
+
+        included = [key for key, value in projection.items()
+                        if value and key != '_id']
+
+        if included:
+            fields = ['_id'] + included
+        else:
+            fields = [field for field in fields if projection.get(field, 1)]
+
+        if not projection.get('_id', 1) and '_id' in fields:
+            fields.remove('_id')
+
+        return fields
+
+    def document(self, row, fields):
+
+        doc = {}
+
+        for field in fields:
+
+            if field == '_id':
+                doc['_id'] = self.ids[row]
+                continue
+
+            column = self.columns.get(field)
+            if column is None:
+                continue
+
+            value = column.values[row]
+            if value is not MISSING:
+                doc[field] = copy.deepcopy(value) if isinstance(value, (dict, list)) \
+                    else value
+
+        return doc
+
+    def set_field(self, row, field, value):
+
+        column = self.columns.get(field)
+
+        if column is None:
+            column = self.columns[field] = Column(len(self.ids))
+
+        if isinstance(value, (dict, list)):
+            value = copy.deepcopy(value)
+
+        column.set(row, value)
+
+    def append(self, doc):
+
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+
+        doc_id = doc['_id']
+
+        if doc_id in self.rows_by_id:
+            raise ValueError('Duplicate _id {}'.format(doc_id))
+
+        row = len(self.ids)
+        self.ids.append(doc_id)
+        self.rows_by_id[doc_id] = row
+        self.alive.append(1)
+
+        for field, column in self.columns.items():
+            if field not in doc:
+                column.append(MISSING)
+
+        for field, value in doc.items():
+
+            if field == '_id':
+                continue
+
+            if field not in self.columns:
+                self.columns[field] = Column(row)
+
+            if isinstance(value, (dict, list)):
+                value = copy.deepcopy(value)
+
+            self.columns[field].append(value)
+
+        return doc_id
+
+    def apply_update(self, row, update):
+
+        for op, fields in update.items():
+
+            if op == '$set':
+                for field, value in fields.items():
+                    if field != '_id':
+                        self.set_field(row, field, value)
+
+            elif op == '$unset':
+                for field in fields:
+                    if field in self.columns:
+                        self.columns[field].set(row, MISSING)
+
+            elif op == '$inc':
+                for field, value in fields.items():
+                    current = self.columns[field].values[row] \
+                        if field in self.columns else MISSING
+                    current = 0 if current is MISSING else current
+                    self.set_field(row, field, current + value)
+
+            else:
+                raise NotImplementedError('Unsupported update operator ' + op)
+
+    def upsert_document(self, query, update):
+
+        doc = {key: value for key, value in (query or {}).items()
+                if not key.startswith('$') and not isinstance(value, dict)}
+
+        for field, value in update.get('$set', {}).items():
+            doc[field] = value
+
+        return self.append(doc)
+
+    ############
+    # Reads
+
+    def find(self, filter=None, projection=None, **kwargs):
+
+        return MemoryCursor(self, filter, projection)
+
+    def find_one(self, filter=None, projection=None):
+
+        for doc in self.find(filter, projection).limit(1):
+            return doc
+
+        return None
+
+    def distinct(self, key, filter=None):
+
+        rows = self.match_rows(filter)
+
+        if key == '_id':
+            return [self.ids[row] for row in rows]
+
+        column = self.columns.get(key)
+        if column is None:
+            return []
+
+        values = []
+        seen = set()
+
+        for row in rows:
+            value = column.values[row]
+            if value is MISSING:
+                continue
+            try:
+                if value in seen:
+                    continue
+                seen.add(value)
+            except TypeError:
+                if value in values:
+                    continue
+            values.append(value)
+
+        return values
+
+    def count_documents(self, filter=None):
+
+        return len(self.match_rows(filter))
+
+    def estimated_document_count(self):
+
+        return len(self.ids) - self.deleted
+
+    ############
+    # Writes
+
+    def insert_one(self, document):
+
+        return SimpleNamespace(inserted_id=self.append(document))
+
+    def insert_many(self, documents, ordered=True):
+
+        return SimpleNamespace(inserted_ids=[self.append(doc) for doc in documents])
+
+    def update_one(self, filter, update, upsert=False):
+
+        rows = self.match_rows(filter)
+
+        if len(rows):
+            self.apply_update(rows[0], update)
+            return SimpleNamespace(matched_count=1, modified_count=1,
+                                    upserted_id=None)
+
+        upserted_id = self.upsert_document(filter, update) if upsert else None
+
+        return SimpleNamespace(matched_count=0, modified_count=0,
+                                upserted_id=upserted_id)
+
+    def update_many(self, filter, update, upsert=False):
+
+        rows = self.match_rows(filter)
+
+        for row in rows:
+            self.apply_update(row, update)
+
+        upserted_id = None
+        if upsert and not len(rows):
+            upserted_id = self.upsert_document(filter, update)
+
+        return SimpleNamespace(matched_count=len(rows), modified_count=len(rows),
+                                upserted_id=upserted_id)
+
+    def replace_one(self, filter, replacement, upsert=False):
+
+        rows = self.match_rows(filter)
+
+        if len(rows):
+            row = rows[0]
+            for field, column in self.columns.items():
+                if field not in replacement:
+                    column.set(row, MISSING)
+            for field, value in replacement.items():
+                if field != '_id':
+                    self.set_field(row, field, value)
+            return SimpleNamespace(matched_count=1, modified_count=1,
+                                    upserted_id=None)
+
+        upserted_id = self.append(dict(replacement)) if upsert else None
+
+        return SimpleNamespace(matched_count=0, modified_count=0,
+                                upserted_id=upserted_id)
+
+    def delete_rows(self, rows):
+
+        for row in rows:
+            del self.rows_by_id[self.ids[row]]
+            self.alive.set(row, 0)
+
+        self.deleted += len(rows)
+        self.compact()
+
+        return SimpleNamespace(deleted_count=len(rows))
+
+    def delete_one(self, filter):
+
+        return self.delete_rows(self.match_rows(filter)[:1])
+
+    def delete_many(self, filter):
+
+        return self.delete_rows(self.match_rows(filter))
+
+    def drop(self):
+
+        self.database.drop_collection(self.name)
+        self.__init__(self.name, self.database)
+
+    def bulk_write(self, requests, ordered=True):
+        """
+        Apply pymongo bulk operations (InsertOne, UpdateOne, UpdateMany,
+        ReplaceOne, DeleteOne, DeleteMany)
+        """
+
+        for request in requests:
+
+            if isinstance(request, InsertOne):
+                self.insert_one(request._doc)
+            elif isinstance(request, UpdateOne):
+                self.update_one(request._filter, request._doc, request._upsert)
+            elif isinstance(request, UpdateMany):
+                self.update_many(request._filter, request._doc, request._upsert)
+            elif isinstance(request, ReplaceOne):
+                self.replace_one(request._filter, request._doc, request._upsert)
+            elif isinstance(request, DeleteOne):
+                self.delete_one(request._filter)
+            elif isinstance(request, DeleteMany):
+                self.delete_many(request._filter)
+            else:
+                raise NotImplementedError('Unsupported bulk operation')
+
+        return SimpleNamespace(acknowledged=True)
+
+    ############
+    # Aggregation
+
+    def frame(self, rows):
+        """
+        The documents at some rows as a DataFrame, with NaN or None for
+        missing fields
+        """
+
+        data = {'_id': [self.ids[row] for row in rows]}
+
+        for field, column in self.columns.items():
+
+            values = self.column_values(field, rows)
+
+            # Integer fields stay integers, as they would in Mongo
+            if values.dtype != object and column.integral():
+                values = pd.array(values, dtype='Float64').astype('Int64')
+
+            data[field] = values
+
+        return pd.DataFrame(data)
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        Run an aggregation pipeline with pandas. Supports $match, $group,
+        $project, $sort, $limit and $merge, with the expression operators in
+        evaluate.
+        Output: Iterator of result documents
+        """
+
+        pipeline = list(pipeline)
+
+        # A leading $match is run on the columns, before building a frame
+        query = None
+        if pipeline and '$match' in pipeline[0]:
+            query = pipeline.pop(0)['$match']
+
+        frame = self.frame(self.match_rows(query))
+
+        for stage in pipeline:
+
+            op, spec = next(iter(stage.items()))
+
+            if op == '$match':
+                mask = query_mask(spec, lambda field: frame_column(frame, field),
+                                    len(frame))
+                frame = frame[mask].reset_index(drop=True)
+
+            elif op == '$group':
+                frame = group_stage(frame, spec)
+
+            elif op == '$project':
+                frame = project_stage(frame, spec)
+
+            elif op == '$sort':
+                frame = frame.iloc[sorted_positions(frame, list(spec.items()))] \
+                            .reset_index(drop=True)
+
+            elif op == '$limit':
+                frame = frame.head(spec)
+
+            elif op == '$merge':
+                into = spec['into'] if isinstance(spec, dict) else spec
+                target = self.database[into]
+                for doc in frame_records(frame):
+                    target.replace_one({'_id': doc['_id']}, doc, upsert=True)
+                return iter([])
+
+            else:
+                raise NotImplementedError('Unsupported aggregation stage ' + op)
+
+        return iter(frame_records(frame))
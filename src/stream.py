@@ -0,0 +1,439 @@
+import math
+import os
+import socket
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+from src.extract import AVL_HEADER, Extractor, parse_avl_line
+from src.geo import ping_xy, to_utm
+from src.label_starts import START_RADIUS, START_CLUSTER_SECONDS, StartLabeler
+from src.label_trips import END_RADIUS, MAX_PING_GAP, MAX_TRIP_SECONDS, \
+    MIN_TRIP_DOCS, MAX_TRIP_DOCS
+
+# A chunk stop is passed once the vehicle is this many meters further away
+# from it than its closest approach
+CROSSING_HYSTERESIS = 50
+
+# Vehicles that haven't reported for this many seconds are forgotten
+MAX_IDLE_SECONDS = 3600
+
+
+class VehicleState(object):
+    """
+    State machine for a single vehicle:
+        idle -> at terminal -> in trip -> (completed or rejected) -> idle
+    Only holds the pings of its current trip, which is capped at
+    MAX_TRIP_DOCS, so memory per active vehicle is bounded.
+    """
+
+    def __init__(self, vehicle):
+
+        self.vehicle = vehicle
+        self.state = 'idle'
+        self.last_ts = None
+        self.reset_trip()
+
+    def reset_trip(self):
+
+        self.start = None
+        self.trip_labels = None
+        self.pings = deque(maxlen=MAX_TRIP_DOCS + 1)
+
+        # Index of the next chunk stop, and the closest ping to it so far
+        self.next_chunk = 0
+        self.best_dist = np.inf
+        self.best_ping = None
+
+
+class TripStream(object):
+    """
+    Labels AVL pings into trips as they arrive, using the same rules as
+    StartLabeler and TripLabeler:
+        A start is the last ping of a cluster of pings near the starting stop
+        A trip ends at the first ping near the last stop
+        Trips with long gaps, too few or too many pings, or that never end,
+        are rejected
+    Events are passed to a callback as dictionaries with a 'type' of
+    'trip_start', 'chunk_crossing', 'trip_completed' or 'trip_rejected'.
+    Crossings are emitted as they happen, so a trip that is later rejected
+    may already have emitted some.
+    """
+
+    def __init__(self, start_latlon, end_latlon, on_event, chunk_stops=None,
+                    blocks=None, start_matcher=None):
+        """
+        Input:
+            start_latlon, end_latlon:
+                Lat/lon tuples of the route's starting and last stops
+            on_event:
+                Function called with each event dictionary
+            chunk_stops:
+                Optional list of (chunk_seq, lat, lon) of a chunk interval
+            blocks:
+                Optional collection of TRAIN_ASSIGNMENTs to keep, as in the
+                Extractor
+            start_matcher:
+                Optional function given a start ping, returning a dictionary of
+                schedule labels (trip_id, trip_id_iso...) or None to drop it
+        """
+
+        self.on_event = on_event
+        self.chunk_stops = chunk_stops or []
+        self.blocks = set(blocks) if blocks is not None else None
+        self.start_matcher = start_matcher
+
+        # The stops are projected once, and each ping as it arrives, so
+        # distances are planar like the batch labelers'
+        self.start_xy = latlon_xy(start_latlon)
+        self.end_xy = latlon_xy(end_latlon)
+        self.chunk_xy = [latlon_xy((lat, lon)) for _, lat, lon in self.chunk_stops]
+
+        self.vehicles = {}
+
+        # Latest time_stamp seen from any vehicle
+        self.latest_ts = None
+
+        self.counts = {'pings': 0, 'completed': 0, 'empty': 0, 'mini': 0,
+                        'giant': 0, 'endless': 0, 'sparse': 0}
+
+    ############
+    # Input
+
+    def process_line(self, line, header=AVL_HEADER):
+        """
+        Process a raw line of AVL data, skipping blank and header lines
+        """
+
+        line = line.strip()
+
+        if not line or line.startswith('REV'):
+            return
+
+        self.process(parse_avl_line(line.split(","), header))
+
+    def process(self, ping):
+        """
+        Process a single parsed AVL ping
+        """
+
+        if self.blocks is not None and ping['TRAIN_ASSIGNMENT'] not in self.blocks:
+            return
+
+        self.counts['pings'] += 1
+
+        if self.latest_ts is None or ping['time_stamp'] > self.latest_ts:
+            self.latest_ts = ping['time_stamp']
+
+        vehicle = ping['VEHICLE_TAG']
+        state = self.vehicles.get(vehicle)
+
+        if state is None:
+            state = self.vehicles[vehicle] = VehicleState(vehicle)
+
+        # Pings have to arrive in order, per vehicle
+        if state.last_ts is not None and ping['time_stamp'] <= state.last_ts:
+            return
+
+        xy = ping_xy(ping)
+        at_start = distance(xy, self.start_xy) <= START_RADIUS
+
+        if state.state == 'in_trip':
+            self.step_trip(state, ping, xy, at_start)
+
+        elif at_start:
+            state.state = 'terminal'
+            state.start = ping
+
+        elif state.state == 'terminal':
+            # Leaving the starting stop: the last ping there starts the trip
+            self.begin_trip(state)
+
+            # Unless the start didn't match a scheduled departure
+            if state.state == 'in_trip':
+                self.step_trip(state, ping, xy, at_start)
+
+        state.last_ts = ping['time_stamp']
+
+    def evict_idle(self, now):
+        """
+        Forget vehicles that haven't reported in a while, rejecting any trip
+        they were on as endless
+        """
+
+        for vehicle in list(self.vehicles.keys()):
+
+            state = self.vehicles[vehicle]
+
+            if now - state.last_ts > MAX_IDLE_SECONDS:
+                if state.state == 'in_trip':
+                    self.reject(state, 'endless')
+                del self.vehicles[vehicle]
+
+    ############
+    # State transitions
+
+    def begin_trip(self, state):
+
+        start = state.start
+        labels = {}
+
+        if self.start_matcher is not None:
+            labels = self.start_matcher(dict(start))
+
+            # No scheduled departure matched this start
+            if labels is None:
+                state.state = 'idle'
+                state.reset_trip()
+                return
+
+        state.state = 'in_trip'
+        state.trip_labels = labels
+        state.pings.append(start)
+
+        self.emit(state, 'trip_start', start)
+
+    def step_trip(self, state, ping, xy, at_start):
+
+        start_ts = state.start['time_stamp']
+        last_ts = state.pings[-1]['time_stamp']
+        ping_ts = ping['time_stamp']
+
+        # Back at the starting stop soon after leaving: the batch labeler would
+        # put this in the same start cluster, so start over from here
+        if at_start and ping_ts - start_ts < START_CLUSTER_SECONDS:
+            self.emit(state, 'trip_rejected', ping, reason='restarted')
+            state.state = 'terminal'
+            state.reset_trip()
+            state.start = ping
+            return
+
+        if ping_ts - last_ts > MAX_PING_GAP:
+            self.reject(state, 'sparse')
+            self.restart_if_at_start(state, ping, at_start)
+            return
+
+        if ping_ts - start_ts > MAX_TRIP_SECONDS:
+            self.reject(state, 'endless')
+            self.restart_if_at_start(state, ping, at_start)
+            return
+
+        state.pings.append(ping)
+
+        if len(state.pings) > MAX_TRIP_DOCS:
+            self.reject(state, 'giant')
+            return
+
+        self.check_chunk_crossing(state, ping, xy)
+
+        if distance(xy, self.end_xy) <= END_RADIUS:
+            self.complete(state, ping)
+
+    def check_chunk_crossing(self, state, ping, xy):
+        """
+        Track the closest approach to the next chunk stop, emitting a crossing
+        once the vehicle is clearly moving away from it
+        """
+
+        if state.next_chunk >= len(self.chunk_stops):
+            return
+
+        dist = distance(xy, self.chunk_xy[state.next_chunk])
+
+        if dist < state.best_dist:
+            state.best_dist = dist
+            state.best_ping = ping
+
+        elif dist > state.best_dist + CROSSING_HYSTERESIS:
+            self.emit_crossing(state)
+
+    def emit_crossing(self, state):
+
+        seq = self.chunk_stops[state.next_chunk][0]
+
+        self.emit(state, 'chunk_crossing', state.best_ping, chunk=seq,
+                    stop_dist=float(state.best_dist))
+
+        state.next_chunk += 1
+        state.best_dist = np.inf
+        state.best_ping = None
+
+    def complete(self, state, end):
+
+        # The last chunk ends at the last stop
+        while state.next_chunk < len(self.chunk_stops):
+            if state.best_ping is None:
+                state.best_ping = end
+                state.best_dist = np.nan
+            self.emit_crossing(state)
+
+        count = len(state.pings)
+
+        if count < MIN_TRIP_DOCS:
+            self.reject(state, 'mini')
+            return
+
+        self.counts['completed'] += 1
+
+        self.emit(state, 'trip_completed', end,
+                    start_timestamp=state.start['time_stamp'],
+                    duration=end['time_stamp'] - state.start['time_stamp'],
+                    doc_count=count,
+                    pings=[(p['time_stamp'], p['LATITUDE'], p['LONGITUDE'])
+                            for p in state.pings])
+
+        state.state = 'idle'
+        state.reset_trip()
+
+    def reject(self, state, reason):
+
+        self.counts[reason] += 1
+
+        self.emit(state, 'trip_rejected', state.pings[-1], reason=reason)
+
+        state.state = 'idle'
+        state.reset_trip()
+
+    def restart_if_at_start(self, state, ping, at_start):
+
+        if at_start:
+            state.state = 'terminal'
+            state.start = ping
+
+    def emit(self, state, event_type, ping, **details):
+
+        event = {
+            'type': event_type,
+            'vehicle': state.vehicle,
+            'block': ping['TRAIN_ASSIGNMENT'],
+            'time_stamp': ping['time_stamp']
+        }
+
+        if state.trip_labels:
+            event.update(state.trip_labels)
+
+        event.update(details)
+
+        self.on_event(event)
+
+
+def latlon_xy(latlon):
+    """
+    The projected x/y of a lat/lon tuple, as floats
+    """
+
+    x, y = to_utm(latlon[0], latlon[1])
+
+    return float(x), float(y)
+
+
+def distance(xy, xy_0):
+    """
+    Distance in meters between two projected points, without the array
+    overhead of planar_distance for single pings
+    """
+
+    return math.hypot(xy[0] - xy_0[0], xy[1] - xy_0[1])
+
+
+############
+# Sources
+
+def schedule_matcher(start_labeler):
+    """
+    Match stream starts to scheduled trips with a StartLabeler's GTFS data,
+    keeping its trip_id, trip_id_iso and service_id labels
+    """
+
+    def match(start):
+
+        labeled = start_labeler.get_start_labels([start])
+
+        if not labeled:
+            return None
+
+        keys = ['trip_id', 'trip_id_iso', 'service_id', 'sched_time_diff_seconds']
+        return {key: labeled[0][key] for key in keys}
+
+    return match
+
+
+def route_blocks(gtfs_period, bus, direction):
+    """
+    The TRAIN_ASSIGNMENT names of the blocks running a route and direction in
+    a GTFS period, the same ones the Extractor keeps
+    """
+
+    extractor = Extractor(None, bus=bus, direction=direction,
+                            gtfs_period=gtfs_period)
+    extractor.setup()
+
+    return extractor.block_names
+
+
+def route_stream(params, db, schedule_path, on_event, chunk_stops=None):
+    """
+    A TripStream for the route, direction and GTFS period of the parameters.
+    Only pings from the route's blocks are followed, trips run between the
+    first and last stops of the sample schedule, and starts are matched to
+    scheduled trips like the StartLabeler does, for the blocks of the
+    extracted AVL data
+    """
+
+    sched = pd.read_csv(schedule_path)
+    start_latlon = (sched.iloc[0]['stop_lat'], sched.iloc[0]['stop_lon'])
+    end_latlon = (sched.iloc[-1]['stop_lat'], sched.iloc[-1]['stop_lon'])
+
+    blocks = route_blocks(params['gtfs_period'], params['bus'],
+                            params['direction'])
+
+    # Only used to match starts, so it has no out collection
+    start_labeler = StartLabeler(db[params['avl_collection']], None,
+                        gtfs_period=params['gtfs_period'],
+                        direction=params['direction'])
+
+    return TripStream(start_latlon, end_latlon, on_event,
+                chunk_stops=chunk_stops, blocks=blocks,
+                start_matcher=schedule_matcher(start_labeler))
+
+
+def tail_file(path, poll=0.5, follow=True):
+    """
+    Yield lines appended to a file, like `tail -f`. With follow=False, stops at
+    the end of the file.
+    """
+
+    with open(path) as f:
+
+        while True:
+
+            line = f.readline()
+
+            if line:
+                yield line
+            elif follow:
+                time.sleep(poll)
+            else:
+                return
+
+
+def socket_lines(host='127.0.0.1', port=9500):
+    """
+    Listen on a local socket and yield lines from each client that connects
+    """
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn, conn.makefile('r') as reader:
+                for line in reader:
+                    yield line
+    finally:
+        server.close()
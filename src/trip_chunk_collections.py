@@ -5,108 +5,215 @@ import numpy as np
 import pymongo
 from pymongo import MongoClient
 
-def temporal_features_total(trip_id_list, trip_collection, output_collection):
-
-    for idx, trip in enumerate(trip_id_list):
-
-        print ("Getting total duration data for ", trip)
-        print ("Number ", idx+1, " of ", len(trip_id_list))
-
-        start_search = {
-                'trip_id_iso': trip,
-                'trip_start': 1
-            }
-
-        end_search = {
-                'trip_id_iso': trip,
-                'trip_end': 1
-            }
-
-        trip_start = trip_collection.find_one(start_search)
-        trip_end = trip_collection.find_one(end_search)
-
-        if trip_start and trip_end:
+import src.gtfs as gtfs
+import src.instrument as instrument
+
+
+def trip_duration_pipeline(trip_id_list=None):
+    """
+    Build an aggregation pipeline that summarises each trip's start and end
+    documents into a single row with its duration and time-of-day features.
+    Input:
+        trip_id_list: Optional list of trip_id_iso's to restrict the summary to
+    Output: List of aggregation stages, ending with the projected summary
+    """
+
+    match = {'$or': [{'trip_start': 1}, {'trip_end': 1}]}
+
+    if trip_id_list is not None:
+        match['trip_id_iso'] = {'$in': list(trip_id_list)}
+
+    # Only pick a field from the end document of each trip
+    def from_end(field):
+        return {'$cond': [{'$eq': ['$trip_end', 1]}, field, None]}
+
+    return [
+        {'$match': match},
+        # Each trip's earliest start comes first, so every start field is
+        # taken from that one document. Documents without trip_start sort
+        # last
+        {'$sort': {'trip_start': -1, 'time_stamp': 1}},
+        {'$group': {
+            '_id': '$trip_id_iso',
+            'trip_start': {'$first': '$trip_start'},
+            'start_timestamp': {'$first': '$time_stamp'},
+            'end_timestamp': {'$max': from_end('$time_stamp')},
+            'min_noon_sqr': {'$first': '$minutes_noon_sqr'},
+            'min_since_midnight': {'$first': '$min_since_midnight'}
+        }},
+        # Skip trips that are missing either a start or an end
+        {'$match': {
+            'trip_start': 1,
+            'end_timestamp': {'$ne': None}
+        }},
+        {'$project': {
+            'trip_id_iso': '$_id',
+            'start_timestamp': 1,
+            'duration': {'$subtract': ['$end_timestamp', '$start_timestamp']},
+            'min_noon_sqr': 1,
+            'min_since_midnight': 1
+        }}
+    ]
 
-            trip_dict = {}
 
-            start_ts = trip_start['time_stamp']
-            end_ts = trip_end['time_stamp']
-
-            trip_dict['start_timestamp'] = start_ts
-            trip_dict['trip_id_iso'] = trip
-
-            trip_duration = end_ts - start_ts
-            trip_dict['duration'] = trip_duration
-
-            trip_dict['min_noon_sqr'] = trip_start['minutes_noon_sqr']
-
-            # Minutes since midnight
-            start_dt = datetime.fromtimestamp(start_ts)
-            msm = (start_dt.hour * 60) + start_dt.minute
-            trip_dict['min_since_midnight'] = msm
-
-
-            output_collection.insert_one(trip_dict)
+def temporal_features_total(trip_id_list, trip_collection, output_collection):
+    """
+    Build the total duration collection in a single server-side aggregation,
+    merging one summary document per trip into the output collection.
+    """
+
+    print ("Getting total duration data for ", len(trip_id_list), " trips")
+
+    pipeline = trip_duration_pipeline(trip_id_list)
+
+    # Write the summaries straight into the output collection, keyed by trip
+    pipeline.append({'$merge': {
+        'into': output_collection.name,
+        'on': '_id',
+        'whenMatched': 'replace',
+        'whenNotMatched': 'insert'
+    }})
+
+    trip_collection.aggregate(pipeline, allowDiskUse=True)
+
+
+def chunk_group_pipeline(chunk_interval, trip_id_list=None):
+    """
+    Build an aggregation pipeline that groups trip documents by trip and chunk,
+    getting each chunk's first and last time_stamp and average speed.
+    Input:
+        chunk_interval: Number of chunks, picking the chunk_N label to use
+        trip_id_list: Optional list of trip_id_iso's to restrict the groups to
+    Output: List of aggregation stages
+    """
+
+    field = "chunk_" + str(chunk_interval)
+
+    # Trip starts are matched even when unlabeled, for the start time_stamp
+    match = {'$or': [{field: {'$exists': True}}, {'trip_start': 1}]}
+
+    if trip_id_list is not None:
+        match['trip_id_iso'] = {'$in': list(trip_id_list)}
+
+    return [
+        {'$match': match},
+        {'$group': {
+            '_id': {'trip_id_iso': '$trip_id_iso', 'chunk': '$' + field},
+            'min_ts': {'$min': '$time_stamp'},
+            'max_ts': {'$max': '$time_stamp'},
+            # SPEED is stored as a string straight from the AVL files
+            'avg_speed': {'$avg': {'$toDouble': '$SPEED'}},
+            'start_timestamp': {'$min': {
+                '$cond': [{'$eq': ['$trip_start', 1]}, '$time_stamp', None]
+            }}
+        }},
+        {'$project': {
+            '_id': 0,
+            'trip_id_iso': '$_id.trip_id_iso',
+            'chunk': '$_id.chunk',
+            'min_ts': 1,
+            'max_ts': 1,
+            'avg_speed': 1,
+            'start_timestamp': 1
+        }}
+    ]
+
+
+def chunk_frame(trip_collection, chunk_interval, trip_id_list=None):
+    """
+    Get the per-chunk details of every trip as a long DataFrame, with one row
+    per trip and chunk.
+    Input:
+        trip_collection: Collection of labeled, chunked trip documents
+        chunk_interval: Number of chunks trips were divided into
+        trip_id_list: Optional list of trip_id_iso's
+    Output: DataFrame with trip_id_iso, chunk, min_ts, max_ts, avg_speed and
+        start_timestamp columns
+    """
+
+    pipeline = chunk_group_pipeline(chunk_interval, trip_id_list)
+    groups = pd.DataFrame(list(trip_collection.aggregate(pipeline,
+                                    allowDiskUse=True)))
+
+    columns = ['trip_id_iso', 'chunk', 'min_ts', 'max_ts', 'avg_speed',
+                'start_timestamp']
+
+    if groups.empty:
+        return pd.DataFrame(columns=columns)
+
+    # Every chunk row of a trip gets the time of the trip's first start
+    starts = groups.groupby('trip_id_iso')['start_timestamp'].min()
+    groups['start_timestamp'] = groups['trip_id_iso'].map(starts)
+
+    # Drop the group of unlabeled trip starts
+    groups = groups[groups['chunk'].notnull()]
+
+    return groups[columns].reset_index(drop=True)
+
+
+def local_minutes(time_stamps):
+    """
+    Minutes since midnight, in local time, of a series of time_stamps
+    """
+
+    local = gtfs.local_seconds(time_stamps)
+
+    return pd.Series((local % 86400) // 60, index=time_stamps.index).astype(int)
 
 
 def chunk_data_interval(trip_id_list, trip_collection, chunk_collection,
                         output_collection, chunk_interval):
+    """
+    Build one document per trip with the duration, time of day and average
+    speed of each of its chunks, computed for all trips in one pass and
+    inserted in bulk.
+    """
 
     cnk_info = chunk_collection.find_one({'number_chunks':chunk_interval})
+    chnk_seqs = list(cnk_info['chunks'].keys())
 
-    for idx, trip in enumerate(trip_id_list):
+    chunks = chunk_frame(trip_collection, chunk_interval, trip_id_list)
 
-        trip_data = {}
+    if chunks.empty:
+        return
 
-        print ("Getting ", chunk_interval, " Chunk data for ", trip)
-        print ("Number ", idx+1, " of ", len(trip_id_list))
+    chunks['seconds'] = chunks['max_ts'] - chunks['min_ts']
+    chunks['mfn_sq'] = (local_minutes(chunks['min_ts']) - 720)**2
 
-        start_search = {
-                'trip_id_iso': trip,
-                'trip_start': 1
-            }
+    # One row per trip, with a column per chunk feature
+    wide = chunks.set_index(['trip_id_iso', 'chunk']) \
+                [['seconds', 'mfn_sq', 'avg_speed']].unstack('chunk')
 
-        trip_start = trip_collection.find_one(start_search)
+    trip_data = pd.DataFrame(index=wide.index)
+    trip_data['start_timestamp'] = chunks.groupby('trip_id_iso')['start_timestamp'].max()
+    trip_data['trip_id_iso'] = wide.index
 
-        trip_data['start_timestamp'] = trip_start['time_stamp']
-        trip_data['trip_id_iso'] = trip
+    for chnk_seq in chnk_seqs:
 
-        breakin = 0
-
-        for chnk_seq, chnk_data in cnk_info['chunks'].items():
-
-            field = "chunk_" + str(chunk_interval)
-
-            search = {
-                'trip_id_iso': trip,
-                field: chnk_seq
-            }
-
-            chnk_str = '_chnk_' + chnk_seq
-
-            chnk_cursor = trip_collection.find(search)
-
-            chnk_df = pd.DataFrame(list(chnk_cursor))
-
-            min_ts = chnk_df['time_stamp'].min()
-            max_ts = chnk_df['time_stamp'].max()
-
-            chnk_secs = max_ts - min_ts
+        chnk_str = '_chnk_' + chnk_seq
 
-            trip_data['seconds' + chnk_str ] = chnk_secs
+        for feature in ['seconds', 'mfn_sq', 'avg_speed']:
+            if (feature, chnk_seq) in wide.columns:
+                trip_data[feature + chnk_str] = wide[(feature, chnk_seq)]
+            else:
+                trip_data[feature + chnk_str] = np.nan
 
-            min_dt = datetime.fromtimestamp(min_ts)
-            mfn_sq = (((min_dt.hour * 60) + min_dt.minute) - 720)**2
+    # Skip trips that are missing a chunk or their start
+    trip_data = trip_data.dropna()
 
-            trip_data['mfn_sq' + chnk_str] = mfn_sq
+    if trip_data.empty:
+        return
 
-            avg_spd = chnk_df['SPEED'].astype('float').mean()
+    for chnk_seq in chnk_seqs:
+        mfn_col = 'mfn_sq_chnk_' + chnk_seq
+        trip_data[mfn_col] = trip_data[mfn_col].astype(int)
 
-            trip_data['avg_speed' + chnk_str] = avg_spd
+    # Object columns hold plain python values, which BSON can encode
+    records = trip_data.astype(object).to_dict('records')
 
-        if breakin == 0:
+    output_collection.insert_many(records)
 
-            output_collection.insert_one(trip_data)
+    instrument.count('feature_rows', len(records))
 
 
 def six_chunk_data(trip_id_list, trip_collection, chunk_collection, output_collection):
@@ -131,13 +238,13 @@ def six_chunk_data(trip_id_list, trip_collection, chunk_collection, output_colle
 
             chnk_str = '_chnk_' + chnk_seq
 
-            chnk_cursor = trip_collection.find(search)
+            chnk_docs = list(trip_collection.find(search))
 
-            if chnk_cursor.count() == 0:
+            if not chnk_docs:
                 breakin += 1
                 break
 
-            chnk_df = pd.DataFrame(list(chnk_cursor))
+            chnk_df = pd.DataFrame(chnk_docs)
 
             min_ts = chnk_df['time_stamp'].min()
             max_ts = chnk_df['time_stamp'].max()
@@ -0,0 +1,65 @@
+import argparse
+import json
+
+import src.stages as stages
+import src.storage as storage
+import src.stream as stream
+
+parser = argparse.ArgumentParser(
+    description='Label live AVL pings into trips and chunk crossings')
+parser.add_argument('--file', help='AVL file to follow as it grows')
+parser.add_argument('--port', type=int, default=9500,
+                    help='Local port to read AVL lines from, if no file is given')
+parser.add_argument('--schedule',
+                    help='Sample schedule of the route. Defaults to the one '
+                        'chunk_data.py last built')
+parser.add_argument('--interval', type=int,
+                    help='Chunk interval whose crossings should be emitted')
+parser.add_argument('--evict-every', type=int, default=300,
+                    help='Seconds of AVL time between forgetting idle vehicles')
+args = parser.parse_args()
+
+# Load in our parameters file
+with open('parameters.json') as f:
+    params = json.load(f)
+
+db = storage.open_storage(params)
+
+schedule_path = args.schedule or stages.last_schedule_path(db, params)
+
+chunk_stops = []
+if args.interval:
+    chunk_coll = db[params['chunk_collection']]
+    cnk_info = chunk_coll.find_one({'number_chunks': args.interval})
+    chunk_stops = [(seq, info['chunk_stop_lat'], info['chunk_stop_lon'])
+                    for seq, info in cnk_info['chunks'].items()]
+
+def print_event(event):
+    event.pop('pings', None)
+    print (json.dumps(event))
+
+# Follows the route's blocks, labeling starts with their scheduled trips
+trip_stream = stream.route_stream(params, db, schedule_path, print_event,
+                    chunk_stops=chunk_stops)
+
+if args.file:
+    lines = stream.tail_file(args.file)
+else:
+    lines = stream.socket_lines(port=args.port)
+
+last_evicted = None
+
+for line in lines:
+    trip_stream.process_line(line)
+
+    now = trip_stream.latest_ts
+
+    if now is None:
+        continue
+
+    # Forget vehicles that stopped reporting, so memory stays bounded
+    if last_evicted is None:
+        last_evicted = now
+    elif now - last_evicted >= args.evict_every:
+        trip_stream.evict_idle(now)
+        last_evicted = now
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+
+import pytest
+
+# The pipeline reads data/ and imports src. relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import src.storage as storage
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture(params=['memory', 'mongomock'])
+def db(request):
+    """
+    An empty database, in memory and on mongomock
+    """
+
+    if request.param == 'memory':
+        return storage.MemoryStorage()
+
+    mongomock = pytest.importorskip('mongomock')
+
+    return mongomock.MongoClient()['test']
+
+
+@pytest.fixture
+def memory_db():
+    """
+    An empty in-memory database, for pipelines mongomock can't run
+    """
+
+    return storage.MemoryStorage()
+
+
+@pytest.fixture
+def sf_time(monkeypatch):
+    """
+    Run in San Francisco local time, as the AVL time_stamps were made in
+    """
+
+    monkeypatch.setenv('TZ', 'America/Los_Angeles')
+    time.tzset()
+
+    yield
+
+    monkeypatch.undo()
+    time.tzset()
@@ -0,0 +1,23 @@
+from datetime import datetime
+
+import pandas as pd
+
+from src.backtest import TOD_LABELS, service_days, tod_buckets
+
+
+def test_days_and_buckets_match_fromtimestamp(sf_time):
+
+    starts = pd.Series([datetime(2016, 6, 6, 5, 59).timestamp(),
+                        datetime(2016, 6, 6, 23, 30).timestamp(),
+                        datetime(2016, 6, 7, 0, 15).timestamp(),
+                        datetime(2016, 11, 6, 16, 0).timestamp()])
+
+    days = service_days(starts)
+
+    assert days.tolist()[1] == (datetime(2016, 6, 6) - datetime(1970, 1, 1)).days
+    assert days[2] - days[1] == 1
+    assert days[3] == (datetime(2016, 11, 6) - datetime(1970, 1, 1)).days
+
+    labels = [TOD_LABELS[bucket] for bucket in tod_buckets(starts)]
+
+    assert labels == ['night', 'evening', 'night', 'pm_peak']
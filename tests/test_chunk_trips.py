@@ -0,0 +1,133 @@
+from geopy.distance import distance
+
+from src.chunk_trips import TripChunker
+
+START_TS = 1465228800
+
+# Chunk stops along Fulton St, just off the pings' line so that no two pings
+# tie for closest
+CHUNK_SETS = [
+    {'number_chunks': 2, 'chunks': {
+        '1': {'chunk_stop_lat': 37.7701, 'chunk_stop_lon': -122.4703},
+        '2': {'chunk_stop_lat': 37.7701, 'chunk_stop_lon': -122.4403}}},
+    {'number_chunks': 3, 'chunks': {
+        '1': {'chunk_stop_lat': 37.7701, 'chunk_stop_lon': -122.4803},
+        '2': {'chunk_stop_lat': 37.7701, 'chunk_stop_lon': -122.4603},
+        '3': {'chunk_stop_lat': 37.7701, 'chunk_stop_lon': -122.4403}}},
+]
+
+
+def baseline_chunk_trips(trip_coll, chunk_coll):
+    """
+    The original per-trip, per-chunk loop, with a query and an update per
+    document
+    """
+
+    for trip in trip_coll.distinct('trip_id_iso'):
+
+        for chunk in chunk_coll.find():
+
+            chnk_num = "chunk_" + str(chunk['number_chunks'])
+
+            start_ts = 0
+
+            for seq, chunk_info in chunk['chunks'].items():
+
+                best_dist = {'stop_dist': 100000, 'time_stamp': 0}
+
+                filter_search = {"trip_id_iso": trip,
+                                 "time_stamp": {"$gte": start_ts}}
+
+                for doc in trip_coll.find(filter_search).sort('time_stamp'):
+
+                    doc_dist = distance(
+                        (doc['LATITUDE'], doc['LONGITUDE']),
+                        (chunk_info['chunk_stop_lat'],
+                         chunk_info['chunk_stop_lon'])).m
+
+                    if doc_dist < best_dist['stop_dist']:
+                        best_dist['stop_dist'] = doc_dist
+                        best_dist['time_stamp'] = doc['time_stamp']
+
+                label_search = {"trip_id_iso": trip,
+                                "time_stamp": {"$gte": start_ts,
+                                               "$lt": best_dist['time_stamp']}}
+
+                for doc in trip_coll.find(label_search).sort('time_stamp'):
+                    trip_coll.update_one({"_id": doc['_id']},
+                                         {"$set": {chnk_num: seq}})
+
+                start_ts = best_dist['time_stamp']
+
+
+def trip_docs(trip, lons, lat=37.77):
+    """
+    A trip's pings, 30 seconds apart
+    """
+
+    return [{'trip_id_iso': trip, 'time_stamp': START_TS + 30 * idx,
+             'LATITUDE': lat, 'LONGITUDE': round(lon, 4)}
+            for idx, lon in enumerate(lons)]
+
+
+def steps(first, last, count):
+
+    return [first + (last - first) * idx / (count - 1) for idx in range(count)]
+
+
+def sample_trips():
+
+    docs = []
+
+    # Drives past every chunk stop
+    docs += trip_docs('full', steps(-122.49, -122.43, 61))
+
+    # Turns around before the last chunk stop
+    docs += trip_docs('short', steps(-122.49, -122.455, 36))
+
+    # Dwells at the first chunk stop, so several pings tie for closest
+    docs += trip_docs('dwell', steps(-122.49, -122.47, 21)
+                        + [-122.47] * 3 + steps(-122.469, -122.43, 40))
+
+    # Out and back, passing each chunk stop twice
+    docs += trip_docs('loop', steps(-122.49, -122.43, 61)
+                        + steps(-122.431, -122.49, 60))
+
+    # In Sacramento, over 100km from every chunk stop
+    docs += trip_docs('far', steps(-121.49, -121.43, 61), lat=38.58)
+
+    return docs
+
+
+def labels(coll):
+
+    return {(doc['trip_id_iso'], doc['time_stamp']):
+                (doc.get('chunk_2'), doc.get('chunk_3'))
+            for doc in coll.find()}
+
+
+def test_matches_baseline_loop(db):
+
+    for name in ('baseline', 'chunked'):
+        db[name + '_chunks'].insert_many([dict(chunk) for chunk in CHUNK_SETS])
+        db[name + '_trips'].insert_many(sample_trips())
+
+    baseline_chunk_trips(db['baseline_trips'], db['baseline_chunks'])
+    TripChunker(db['chunked_trips'], db['chunked_chunks'],
+                batch_size=2).chunk_trips(verbose=False)
+
+    expected = labels(db['baseline_trips'])
+
+    assert labels(db['chunked_trips']) == expected
+
+    by_trip = {}
+    for (trip, _), trip_labels in expected.items():
+        by_trip.setdefault(trip, set()).add(trip_labels)
+
+    assert by_trip['far'] == {(None, None)}
+    assert ('2', '3') in by_trip['full']
+    assert ('2', '3') in by_trip['dwell']
+    # The first of the dwelling pings is the closest to the chunk stop, so it
+    # ends chunk 1 and every dwelling ping falls in chunk 2
+    dwell = [expected['dwell', START_TS + 30 * idx][0] for idx in range(19, 24)]
+    assert dwell == ['1', '2', '2', '2', '2']
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+import src.feature_store as ftr_store
+
+
+def test_round_trip(tmp_path):
+
+    frame = pd.DataFrame({
+        'trip_id_iso': ['a', None, 'c'],
+        'seconds': [10.5, 20.0, 30.0],
+        # Such as a headway prior on the first trips of a table
+        'prior_seconds': pd.Series([None, None, None], dtype=object),
+        'prior_count': pd.Series([1, None, 3], dtype=object),
+        'chunk': ['1', '2', '10'],
+    })
+
+    ftr_store.write_feature_table('trips', frame, root=str(tmp_path))
+    table = ftr_store.load_feature_table('trips', root=str(tmp_path))
+
+    assert len(table) == 3
+    assert table['trip_id_iso'].tolist() == ['a', '', 'c']
+    assert table['trip_id_iso'].dtype.kind == 'U'
+    assert table['seconds'].tolist() == [10.5, 20.0, 30.0]
+
+    assert table['prior_seconds'].dtype == float
+    assert np.isnan(table['prior_seconds']).all()
+
+    np.testing.assert_array_equal(table['prior_count'], [1, np.nan, 3])
+
+    # Strings of digits stay strings
+    assert table['chunk'].tolist() == ['1', '2', '10']
+
+
+def test_versions(tmp_path):
+
+    frame = pd.DataFrame({'x': [1, 2]})
+
+    ftr_store.write_feature_table('t', frame, root=str(tmp_path))
+    ftr_store.write_feature_table('t', frame * 2, root=str(tmp_path))
+
+    assert ftr_store.table_versions('t', root=str(tmp_path)) == [1, 2]
+    assert ftr_store.load_feature_table('t', root=str(tmp_path))['x'].tolist() == [2, 4]
+    assert ftr_store.load_feature_table('t', version=1,
+                root=str(tmp_path))['x'].tolist() == [1, 2]
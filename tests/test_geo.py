@@ -0,0 +1,54 @@
+import numpy as np
+
+from src.geo import haversine, planar_distance, project_xy_onto_polyline, \
+    to_utm
+
+
+def test_to_utm_central_meridian():
+
+    # On the central meridian, easting is the false easting and northing is
+    # the scaled meridian arc: 4982950.40m at 45N
+    x, y = to_utm([0.0, 45.0], [-123.0, -123.0])
+
+    np.testing.assert_allclose(x, [500000, 500000], atol=1e-6)
+    np.testing.assert_allclose(y, [0, 4982950.40], atol=0.01)
+
+
+def test_to_utm_symmetric_about_meridian():
+
+    x, y = to_utm([37.78, 37.78], [-122.42, -123.58])
+
+    assert abs((x[0] - 500000) + (x[1] - 500000)) < 1e-6
+    assert abs(y[0] - y[1]) < 1e-6
+
+
+def test_planar_distance_close_to_great_circle():
+
+    # Pairs of points across San Francisco, from 20m to 10km apart
+    lat = np.array([37.7793, 37.7793, 37.7086, 37.8080])
+    lon = np.array([-122.4193, -122.4193, -122.4581, -122.4177])
+    lat_0 = np.array([37.7794, 37.7700, 37.7449, 37.7349])
+    lon_0 = np.array([-122.4191, -122.4150, -122.4194, -122.3881])
+
+    x, y = to_utm(lat, lon)
+    x_0, y_0 = to_utm(lat_0, lon_0)
+
+    planar = planar_distance(x, y, x_0, y_0)
+    sphere = haversine(lat, lon, lat_0, lon_0)
+
+    # The sphere is itself within 0.5% of the ellipsoid
+    np.testing.assert_allclose(planar, sphere, rtol=0.005)
+
+
+def test_project_xy_onto_polyline():
+
+    # An L-shaped line, with distances that don't match its length
+    line_x = [0.0, 100.0, 100.0]
+    line_y = [0.0, 0.0, 100.0]
+    line_dist = [0.0, 200.0, 300.0]
+
+    along = project_xy_onto_polyline(line_x, line_y, line_dist,
+                [50.0, 150.0, 110.0, -20.0, 100.0],
+                [10.0, -10.0, 60.0, 0.0, 500.0], block_size=2)
+
+    np.testing.assert_allclose(along, [100, 200, 260, 0, 300])
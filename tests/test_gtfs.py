@@ -0,0 +1,63 @@
+from datetime import datetime
+
+import numpy as np
+
+import src.gtfs as gtfs
+
+# sfmta_2016-04-22, whose calendar starts on 2016-02-13
+PERIOD = 3
+
+
+def stamps(*whens):
+
+    return np.array([datetime.strptime(when, '%Y-%m-%d %H:%M').timestamp()
+                        for when in whens])
+
+
+def test_local_days_match_fromtimestamp(sf_time):
+
+    when = stamps('2016-03-13 01:30', '2016-03-13 03:30', '2016-11-06 23:59')
+    days, hours = gtfs.local_days(when)
+
+    for stamp, day, hour in zip(when, days, hours):
+        local = datetime.fromtimestamp(stamp)
+        assert day == (local.date() - datetime(1970, 1, 1).date()).days
+        assert hour == local.hour
+
+
+def test_epoch_day():
+
+    assert gtfs.epoch_day(20160215) == gtfs.epoch_day('2016-02-15')
+    assert gtfs.epoch_day('1970-01-02') == 1
+
+
+def test_service_calendar_weekdays_and_holidays():
+
+    calendar = gtfs.ServiceCalendar(PERIOD)
+
+    services = calendar.resolve(stamps('2016-02-16 12:00', '2016-02-20 12:00',
+                                        '2016-02-21 12:00', '2016-02-15 12:00'))
+
+    assert [row.tolist() for row in services] == [[1], [2], [3],
+                                                    # Presidents' Day
+                                                    [2]]
+
+
+def test_service_calendar_overnight():
+
+    calendar = gtfs.ServiceCalendar(PERIOD)
+
+    # Early on a Monday, Sunday's trips may still be running
+    services = calendar.resolve(stamps('2016-02-22 05:00', '2016-02-22 09:00'))
+
+    assert sorted(services[0].tolist()) == [1, 3]
+    assert services[1].tolist() == [1]
+
+
+def test_service_calendar_outside_its_dates():
+
+    calendar = gtfs.ServiceCalendar(PERIOD)
+
+    # Before the calendar starts, the weekday pattern still applies
+    assert calendar.resolve(stamps('2015-10-06 12:00'))[0].tolist() == [1]
+    assert calendar.resolve(np.array([])) == []
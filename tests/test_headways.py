@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+
+from src.headways import headway_features, headway_table
+
+
+def passing(rows):
+
+    chunks = pd.DataFrame(rows, columns=['trip_id_iso', 'chunk', 'enter_ts',
+                                            'pass_ts'])
+    chunks['start_timestamp'] = chunks['enter_ts']
+    chunks['seconds'] = chunks['pass_ts'] - chunks['enter_ts']
+
+    return chunks
+
+
+def test_features_only_use_earlier_vehicles():
+
+    chunks = passing([
+        ('a', '1', 0, 100),
+        ('b', '1', 300, 420),
+        ('c', '1', 600, 650),
+        # Enters before b has passed, so a is its prior vehicle
+        ('d', '1', 400, 900),
+        ('a', '2', 100, 200),
+    ])
+
+    features = headway_features(chunks).set_index(['trip_id_iso', 'chunk'])
+
+    assert 'headway' not in features.columns
+
+    assert np.isnan(features.loc[('a', '1'), 'since_prior_pass'])
+
+    assert features.loc[('b', '1'), 'since_prior_pass'] == 200
+    assert features.loc[('b', '1'), 'prior_seconds'] == 100
+
+    assert features.loc[('d', '1'), 'since_prior_pass'] == 300
+    assert features.loc[('d', '1'), 'prior_seconds'] == 100
+
+    # c's prior is b, whose rolling headway is b's gap behind a, not c's own
+    assert features.loc[('c', '1'), 'prior_seconds'] == 120
+    assert features.loc[('c', '1'), 'rolling_headway'] == 320
+    assert features.loc[('c', '1'), 'rolling_seconds'] == 110
+
+    # Chunks don't see each other's vehicles
+    assert np.isnan(features.loc[('a', '2'), 'prior_seconds'])
+
+
+def test_features_ignore_when_the_trip_passes():
+
+    chunks = passing([('a', '1', 0, 100), ('b', '1', 300, 420)])
+    later = passing([('a', '1', 0, 100), ('b', '1', 300, 2000)])
+
+    features = headway_features(chunks)
+    moved = headway_features(later)
+
+    b = features['trip_id_iso'] == 'b'
+    assert features[b].drop(columns='start_timestamp').equals(
+                moved[b].drop(columns='start_timestamp'))
+
+
+def test_table_one_row_per_trip():
+
+    chunks = passing([('a', '1', 0, 100), ('a', '2', 100, 200),
+                        ('b', '1', 300, 420), ('b', '2', 420, 500)])
+
+    table = headway_table(headway_features(chunks))
+
+    assert sorted(table['trip_id_iso']) == ['a', 'b']
+    assert 'since_prior_pass_chnk_2' in table.columns
+    assert not any(column.startswith('headway') for column in table.columns)
+
+    b = table.set_index('trip_id_iso').loc['b']
+    assert b['since_prior_pass_chnk_2'] == 220
+    assert b['prior_seconds_chnk_2'] == 100
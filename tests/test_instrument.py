@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+import pytest
+
+from src.instrument import CommandMonitor, Recorder
+
+
+def send_find(monitor):
+
+    started = SimpleNamespace(command={'find': 'trips', 'filter': {'a': 1}},
+                              command_name='find', database_name='test',
+                              connection_id=('localhost', 27017), request_id=1)
+    succeeded = SimpleNamespace(reply={'cursor': {'firstBatch': [{'a': 1}]}},
+                                command_name='find', duration_micros=1500,
+                                connection_id=('localhost', 27017), request_id=1)
+
+    monitor.started(started)
+    monitor.succeeded(succeeded)
+
+
+@pytest.mark.parametrize('measure_bytes', [False, True])
+def test_command_sizes_only_when_measured(measure_bytes):
+
+    recorder = Recorder()
+    monitor = CommandMonitor(recorder, measure_bytes)
+
+    with recorder.span('chunk_trips'):
+        send_find(monitor)
+
+    stats = recorder.snapshot()['mongo']['chunk_trips']['trips']['find']
+
+    assert stats['count'] == 1
+    assert stats['seconds'] == pytest.approx(0.0015)
+
+    if measure_bytes:
+        assert stats['bytes_sent'] > 0 and stats['bytes_received'] > 0
+    else:
+        assert stats['bytes_sent'] == stats['bytes_received'] == 0
@@ -0,0 +1,128 @@
+import json
+
+import pytest
+
+from src.orchestrator import Orchestrator
+from src.stages import pipeline_stages
+
+
+def load_params(**changes):
+
+    with open('parameters.json') as params_file:
+        params = json.load(params_file)
+
+    params.update(storage='memory', **changes)
+
+    return params
+
+
+class StubRuns(object):
+    """
+    Replaces the stages' work with recording which stages ran, optionally
+    failing the named stages once
+    """
+
+    def __init__(self, fail=()):
+
+        self.ran = []
+        self.fail = set(fail)
+
+    def runner(self, params, db):
+
+        stages = pipeline_stages(params)
+        for stage in stages:
+            stage.run = self.run
+
+        return Orchestrator(stages, db, params)
+
+    def run(self, ctx, group):
+
+        names = [stage.name for stage in group]
+
+        failing = self.fail.intersection(names)
+        if failing:
+            self.fail -= failing
+            raise RuntimeError('Stub failure')
+
+        self.ran.extend(names)
+
+
+def test_unchanged_stages_are_skipped(memory_db):
+
+    params = load_params()
+    stubs = StubRuns()
+
+    first = stubs.runner(params, memory_db).run()
+
+    assert first[:4] == ['extract', 'label_starts', 'label_trips',
+                         'sample_schedule']
+    assert set(first) == {stage.name for stage in pipeline_stages(params)}
+    assert stubs.ran == first
+
+    assert stubs.runner(params, memory_db).run() == []
+
+    # Only the headway stages read the headway window
+    params['headway_window'] = 5
+    assert stubs.runner(params, memory_db).run() == ['headways_2', 'headways_6']
+
+
+def test_resume_runs_from_the_failed_stage(memory_db):
+
+    params = load_params()
+    stubs = StubRuns(fail=['chunk_trips_6'])
+
+    with pytest.raises(RuntimeError):
+        stubs.runner(params, memory_db).run()
+
+    runner = stubs.runner(params, memory_db)
+
+    # Both intervals are chunked in one pass, so both failed
+    assert runner.status('chunk_trips_2') == 'failed'
+    assert runner.status('chunk_trips_6') == 'failed'
+    assert runner.status('build_chunks_6') == 'done'
+    assert 'chunk_features_2' not in stubs.ran
+
+    stubs.ran = []
+    resumed = runner.run(resume=True)
+
+    assert sorted(resumed) == ['chunk_features_2', 'chunk_features_6',
+                               'chunk_trips_2', 'chunk_trips_6',
+                               'headways_2', 'headways_6']
+    assert stubs.ran == resumed
+
+    # The failed run stopped before reaching the stages that don't depend on
+    # the failed ones, so they are left for the next full run
+    assert runner.run() == ['stop_events', 'duration_features']
+    assert runner.run() == []
+
+
+def test_stage_runs_only_the_selected_stages(memory_db):
+
+    params = load_params()
+    stubs = StubRuns()
+    stubs.runner(params, memory_db).run()
+
+    runner = stubs.runner(params, memory_db)
+
+    # Selected stages run even though nothing changed, and their dependents
+    # are left for the next full run
+    assert runner.run(only=['build_chunks']) == ['build_chunks_2',
+                                                 'build_chunks_6']
+    assert runner.run(only=['headways_6']) == ['headways_6']
+
+    assert runner.run() == ['chunk_trips_2', 'chunk_trips_6',
+                            'chunk_features_2', 'headways_2',
+                            'chunk_features_6', 'headways_6']
+    assert runner.run() == []
+
+
+def test_new_chunk_interval_runs_only_its_stages(memory_db):
+
+    stubs = StubRuns()
+    stubs.runner(load_params(chunks=[2, 6]), memory_db).run()
+
+    params = load_params(chunks=[2, 6, 10])
+    ran = stubs.runner(params, memory_db).run()
+
+    assert ran == ['build_chunks_10', 'chunk_trips_10', 'chunk_features_10',
+                   'headways_10']
@@ -0,0 +1,58 @@
+import os
+import uuid
+from collections import Counter
+
+import pytest
+
+from src.parallel import ShardedExecutor, shard_trip_ids
+
+TRIP_IDS = ['{}_2016-06-{:02d}_{}'.format(trip, day, uuid.uuid4().hex[:8])
+            for day in range(6, 11) for trip in range(7100000, 7100040)]
+
+
+def record_shard(db, trip_ids, out_dir):
+    """
+    Worker that writes the trips of its shard to a file of its own
+    """
+
+    path = os.path.join(out_dir, uuid.uuid4().hex)
+
+    with open(path, 'w') as out_file:
+        out_file.write('\n'.join(trip_ids))
+
+
+@pytest.mark.parametrize('shard_by', ['hash', 'day'])
+def test_shards_cover_every_trip_once(shard_by):
+
+    shards = shard_trip_ids(TRIP_IDS, 8, shard_by)
+
+    counts = Counter(trip for shard in shards.values() for trip in shard)
+
+    assert sorted(counts) == sorted(TRIP_IDS)
+    assert set(counts.values()) == {1}
+
+    if shard_by == 'day':
+        assert sorted(shards) == ['2016-06-{:02d}'.format(day)
+                                  for day in range(6, 11)]
+        assert all(trip.split('_')[1] == day
+                   for day, shard in shards.items() for trip in shard)
+    else:
+        assert set(shards) <= set(range(8))
+        assert len(shards) > 1
+
+
+@pytest.mark.parametrize('shard_by', ['hash', 'day'])
+def test_executor_runs_every_trip_once(shard_by, tmp_path):
+
+    # The workers' clients only connect when used, so no server is needed
+    executor = ShardedExecutor('test', workers=2, shard_by=shard_by)
+
+    failed = executor.run(record_shard, TRIP_IDS, str(tmp_path))
+
+    assert failed == []
+
+    ran = []
+    for path in tmp_path.iterdir():
+        ran.extend(path.read_text().split('\n'))
+
+    assert sorted(ran) == sorted(TRIP_IDS)
@@ -0,0 +1,78 @@
+from collections import Counter
+from datetime import datetime
+
+import pytest
+
+from src.partition import MemoryBudget, MemoryBudgetExceeded, \
+    collection_windows, in_window, window_search
+
+
+def ts(text):
+
+    return datetime.strptime(text, '%Y-%m-%d %H:%M').timestamp()
+
+
+STARTS = {
+    'a': '2016-06-06 08:00',
+    # Crosses midnight
+    'b': '2016-06-06 23:50',
+    # Before 3am, so still the 6th's service day
+    'c': '2016-06-07 02:30',
+    'd': '2016-06-07 03:05',
+    'e': '2016-06-09 12:00',
+}
+
+
+def trip_windows(coll, days):
+    """
+    The windows each trip's start is found in, as the labelers search them
+    """
+
+    found = {}
+
+    for idx, window in enumerate(collection_windows(coll, {'trip_start': 1},
+                                                    days)):
+        for trip in coll.distinct('trip_id_iso',
+                                  window_search({'trip_start': 1}, window)):
+            found.setdefault(trip, []).append(idx)
+
+    return found
+
+
+@pytest.mark.parametrize('days', [None, 1, 2])
+def test_each_trip_falls_in_one_window(db, sf_time, days):
+
+    coll = db['trips']
+    for trip, when in STARTS.items():
+        coll.insert_one({'trip_id_iso': trip, 'time_stamp': ts(when),
+                         'trip_start': 1})
+        coll.insert_one({'trip_id_iso': trip, 'time_stamp': ts(when) + 40 * 60})
+
+    found = trip_windows(coll, days)
+
+    assert sorted(found) == sorted(STARTS)
+    assert all(len(windows) == 1 for windows in found.values())
+
+    assert found['a'] == found['b'] == found['c']
+
+    if days == 1:
+        assert found['d'] == [found['a'][0] + 1]
+        assert found['e'] == [found['a'][0] + 3]
+
+        # The crossing trip's pings after midnight are in its start's window
+        window = collection_windows(coll, {'trip_start': 1}, 1)[found['b'][0]]
+        assert in_window(ts(STARTS['b']) + 40 * 60, window)
+
+
+def test_memory_budget(monkeypatch):
+
+    monkeypatch.setattr('src.partition.rss_mb', lambda: 500.0)
+
+    budget = MemoryBudget()
+    budget.check('unlimited')
+    assert budget.peak_mb == 500.0
+
+    MemoryBudget(1000).check('under')
+
+    with pytest.raises(MemoryBudgetExceeded, match='over the budget of 100MB'):
+        MemoryBudget(100).check('label_trips')
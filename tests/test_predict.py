@@ -0,0 +1,125 @@
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import Ridge
+from sklearn.preprocessing import StandardScaler
+
+import src.predict as predict
+from src.prediction_cache import PredictionCache
+
+FEATURES = ['min_noon_sqr', 'prior_duration']
+
+
+def fit_spec(model, seed=0):
+
+    rng = np.random.RandomState(seed)
+    X = np.column_stack([rng.uniform(0, 5e5, 200), rng.uniform(1500, 3500, 200)])
+    y = 0.002 * X[:, 0] + 0.8 * X[:, 1] + rng.normal(0, 60, 200)
+
+    scaler = StandardScaler().fit(X)
+    scaler_y = StandardScaler().fit(y.reshape(-1, 1))
+    model.fit(scaler.transform(X), scaler_y.transform(y.reshape(-1, 1)).ravel())
+
+    return {'model': model, 'scaler': scaler, 'scaler_y': scaler_y,
+            'features': FEATURES, 'target': 'duration'}, X
+
+
+def sklearn_predict(spec, X):
+
+    scaled = spec['model'].predict(spec['scaler'].transform(X))
+
+    return spec['scaler_y'].inverse_transform(scaled.reshape(-1, 1)).ravel()
+
+
+def test_compiled_linear_matches_sklearn():
+
+    spec, X = fit_spec(Ridge(alpha=10))
+    compiled = predict.CompiledModel('duration', spec)
+
+    assert compiled.kind == 'linear'
+    np.testing.assert_allclose(compiled.predict_matrix(X),
+                                sklearn_predict(spec, X), rtol=1e-9)
+
+
+def test_compiled_forest_matches_sklearn():
+
+    spec, X = fit_spec(RandomForestRegressor(n_estimators=10, max_depth=4,
+                                                random_state=0))
+    compiled = predict.CompiledModel('duration', spec)
+
+    assert compiled.kind == 'forest'
+    np.testing.assert_allclose(compiled.predict_matrix(X),
+                                sklearn_predict(spec, X), rtol=1e-9)
+
+
+def cached_predictor(tmp_path, **kwargs):
+
+    spec, _ = fit_spec(Ridge(alpha=10))
+    path = str(tmp_path / 'models.pkl')
+    predict.save_artifact({'duration': spec}, path)
+
+    predictor = predict.Predictor(path)
+
+    return predictor, PredictionCache(predictor, bucket_minutes=15, **kwargs)
+
+
+def test_cache_keys_on_non_time_features(tmp_path):
+
+    predictor, cache = cached_predictor(tmp_path)
+
+    slow = {'min_noon_sqr': 100, 'prior_duration': 3000}
+    fast = {'min_noon_sqr': 100, 'prior_duration': 2000}
+
+    # Same bucket, different prior trips
+    first = cache.predict('duration', slow, '33', 0, 600)
+    second = cache.predict('duration', fast, '33', 0, 605)
+
+    assert first != second
+    assert second == predictor.predict('duration', [fast])[0]
+    assert cache.stats()['misses'] == 2
+
+    # Only the time of day differs, within the bucket
+    cache.predict('duration', dict(fast, min_noon_sqr=0), '33', 0, 610)
+    assert cache.stats()['hits'] == 1
+
+
+def test_cache_explicit_key_features(tmp_path):
+
+    _, cache = cached_predictor(tmp_path, key_features=[])
+
+    cache.predict('duration', {'min_noon_sqr': 100, 'prior_duration': 3000},
+                    '33', 0, 600)
+    cache.predict('duration', {'min_noon_sqr': 100, 'prior_duration': 2000},
+                    '33', 0, 605)
+
+    assert cache.stats()['hits'] == 1
+
+
+def test_cache_invalidated_by_observation(tmp_path):
+
+    _, cache = cached_predictor(tmp_path)
+    trip = {'min_noon_sqr': 100, 'prior_duration': 3000}
+
+    cache.predict('duration', trip, '33', 0, 600)
+    cache.observe('33', 0)
+    cache.predict('duration', trip, '33', 0, 600)
+
+    stats = cache.stats()
+    assert (stats['hits'], stats['invalidations']) == (0, 1)
+
+
+def test_chunk_models_bucket_their_time_of_day(tmp_path):
+
+    spec, _ = fit_spec(Ridge(alpha=10))
+    spec['features'] = ['mfn_sq_chnk_1', 'prior_seconds_chnk_2']
+    path = str(tmp_path / 'models.pkl')
+    predict.save_artifact({'chunk_2_2': spec}, path)
+
+    cache = PredictionCache(predict.Predictor(path), bucket_minutes=15)
+
+    assert cache.model_key_features('chunk_2_2') == ['prior_seconds_chnk_2']
+
+    trip = {'prior_seconds_chnk_2': 800}
+    cache.predict('chunk_2_2', dict(trip, mfn_sq_chnk_1=90000), '33', 0, 600)
+    cache.predict('chunk_2_2', dict(trip, mfn_sq_chnk_1=88000), '33', 0, 610)
+
+    assert cache.stats()['hits'] == 1
@@ -0,0 +1,39 @@
+import pstats
+import time
+
+from src.profiling import Sampler
+
+
+def busy(seconds):
+
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_sampler_stops_its_thread():
+
+    sampler = Sampler(interval=0.001)
+
+    sampler.enable()
+    busy(0.05)
+    sampler.disable()
+
+    assert sampler.thread is None
+
+    counted = sum(sampler.samples.values())
+    assert counted > 0
+
+    # Nothing is sampled while disabled
+    busy(0.02)
+    assert sum(sampler.samples.values()) == counted
+
+    # Enabled again, samples accumulate
+    sampler.enable()
+    busy(0.02)
+
+    stats = pstats.Stats(sampler)
+
+    assert sampler.thread is None
+    assert sum(sampler.samples.values()) > counted
+    assert any(func == 'busy' for _, _, func in stats.stats)
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import src.replay as replay
+
+
+def write_day(path, times, vehicle):
+
+    lines = ['REV,REPORT_TIME,VEHICLE_TAG,LONGITUDE,LATITUDE,SPEED,HEADING,'
+                'TRAIN_ASSIGNMENT,PREDICTABLE']
+    lines += ['1,{},{},-122.4,37.8,0,0,3301,1'.format(
+                when.strftime('%m/%d/%Y %H:%M:%S'), vehicle) for when in times]
+
+    path.write_text('\n'.join(lines) + '\n')
+
+    return str(path)
+
+
+def test_file_pings_merge_lazily(tmp_path, monkeypatch):
+
+    midnight = datetime(2016, 6, 7)
+    hours = lambda *hrs: [midnight + timedelta(hours=hr) for hr in hrs]
+
+    # Out of order within a file, and the first day runs past midnight
+    paths = [write_day(tmp_path / 'b.csv', hours(26, 24.5, 30), 'b'),
+                write_day(tmp_path / 'a.csv', hours(5, 1, 23, 24.2), 'a'),
+                write_day(tmp_path / 'c.csv', hours(49, 48), 'c'),
+                write_day(tmp_path / 'empty.csv', [], 'x')]
+
+    opened = []
+    read_day_file = replay.read_day_file
+
+    def record(path, header):
+        opened.append(path)
+        return read_day_file(path, header)
+
+    monkeypatch.setattr(replay, 'read_day_file', record)
+
+    streamed = []
+    for ping in replay.file_pings(paths):
+        streamed.append((ping['VEHICLE_TAG'], len(opened)))
+
+    assert [vehicle for vehicle, _ in streamed] == \
+        ['a', 'a', 'a', 'a', 'b', 'b', 'b', 'c', 'c']
+
+    # Each day is only read once the merge reaches it
+    assert [files for _, files in streamed] == [1, 1, 1, 1, 2, 2, 2, 3, 3]
+    assert opened == [paths[1], paths[0], paths[2]]
+
+
+def test_first_time_stamp(tmp_path):
+
+    path = write_day(tmp_path / 'a.csv', [datetime(2016, 6, 7, 9, 5, 3),
+                        datetime(2016, 6, 7, 10, 0, 0),
+                        datetime(2016, 6, 6, 23, 59, 59)], 'a')
+
+    assert replay.first_time_stamp(path) == \
+        datetime(2016, 6, 6, 23, 59, 59).timestamp()
+    assert replay.first_time_stamp(write_day(tmp_path / 'e.csv', [], 'x')) is None
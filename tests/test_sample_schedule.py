@@ -0,0 +1,95 @@
+import os
+
+import pandas as pd
+
+import src.gtfs as gtfs
+import src.sample_schedule as smpl_schd
+
+
+def write_table(path, rows, columns):
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.DataFrame(rows, columns=columns).to_csv(path, index=False)
+
+
+def tiny_gtfs(root):
+    """
+    A GTFS period with one shape and two trips, the longer with three stops
+    """
+
+    write_table(os.path.join(root, 'data/gtfs_lookup.csv'),
+                [('2016-06-04', '2016-08-12', 'tiny', 105)],
+                ['from_date', 'to_date', 'directory', 'sign_id'])
+
+    gtfs_dir = os.path.join(root, 'data/gtfs/tiny')
+
+    write_table(os.path.join(gtfs_dir, 'stops.txt'),
+                [(1, 'A', 37.8, -122.40), (2, 'B', 37.8, -122.39),
+                    (3, 'C', 37.8, -122.38)],
+                ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+    write_table(os.path.join(gtfs_dir, 'shapes.txt'),
+                [('s', 37.8, -122.40 + 0.005 * idx, idx + 1, 440.0 * idx)
+                    for idx in range(5)],
+                ['shape_id', 'shape_pt_lat', 'shape_pt_lon',
+                    'shape_pt_sequence', 'shape_dist_traveled'])
+    write_table(os.path.join(gtfs_dir, 'trips.txt'),
+                [(10, 's'), (11, 's')], ['trip_id', 'shape_id'])
+    write_table(os.path.join(gtfs_dir, 'stop_times.txt'),
+                [(10, 1, 1), (10, 2, 2), (10, 3, 3), (11, 1, 1), (11, 2, 2)],
+                ['trip_id', 'stop_id', 'stop_sequence'])
+
+
+def test_schedule_of_longest_trip(memory_db, tmp_path, monkeypatch):
+
+    tiny_gtfs(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+
+    coll = memory_db['trips']
+    coll.insert_many([{'trip_id': 10}, {'trip_id': 11}])
+
+    schedule = pd.read_csv(smpl_schd.create_sample_schedule(0, coll, '33', 0))
+
+    assert schedule['stop_name'].tolist() == ['A', 'B', 'C']
+    assert schedule['stop_distance'].is_monotonic_increasing
+    assert abs(schedule['stop_distance'].values[-1] - 1760) < 20
+
+
+def test_cache_hit_skips_gtfs(memory_db, tmp_path, monkeypatch):
+
+    tiny_gtfs(str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+
+    coll = memory_db['trips']
+    coll.insert_many([{'trip_id': 10}, {'trip_id': 11}])
+
+    path = smpl_schd.create_sample_schedule(0, coll, '33', 0)
+
+    read_table = gtfs.read_table
+    reads = []
+
+    def counted_read(gtfs_dir, name):
+        reads.append(name)
+        return read_table(gtfs_dir, name)
+
+    monkeypatch.setattr(gtfs, 'read_table', counted_read)
+
+    assert smpl_schd.create_sample_schedule(0, coll, '33', 0) == path
+    assert reads == []
+
+    # New labeled trips with the same pattern: the GTFS has to be read to
+    # tell, but the schedule is kept
+    coll.insert_one({'trip_id': 12})
+
+    assert smpl_schd.create_sample_schedule(0, coll, '33', 0) == path
+    assert reads == ['stop_times']
+
+    # Then the manifest knows these trips too
+    assert smpl_schd.create_sample_schedule(0, coll, '33', 0) == path
+    assert reads == ['stop_times']
+
+    # Touching a GTFS file means checking it again
+    stop_times = gtfs.table_path('tiny', 'stop_times')
+    os.utime(stop_times, (0, 0))
+
+    assert smpl_schd.create_sample_schedule(0, coll, '33', 0) == path
+    assert reads == ['stop_times', 'stop_times']
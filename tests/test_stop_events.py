@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from src.stop_events import event_docs, stop_arrivals
+
+# A straight line along x, so the distance along it is x
+LINE = (np.array([0.0, 1000.0]), np.array([0.0, 0.0]), np.array([0.0, 1000.0]))
+STOPS = [0, 100, 200, 450, 600, 1000]
+
+
+def pings(rows):
+
+    frame = pd.DataFrame(rows, columns=['trip_id_iso', 'time_stamp', 'x'])
+    frame['y'] = 5.0
+
+    return frame
+
+
+def test_stop_arrivals():
+
+    trip_ids, starts, arrivals = stop_arrivals(pings([
+        ('a', 0, 0), ('a', 10, 100),
+        # Waiting at a stop, then GPS noise backwards
+        ('a', 20, 100), ('a', 30, 90),
+        ('a', 40, 300), ('a', 100, 1000),
+        # Only covers the middle of the line
+        ('b', 1000, 500), ('b', 1100, 700),
+    ]), LINE, STOPS)
+
+    assert trip_ids.tolist() == ['a', 'b']
+    assert starts.tolist() == [0, 1000]
+
+    np.testing.assert_allclose(arrivals[0],
+        [0, 10, 25, 40 + 150 / 700 * 60, 40 + 300 / 700 * 60, 100])
+
+    # Stops within the tolerance of where the trip starts get its first ping
+    np.testing.assert_allclose(arrivals[1],
+        [np.nan, np.nan, np.nan, 0, 50, np.nan])
+
+
+def test_trips_are_independent():
+
+    one = pings([('a', 0, 0), ('a', 100, 1000)])
+    both = pings([('a', 0, 0), ('a', 100, 1000),
+                    ('b', 5000, 0), ('b', 5050, 1000)])
+
+    _, _, alone = stop_arrivals(one, LINE, STOPS)
+    _, _, together = stop_arrivals(both, LINE, STOPS)
+
+    np.testing.assert_allclose(together[0], alone[0])
+    np.testing.assert_allclose(together[1], alone[0] / 2)
+
+
+def test_event_docs():
+
+    docs = event_docs(np.array(['a']), np.array([10.0]),
+                        np.array([[0.0, 12.6, np.nan]]), 'sched.csv')
+
+    assert docs == [{'trip_id_iso': 'a', 'start_time': 10.0,
+                        'schedule': 'sched.csv', 'stops_covered': 2,
+                        'arrivals': [0, 13, None]}]
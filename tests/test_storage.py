@@ -0,0 +1,119 @@
+import src.storage as storage
+
+
+def docs():
+
+    return [
+        {'trip_id_iso': 'a', 'time_stamp': 10.0, 'trip_start': 1, 'SPEED': '5'},
+        {'trip_id_iso': 'a', 'time_stamp': 20.0, 'SPEED': '15'},
+        {'trip_id_iso': 'a', 'time_stamp': 30.0, 'trip_end': 1, 'SPEED': '10'},
+        {'trip_id_iso': 'b', 'time_stamp': 15.0, 'trip_start': 1},
+        {'trip_id_iso': 'b', 'time_stamp': 25.0, 'chunk_2': '1'},
+    ]
+
+
+def test_find_queries(db):
+
+    coll = db['trips']
+    coll.insert_many(docs())
+
+    found = lambda query: sorted(doc['time_stamp'] for doc in coll.find(query))
+
+    assert found({'trip_id_iso': 'a'}) == [10, 20, 30]
+    assert found({'time_stamp': {'$gt': 15, '$lte': 30}}) == [20, 25, 30]
+    assert found({'trip_start': {'$exists': False}}) == [20, 25, 30]
+    assert found({'$or': [{'trip_start': 1}, {'trip_end': 1}]}) == [10, 15, 30]
+    assert found({'trip_id_iso': {'$in': ['b']}, 'chunk_2': '1'}) == [25]
+    assert found({'trip_id_iso': {'$ne': 'a'}}) == [15, 25]
+
+    assert coll.count_documents({'trip_start': 1}) == 2
+    assert sorted(coll.distinct('trip_id_iso')) == ['a', 'b']
+    assert coll.distinct('chunk_2', {'trip_id_iso': 'a'}) == []
+
+
+def test_sort_limit_and_projection(db):
+
+    coll = db['trips']
+    coll.insert_many(docs())
+
+    cursor = coll.find({}, {'_id': 0, 'time_stamp': 1}) \
+                .sort('time_stamp', -1).limit(2)
+
+    assert list(cursor) == [{'time_stamp': 30.0}, {'time_stamp': 25.0}]
+
+
+def test_updates_and_deletes(db):
+
+    coll = db['trips']
+    coll.insert_many(docs())
+
+    coll.update_many({'trip_id_iso': 'b'}, {'$set': {'trip_id_iso': 'c'}})
+    coll.update_one({'time_stamp': 20.0}, {'$unset': {'SPEED': ''}})
+    coll.update_one({'trip_id_iso': 'z'}, {'$set': {'time_stamp': 99.0}},
+                    upsert=True)
+    coll.delete_many({'trip_end': 1})
+
+    assert sorted(coll.distinct('trip_id_iso')) == ['a', 'c', 'z']
+    assert 'SPEED' not in coll.find_one({'time_stamp': 20.0})
+    assert coll.count_documents({}) == 5
+
+
+def test_aggregate_group(db):
+
+    coll = db['trips']
+    coll.insert_many(docs())
+
+    rows = coll.aggregate([
+        {'$match': {'time_stamp': {'$gte': 10}}},
+        {'$sort': {'time_stamp': 1}},
+        {'$group': {'_id': '$trip_id_iso', 'first': {'$first': '$time_stamp'},
+                    'last': {'$max': '$time_stamp'}, 'count': {'$sum': 1}}},
+        {'$project': {'span': {'$subtract': ['$last', '$first']}, 'count': 1}},
+        {'$sort': {'_id': 1}}])
+
+    assert [(row['_id'], row['span'], row['count']) for row in rows] == \
+        [('a', 20, 3), ('b', 10, 2)]
+
+
+def test_save_and_load(tmp_path):
+
+    db = storage.MemoryStorage(str(tmp_path))
+    db['trips'].insert_many(docs())
+    db.save()
+
+    loaded = storage.MemoryStorage(str(tmp_path))
+
+    assert loaded['trips'].count_documents({'trip_id_iso': 'a'}) == 3
+    assert loaded['trips'].find_one({'chunk_2': '1'})['time_stamp'] == 25.0
+
+
+def test_nulls_sort_first_ascending_last_descending(db):
+
+    coll = db['trips']
+    coll.insert_many([{'k': 'a', 'v': 2}, {'k': 'b'}, {'k': 'c', 'v': None},
+                        {'k': 'd', 'v': 1}])
+
+    def order(direction):
+        return [doc['k'] for doc in coll.find().sort('v', direction)]
+
+    def aggregated(direction):
+        return [doc['k'] for doc in coll.aggregate([{'$sort': {'v': direction}}])]
+
+    assert order(1) == aggregated(1) == ['b', 'c', 'd', 'a']
+    assert order(-1) == aggregated(-1) == ['a', 'd', 'b', 'c']
+
+
+def test_group_first_and_last_keep_nulls(db):
+
+    coll = db['trips']
+    coll.insert_many([{'g': 1, 't': 1, 'v': None}, {'g': 1, 't': 2, 'v': 7},
+                        {'g': 1, 't': 3, 'v': None}, {'g': 2, 't': 1, 'v': 5}])
+
+    rows = coll.aggregate([
+        {'$sort': {'t': 1}},
+        {'$group': {'_id': '$g', 'first': {'$first': '$v'},
+                    'last': {'$last': '$v'}, 'top': {'$max': '$t'}}},
+        {'$sort': {'_id': 1}}])
+
+    assert [(row['_id'], row['first'], row['last'], row['top'])
+            for row in rows] == [(1, None, None, 3), (2, 5, 5, 1)]
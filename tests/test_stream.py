@@ -0,0 +1,112 @@
+import numpy as np
+
+from src.label_trips import MAX_PING_GAP, MIN_TRIP_DOCS
+from src.stream import MAX_IDLE_SECONDS, TripStream, route_blocks
+
+START = (37.80, -122.40)
+END = (37.80, -122.35)
+
+
+def ping(ts, lon, vehicle='1', block='3301'):
+
+    return {'VEHICLE_TAG': vehicle, 'TRAIN_ASSIGNMENT': block,
+            'time_stamp': float(ts), 'LATITUDE': str(START[0]),
+            'LONGITUDE': str(lon)}
+
+
+def drive(stream, t0=0, count=MIN_TRIP_DOCS + 10, vehicle='1', block='3301'):
+    """
+    Wait at the starting stop, then drive to the last stop a minute a ping
+    """
+
+    stream.process(ping(t0, START[1], vehicle, block))
+
+    for lon in np.linspace(START[1] + 0.002, END[1], count):
+        t0 += 60
+        stream.process(ping(t0, lon, vehicle, block))
+
+    return t0
+
+
+def event_stream(**kwargs):
+
+    events = []
+    stream = TripStream(START, END, events.append, **kwargs)
+
+    return stream, events
+
+
+def test_completed_trip():
+
+    stream, events = event_stream()
+    drive(stream)
+
+    assert [event['type'] for event in events] == ['trip_start', 'trip_completed']
+    assert events[0]['time_stamp'] == 0
+    # Ends at the first ping near the last stop
+    assert events[1]['duration'] == events[1]['time_stamp']
+    assert events[1]['doc_count'] >= MIN_TRIP_DOCS
+    assert stream.counts['completed'] == 1
+    assert stream.vehicles['1'].state == 'idle'
+
+
+def test_sparse_trip_is_rejected():
+
+    stream, events = event_stream()
+    stream.process(ping(0, START[1]))
+    stream.process(ping(60, START[1] + 0.002))
+    stream.process(ping(60 + MAX_PING_GAP + 1, START[1] + 0.004))
+
+    assert [event['type'] for event in events] == ['trip_start', 'trip_rejected']
+    assert events[1]['reason'] == 'sparse'
+    assert stream.vehicles['1'].state == 'idle'
+
+
+def test_unmatched_start_goes_idle():
+
+    stream, events = event_stream(start_matcher=lambda start: None)
+    drive(stream)
+
+    assert events == []
+    assert stream.counts['completed'] == 0
+    assert stream.vehicles['1'].state == 'idle'
+
+
+def test_matched_start_labels_events():
+
+    stream, events = event_stream(
+                        start_matcher=lambda start: {'trip_id_iso': 'x'})
+    drive(stream)
+
+    assert [event['trip_id_iso'] for event in events] == ['x', 'x']
+
+
+def test_evict_idle_rejects_open_trips():
+
+    stream, events = event_stream()
+    stream.process(ping(0, START[1]))
+    stream.process(ping(60, START[1] + 0.002))
+    drive(stream, vehicle='2', t0=MAX_IDLE_SECONDS)
+
+    assert stream.latest_ts > 60 + MAX_IDLE_SECONDS
+
+    stream.evict_idle(stream.latest_ts)
+
+    assert list(stream.vehicles) == ['2']
+    assert stream.counts['endless'] == 1
+
+
+def test_off_route_blocks_are_ignored():
+
+    stream, events = event_stream(blocks=route_blocks(1, '33', 0))
+
+    # A vehicle of another route, driving the same streets
+    drive(stream, vehicle='2', block='3801')
+
+    assert events == []
+    assert stream.vehicles == {}
+    assert stream.counts['pings'] == 0
+
+    drive(stream, vehicle='1', block='3301')
+
+    assert [event['type'] for event in events] == ['trip_start', 'trip_completed']
@@ -0,0 +1,112 @@
+from datetime import datetime
+
+import pandas as pd
+
+from src.trip_chunk_collections import chunk_data_interval, chunk_frame, \
+    local_minutes, trip_duration_pipeline
+
+
+def ts(text):
+
+    return datetime.strptime(text, '%Y-%m-%d %H:%M').timestamp()
+
+
+def start_doc(trip, when):
+
+    start_dt = datetime.fromtimestamp(ts(when))
+    mins = start_dt.hour * 60 + start_dt.minute
+
+    return {'trip_id_iso': trip, 'time_stamp': ts(when), 'trip_start': 1,
+            'minutes_noon_sqr': (mins - 720)**2, 'min_since_midnight': mins}
+
+
+def test_duration_from_first_start(db):
+
+    coll = db['trips']
+    coll.insert_many([
+        start_doc('a', '2016-06-06 09:31'),
+        # A second start, later on, doesn't shorten the trip
+        start_doc('a', '2016-06-06 10:20'),
+        {'trip_id_iso': 'a', 'time_stamp': ts('2016-06-06 10:21'), 'trip_end': 1},
+        start_doc('b', '2016-06-06 13:00'),
+        {'trip_id_iso': 'b', 'time_stamp': ts('2016-06-06 13:45'), 'trip_end': 1},
+        # No end
+        start_doc('c', '2016-06-06 14:00'),
+    ])
+
+    rows = {row['trip_id_iso']: row
+            for row in coll.aggregate(trip_duration_pipeline())}
+
+    assert sorted(rows) == ['a', 'b']
+
+    assert rows['a']['duration'] == 50 * 60
+    assert rows['a']['start_timestamp'] == ts('2016-06-06 09:31')
+    assert rows['a']['min_since_midnight'] == 9 * 60 + 31
+    assert rows['a']['min_noon_sqr'] == (9 * 60 + 31 - 720)**2
+
+    assert rows['b']['duration'] == 45 * 60
+    assert rows['b']['min_since_midnight'] == 13 * 60
+
+
+def test_chunk_frame_uses_first_start(memory_db):
+
+    # mongomock has no $toDouble
+    coll = memory_db['trips']
+    coll.insert_many([
+        start_doc('a', '2016-06-06 09:31'),
+        start_doc('a', '2016-06-06 09:40'),
+        {'trip_id_iso': 'a', 'time_stamp': ts('2016-06-06 09:35'),
+            'chunk_2': '1', 'SPEED': '10'},
+        {'trip_id_iso': 'a', 'time_stamp': ts('2016-06-06 09:50'),
+            'chunk_2': '2', 'SPEED': '20'},
+    ])
+
+    frame = chunk_frame(coll, 2)
+
+    assert sorted(frame['chunk']) == ['1', '2']
+    assert (frame['start_timestamp'] == ts('2016-06-06 09:31')).all()
+
+
+def test_local_minutes_match_fromtimestamp(sf_time):
+
+    # Either side of the spring and fall clock changes
+    stamps = pd.Series([ts('2016-03-12 23:59'), ts('2016-03-13 04:10'),
+                        ts('2016-11-06 00:30'), ts('2016-11-06 13:05')])
+
+    expected = [datetime.fromtimestamp(stamp).hour * 60
+                    + datetime.fromtimestamp(stamp).minute for stamp in stamps]
+
+    assert local_minutes(stamps).tolist() == expected
+    assert expected == [23 * 60 + 59, 4 * 60 + 10, 30, 13 * 60 + 5]
+
+
+def test_chunk_data_interval_mfn_sq(memory_db, sf_time):
+
+    memory_db['chunks'].insert_one({'number_chunks': 2,
+                                    'chunks': {'1': {}, '2': {}}})
+
+    trips = memory_db['trips']
+    trips.insert_many([
+        start_doc('a', '2016-06-06 09:31'),
+        {'trip_id_iso': 'a', 'time_stamp': ts('2016-06-06 09:35'),
+            'chunk_2': '1', 'SPEED': '10'},
+        {'trip_id_iso': 'a', 'time_stamp': ts('2016-06-06 09:45'),
+            'chunk_2': '1', 'SPEED': '20'},
+        {'trip_id_iso': 'a', 'time_stamp': ts('2016-06-06 10:02'),
+            'chunk_2': '2', 'SPEED': '20'},
+        # Trips missing a chunk are skipped
+        start_doc('b', '2016-06-06 11:00'),
+        {'trip_id_iso': 'b', 'time_stamp': ts('2016-06-06 11:05'),
+            'chunk_2': '1', 'SPEED': '10'},
+    ])
+
+    chunk_data_interval(None, trips, memory_db['chunks'], memory_db['out'], 2)
+
+    rows = list(memory_db['out'].find({}, {'_id': 0}))
+
+    assert len(rows) == 1
+    assert rows[0]['trip_id_iso'] == 'a'
+    assert rows[0]['seconds_chnk_1'] == 10 * 60
+    assert rows[0]['mfn_sq_chnk_1'] == (9 * 60 + 35 - 720)**2
+    assert rows[0]['mfn_sq_chnk_2'] == (10 * 60 + 2 - 720)**2
+    assert rows[0]['avg_speed_chnk_1'] == 15
@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.linear_model import Ridge
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.model_selection import GridSearchCV, KFold, train_test_split
+from sklearn.preprocessing import StandardScaler
+
+import src.feature_store as ftr_store
+import src.prior_features as priors
+import src.predict as predict
+import src.storage as storage
+from src.fingerprint import fingerprint_values
+
+# Hyperparameter grids searched for each model
+GRIDS = {
+    'ridge': (Ridge, {'alpha': [5, 10, 20, 30]}),
+    'forest': (RandomForestRegressor, {'n_estimators': [50, 100],
+                                        'max_depth': [2, 4],
+                                        'max_leaf_nodes': [20]})
+}
+
+MODEL_DIR = 'models'
+CACHE_DIR = os.path.join(MODEL_DIR, 'cache')
+
+
+def load_table(name, db, root=ftr_store.FEATURE_DIR):
+    """
+    Load a feature table from the feature store, or from its collection if it
+    hasn't been written there yet
+    Output: DataFrame, and a description of the data version
+    """
+
+    try:
+        table = ftr_store.load_feature_table(name, root=root)
+        return table.to_frame(), {'table': name,
+                                    'version': table.manifest['version']}
+    except IOError:
+        frame = pd.DataFrame(list(db[name].find({}, {'_id': 0})))
+        return frame, {'table': name, 'rows': len(frame)}
+
+
+def model_tasks(params, db):
+    """
+    Build the list of models to train: total duration, and one per chunk of
+    each chunk interval.
+    Output: List of (name, DataFrame, features, target, data description)
+    """
+
+    tasks = []
+
+    feature_dir = params.get('feature_dir', ftr_store.FEATURE_DIR)
+
+    # Total duration, from the time of day and the previous trip
+    duration_df, source = load_table(params['duration_collection'], db,
+                                feature_dir)
+    duration_df = duration_df[duration_df['duration'] < params.get('max_duration', 4500)]
+    duration_df = priors.duration_priors(duration_df)
+
+    tasks.append(('duration', duration_df, ['min_noon_sqr', 'prior_duration'],
+                    'duration', source))
+
+    trims = params.get('chunk_trim_seconds', {})
+
+    for chunk_interval in params['chunks']:
+
+        coll_str = "chunk_" + str(chunk_interval) + "_collection"
+        chunk_df, source = load_table(coll_str, db, feature_dir)
+        chunk_df = priors.chunk_priors(chunk_df, chunk_interval)
+
+        # Drop trips with unreasonably long chunks
+        trim = trims.get(str(chunk_interval), 5000 / chunk_interval)
+        seconds_cols = ['seconds_chnk_' + str(seq)
+                        for seq in range(1, chunk_interval + 1)]
+        chunk_df = chunk_df[(chunk_df[seconds_cols] < trim).all(axis=1)]
+
+        for seq in range(1, chunk_interval + 1):
+
+            target = 'seconds_chnk_' + str(seq)
+            features = ['prior_' + target]
+
+            # Later chunks also know how the trip did on the chunk before
+            if seq > 1:
+                features = ['seconds_chnk_' + str(seq - 1),
+                            'mfn_sq_chnk_' + str(seq - 1)] + features
+            else:
+                features = ['mfn_sq_chnk_1'] + features
+
+            name = 'chunk_{}_chnk_{}'.format(chunk_interval, seq)
+            tasks.append((name, chunk_df, features, target, source))
+
+    return tasks
+
+
+def prepare(name, frame, features, target, cv, seed):
+    """
+    Split, scale and fold a task's data, caching the results on disk so
+    retraining on unchanged data skips straight to fitting.
+    Output: Dictionary of scaled matrices, scalers and fold indices
+    """
+
+    data_hash = int(pd.util.hash_pandas_object(frame[features + [target]]).sum())
+    key = fingerprint_values([name, features, target, data_hash, cv, seed])
+    cache_path = os.path.join(CACHE_DIR, name + '_' + key[:12] + '.pkl')
+
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+
+    X = frame[features].values.astype(float)
+    y = frame[target].values.astype(float).reshape(-1, 1)
+
+    train_idx, test_idx = train_test_split(np.arange(len(y)), random_state=seed)
+    kfold = KFold(n_splits=cv, shuffle=True, random_state=seed)
+
+    scaler = StandardScaler().fit(X[train_idx])
+    scaler_y = StandardScaler().fit(y[train_idx])
+
+    data = {
+        'X_train': scaler.transform(X[train_idx]),
+        'y_train': scaler_y.transform(y[train_idx]).ravel(),
+        'X_test': scaler.transform(X[test_idx]),
+        'y_test': y[test_idx].ravel(),
+        'scaler': scaler,
+        'scaler_y': scaler_y,
+        'folds': list(kfold.split(train_idx))
+    }
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(cache_path, 'wb') as f:
+        pickle.dump(data, f)
+
+    return data
+
+
+def train_task(data, model_names, n_jobs):
+    """
+    Grid search every model type over the cached folds, in parallel, and keep
+    the best one by cross-validated RMSE.
+    Output: The best fitted model and the metrics of every model type
+    """
+
+    best = None
+    metrics = {}
+    y_scale = data['scaler_y'].scale_[0]
+
+    for model_name in model_names:
+
+        estimator, grid = GRIDS[model_name]
+
+        search = GridSearchCV(estimator(), grid, cv=data['folds'],
+                    scoring='neg_mean_squared_error', n_jobs=n_jobs)
+        search.fit(data['X_train'], data['y_train'])
+
+        # Scores are on the scaled target, convert RMSE back to seconds
+        cv_rmse = (-search.best_score_)**.5 * y_scale
+
+        y_pred = data['scaler_y'].inverse_transform(
+            search.predict(data['X_test']).reshape(-1, 1)).ravel()
+
+        metrics[model_name] = {
+            'params': search.best_params_,
+            'cv_rmse': float(cv_rmse),
+            'test_rmse': float(mean_squared_error(data['y_test'], y_pred)**.5),
+            'test_r2': float(r2_score(data['y_test'], y_pred))
+        }
+
+        if best is None or cv_rmse < best[1]:
+            best = (search.best_estimator_, cv_rmse, model_name)
+
+    return best[0], best[2], metrics
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Train total duration and chunk interval models')
+    parser.add_argument('--cv', type=int, default=20, help='Number of CV folds')
+    parser.add_argument('--n-jobs', type=int, default=-1,
+                        help='Parallel fits, -1 for every core')
+    parser.add_argument('--models', default='ridge,forest',
+                        help='Comma separated model types to try')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Load in our parameters file
+    with open('parameters.json') as f:
+        params = json.load(f)
+
+    db = storage.open_storage(params)
+
+    artifact = {}
+    all_metrics = {}
+
+    for name, frame, features, target, source in model_tasks(params, db):
+
+        print ("Training ", name, " on ", len(frame), " trips")
+
+        data = prepare(name, frame, features, target, args.cv, args.seed)
+        model, model_name, metrics = train_task(data, args.models.split(','),
+                                        args.n_jobs)
+
+        artifact[name] = {
+            'model': model,
+            'scaler': data['scaler'],
+            'scaler_y': data['scaler_y'],
+            'features': features,
+            'target': target,
+            'metrics': metrics[model_name]
+        }
+
+        all_metrics[name] = {'best': model_name, 'models': metrics,
+                                'data': source}
+
+        print ("Best: ", model_name, " RMSE: ",
+                "{0:.2f}".format(metrics[model_name]['test_rmse']))
+
+    # Write a new version of the model artifact, with its metrics
+    run_name = '{}_{}_{}'.format(params['bus'], params['direction'],
+                    params['gtfs_period'])
+    versions = ftr_store.table_versions(run_name, root=MODEL_DIR)
+    version = versions[-1] + 1 if versions else 1
+
+    out_dir = os.path.join(MODEL_DIR, run_name, 'v{:04d}'.format(version))
+    os.makedirs(out_dir)
+
+    predict.save_artifact(artifact, os.path.join(out_dir, 'models.pkl'))
+
+    with open(os.path.join(out_dir, 'metrics.json'), 'w') as f:
+        json.dump(all_metrics, f, indent=2, default=str)
+
+    print ("Models written to ", out_dir)